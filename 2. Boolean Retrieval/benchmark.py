@@ -0,0 +1,424 @@
+#!/usr/bin/python3
+import getopt
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from itertools import accumulate
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.termdict import TermDictionary
+from postings import Bitmap, decode_postings, intersect, linked_list_differece, not_difference, two_merge
+import vectorized
+from vectorized_check import check_operations
+
+# Reproducible benchmark of the Boolean engine: a seeded synthetic corpus is generated in the layout read by
+# index.py (one file per document, named by its docId), indexed with index.py, then
+# - the postings lists operations are timed on postings lists of the built index (rare and common terms)
+# - the full search path is timed per query shape, on a resident index (search.py in server mode)
+# Both are timed with the Python and the NumPy backend (vectorized.py), after a differential check that the
+# vectorized operations and queries give exactly the results of the Python ones (the run fails otherwise).
+# The report is a JSON file, comparable with the report of another commit (-c).
+#
+# Document words are drawn from a Zipf distribution: the word of rank r has a probability proportional to
+# 1 / r^ZIPF_EXPONENT, as the terms of natural language text.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DOCUMENTS = 2000
+VOCABULARY = 5000
+DOCUMENT_LENGTH = 200
+SEED = 3245
+REPEAT = 5
+
+ZIPF_EXPONENT = 1.0
+SENTENCE_LENGTH = 12
+
+# Queries generated for every query shape
+QUERIES_PER_SHAPE = 20
+# Number of operands of the deep OR queries
+OR_DEPTH = 8
+
+# Word ranks of common, mid-frequency and rare words, as fractions of the vocabulary
+COMMON_RANKS = (0, 0.005)
+MIDDLE_RANKS = (0.02, 0.1)
+RARE_RANKS = (0.3, 0.9)
+
+# A median slower than the baseline by more than this ratio is reported as a regression
+REGRESSION_THRESHOLD = 1.25
+
+# Worker processes of the parallel builds checked against the serial builds, and the files of the Boolean and VSM
+# indexes which must be byte-identical
+CHECKED_WORKERS = 4
+BOOLEAN_INDEX_FILES = ('dictionary.txt', 'postings.txt', 'docIds.bitmap', 'permuterm.txt')
+VSM_INDEX = os.path.join(HERE, '..', '3. Vector Space Model', 'index.py')
+VSM_INDEX_FILES = ('dictionary.txt', 'postings.txt', 'documents.table')
+
+CONSONANTS = 'bdfgklmnprstvz'
+VOWELS = 'aiou'
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -o report-file [-n documents] [-v vocabulary] [-l document-length]"
+                                    " [-s seed] [-r repeat] [-t work-directory] [-c baseline-report-file]")
+
+
+# Distinct pronounceable word for every rank: its digits in base (consonants x vowels), one syllable per digit
+def make_word(rank):
+    syllables = [c + v for c in CONSONANTS for v in VOWELS]
+    word = ''
+    rank += 1
+    while rank:
+        rank, digit = divmod(rank - 1, len(syllables))
+        word = syllables[digit] + word
+    return word + 'n'
+
+
+def generate_corpus(directory, documents, vocabulary, length, seed):
+    rng = random.Random(seed)
+    words = [make_word(rank) for rank in range(vocabulary)]
+    cumulative_weights = list(accumulate(1 / (rank + 1) ** ZIPF_EXPONENT for rank in range(vocabulary)))
+    os.makedirs(directory)
+    # docIds are not contiguous, as in a real collection
+    docId = 0
+    for _ in range(documents):
+        docId += rng.randint(1, 3)
+        drawn = rng.choices(words, cum_weights=cumulative_weights, k=length)
+        sentences = [' '.join(drawn[i:i + SENTENCE_LENGTH]) + '.' for i in range(0, length, SENTENCE_LENGTH)]
+        with open(os.path.join(directory, str(docId)), 'w') as handle:
+            handle.write(' '.join(sentences))
+    return words
+
+
+# Words with ranks in the given range (fractions of the vocabulary)
+def ranked_words(words, ranks):
+    low, high = ranks
+    return words[int(low * len(words)):max(int(low * len(words)) + 1, int(high * len(words)))]
+
+
+# Queries of every shape, drawn from the words by their frequency
+def generate_queries(words, seed):
+    rng = random.Random(seed)
+    common = ranked_words(words, COMMON_RANKS)
+    middle = ranked_words(words, MIDDLE_RANKS)
+    rare = ranked_words(words, RARE_RANKS)
+    shapes = {
+        'rare_and_common': lambda: f'{rng.choice(rare)} AND {rng.choice(common)}',
+        'common_and_common': lambda: ' AND '.join(rng.sample(common, 2)),
+        'deep_or': lambda: ' OR '.join(rng.sample(middle, OR_DEPTH)),
+        'not_heavy': lambda: f'{rng.choice(common)} AND NOT {rng.choice(middle)} AND NOT {rng.choice(middle)}',
+        'not_only': lambda: f'NOT {rng.choice(common)} AND NOT {rng.choice(rare)}',
+        'mixed': lambda: f'({rng.choice(middle)} OR {rng.choice(rare)}) AND NOT ({rng.choice(common)} AND '
+                         f'{rng.choice(middle)})',
+    }
+    return {shape: [make_query() for _ in range(QUERIES_PER_SHAPE)] for shape, make_query in shapes.items()}
+
+
+def build_index(corpus_directory, work_directory, index_script=os.path.join(HERE, 'index.py'), options=()):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, index_script, '-i', corpus_directory, '-d', 'dictionary.txt', '-p', 'postings.txt']
+                   + list(options), cwd=work_directory, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def same_files(directory, other_directory, names):
+    different = []
+    for name in names:
+        with open(os.path.join(directory, name), 'rb') as handle:
+            data = handle.read()
+        with open(os.path.join(other_directory, name), 'rb') as handle:
+            if handle.read() != data:
+                different.append(name)
+    return different
+
+
+# Check that a parallel build (index.py -w) writes exactly the files of a serial build, for the Boolean index (built
+# serially in the work directory) and the VSM index of the corpus. Returns the descriptions of the mismatches.
+def check_parallel_builds(corpus_directory, work_directory):
+    mismatches = []
+    parallel_directory = os.path.join(work_directory, 'parallel')
+    os.makedirs(parallel_directory)
+    build_index(corpus_directory, parallel_directory, options=['-w', str(CHECKED_WORKERS)])
+    mismatches.extend(f'boolean {name}' for name in same_files(work_directory, parallel_directory,
+                                                               BOOLEAN_INDEX_FILES))
+
+    directories = []
+    for name, options in (('vsm-serial', []), ('vsm-parallel', ['-w', str(CHECKED_WORKERS)])):
+        directory = os.path.join(work_directory, name)
+        os.makedirs(directory)
+        build_index(corpus_directory, directory, VSM_INDEX, options)
+        directories.append(directory)
+    mismatches.extend(f'vsm {name}' for name in same_files(*directories, VSM_INDEX_FILES))
+    return mismatches
+
+
+def summarize(timings):
+    return {'calls': len(timings), 'min': min(timings), 'median': statistics.median(timings),
+            'mean': statistics.mean(timings), 'p95': sorted(timings)[int(0.95 * (len(timings) - 1))]}
+
+
+# Postings lists of the dictionary terms, from the most to the least frequent
+def load_postings(work_directory):
+    dictionary = TermDictionary(os.path.join(work_directory, 'dictionary.txt'))
+    with open(os.path.join(work_directory, 'postings.txt'), 'rb') as postings_file:
+        entries = sorted(dictionary.items(), key=lambda entry: (-entry[1][2], entry[0]))
+        postings = []
+        for term, (position, size, length) in entries:
+            postings_file.seek(position)
+            postings.append(decode_postings(postings_file.read(size), length))
+    dictionary.close()
+    with open(os.path.join(work_directory, 'docIds.bitmap'), 'rb') as handle:
+        all_docIds = Bitmap.from_bytes(handle.read())
+    return postings, all_docIds
+
+
+# Time the postings lists operations on pairs of lists of rare, mid-frequency and common terms,
+# with the Python operations on the decoded lists and the vectorized ones on arrays
+def time_operations(postings, all_docIds, repeat):
+    def pick(ranks):
+        return ranked_words(postings, ranks)[0]
+
+    # list containers of the operands, as the operations receive them from the query evaluation
+    def as_list(p):
+        return list(p) if isinstance(p, Bitmap) else p
+
+    # the two most frequent terms
+    common, common2 = postings[0], postings[1]
+    middle, rare = pick(MIDDLE_RANKS), pick(RARE_RANKS)
+    cases = {
+        'intersect/rare_common': (intersect, (rare, common)),
+        'intersect/middle_common': (intersect, (middle, common)),
+        'intersect/common_common': (intersect, (common, common2)),
+        'two_merge/middle_rare': (two_merge, (middle, rare)),
+        'two_merge/common_common': (two_merge, (common, common2)),
+        'linked_list_differece/common_middle': (linked_list_differece, (common, middle)),
+        'linked_list_differece/middle_rare': (linked_list_differece, (middle, rare)),
+        'not_difference/common': (not_difference, (as_list(common), all_docIds)),
+        'not_difference/rare': (not_difference, (as_list(rare), all_docIds)),
+    }
+    # the vectorized operations on the arrays held by the numpy backend
+    for name, (operation, args) in list(cases.items()):
+        vectorized_operation = getattr(vectorized, operation.__name__)
+        cases['numpy/' + name] = (vectorized_operation, tuple(vectorized.to_array(arg) for arg in args))
+
+    results = {}
+    for name, (operation, args) in cases.items():
+        number, _ = timeit.Timer(lambda: operation(*args)).autorange()
+        timings = [t / number for t in timeit.repeat(lambda: operation(*args), number=number, repeat=repeat)]
+        results[name] = summarize(timings)
+        results[name]['operand_lengths'] = [len(arg) for arg in args]
+    return results
+
+
+# Time every query through a resident index (search.py in server mode with the given backend), from sending the query
+# to reading its result line, so that loading the index is not counted.
+# Returns the timings by query shape and the result lines of the first round.
+def time_queries(work_directory, queries, repeat, backend='python'):
+    server = subprocess.Popen([sys.executable, os.path.join(HERE, 'search.py'),
+                               '-d', 'dictionary.txt', '-p', 'postings.txt', '-s', '-b', backend],
+                              cwd=work_directory, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    def answer(query):
+        start = time.perf_counter()
+        server.stdin.write(query + '\n')
+        server.stdin.flush()
+        line = server.stdout.readline()
+        return time.perf_counter() - start, line
+
+    results = {}
+    answers = []
+    for shape, shape_queries in queries.items():
+        timings = []
+        result_lengths = []
+        # the first round fills the result cache of the server like a fresh batch, later rounds hit it
+        first_round = []
+        for round_number in range(repeat):
+            for query in shape_queries:
+                elapsed, line = answer(query)
+                timings.append(elapsed)
+                if round_number == 0:
+                    first_round.append(elapsed)
+                    result_lengths.append(len(line.split()))
+                    answers.append(line)
+        results[shape] = summarize(first_round)
+        results[shape]['cached_median'] = statistics.median(timings[len(first_round):]) if repeat > 1 else None
+        results[shape]['mean_result_length'] = statistics.mean(result_lengths)
+
+    server.stdin.close()
+    server.wait()
+    return results, answers
+
+
+# Time a whole batch of queries with search.py (loading the index included)
+def time_batch(work_directory, queries, backend='python'):
+    queries_path = os.path.join(work_directory, 'queries.txt')
+    with open(queries_path, 'w') as handle:
+        handle.write('\n'.join(query for shape_queries in queries.values() for query in shape_queries) + '\n')
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(HERE, 'search.py'), '-d', 'dictionary.txt', '-p', 'postings.txt',
+                    '-q', queries_path, '-o', os.path.join(work_directory, 'results.txt'), '-b', backend],
+                   cwd=work_directory, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Median timings of two reports, by metric name
+def report_medians(report):
+    medians = {'build': report['build_seconds'], 'batch': report['batch_seconds'],
+               'numpy_batch': report.get('numpy_batch_seconds')}
+    for section in ('operations', 'queries', 'numpy_queries'):
+        for name, timings in report.get(section, {}).items():
+            medians[f'{section}/{name}'] = timings['median']
+    return medians
+
+
+# Print the ratio of every timing to the baseline, returns the names of the regressed metrics
+def compare_reports(baseline, report):
+    regressions = []
+    baseline_medians = report_medians(baseline)
+    for name, median in report_medians(report).items():
+        if baseline_medians.get(name) is None:
+            continue
+        ratio = median / baseline_medians[name] if baseline_medians[name] else float('inf')
+        flag = ''
+        if ratio > REGRESSION_THRESHOLD:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:50} {baseline_medians[name]:12.6f} {median:12.6f} {ratio:7.2f}x{flag}')
+    return regressions
+
+
+def run_benchmark(report_path, documents, vocabulary, length, seed, repeat, work_directory=None,
+                  baseline_path=None):
+    """
+    generate the synthetic corpus, build its index, check that both backends agree, time the postings lists
+    operations and the queries, then write the report (and compare it with the baseline report).
+    Returns the names of the regressed metrics, or of the failed checks.
+    """
+    keep = work_directory is not None
+    if keep:
+        shutil.rmtree(work_directory, ignore_errors=True)
+        os.makedirs(work_directory)
+    else:
+        work_directory = tempfile.mkdtemp(prefix='boolean-benchmark-')
+    work_directory = os.path.abspath(work_directory)
+
+    print('generating corpus...')
+    words = generate_corpus(os.path.join(work_directory, 'documents'), documents, vocabulary, length, seed)
+    queries = generate_queries(words, seed)
+
+    print('indexing...')
+    build_seconds = build_index(os.path.join(work_directory, 'documents'), work_directory)
+
+    print('checking the numpy backend...')
+    postings, all_docIds = load_postings(work_directory)
+    mismatches = check_operations(postings, all_docIds, seed)
+
+    print('checking the parallel builds...')
+    build_mismatches = check_parallel_builds(os.path.join(work_directory, 'documents'), work_directory)
+    for mismatch in build_mismatches:
+        print(f'parallel build differs: {mismatch}')
+
+    print('timing postings lists operations...')
+    operations = time_operations(postings, all_docIds, repeat)
+
+    print('timing queries...')
+    query_timings, answers = time_queries(work_directory, queries, repeat)
+    batch_seconds = time_batch(work_directory, queries)
+    numpy_query_timings, numpy_answers = time_queries(work_directory, queries, repeat, 'numpy')
+    numpy_batch_seconds = time_batch(work_directory, queries, 'numpy')
+    all_queries = [query for shape_queries in queries.values() for query in shape_queries]
+    mismatches.extend(f'query {query!r}' for query, answer, numpy_answer in zip(all_queries, answers, numpy_answers)
+                      if answer != numpy_answer)
+    for mismatch in mismatches:
+        print(f'backends differ: {mismatch}')
+
+    report = {
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {'documents': documents, 'vocabulary': vocabulary, 'document_length': length, 'seed': seed,
+                       'repeat': repeat, 'zipf_exponent': ZIPF_EXPONENT, 'queries_per_shape': QUERIES_PER_SHAPE},
+        'index': {'terms': len(postings), 'documents': len(all_docIds),
+                  'postings_bytes': os.path.getsize(os.path.join(work_directory, 'postings.txt'))},
+        'build_seconds': build_seconds,
+        'batch_seconds': batch_seconds,
+        'numpy_batch_seconds': numpy_batch_seconds,
+        'operations': operations,
+        'queries': query_timings,
+        'numpy_queries': numpy_query_timings,
+        'backend_mismatches': mismatches,
+        'parallel_build_mismatches': build_mismatches,
+    }
+    with open(report_path, 'w') as handle:
+        json.dump(report, handle, indent=2, sort_keys=True)
+
+    if not keep:
+        shutil.rmtree(work_directory)
+
+    regressions = ['backends'] if mismatches else []
+    if build_mismatches:
+        regressions.append('parallel builds')
+    if baseline_path is not None:
+        with open(baseline_path, 'r') as handle:
+            baseline = json.load(handle)
+        if baseline['parameters'] != report['parameters']:
+            print('warning: the baseline was run with different parameters')
+        regressions += compare_reports(baseline, report)
+    print('DONE!')
+    return regressions
+
+
+report_file = work_directory = baseline_file = None
+documents = DOCUMENTS
+vocabulary = VOCABULARY
+length = DOCUMENT_LENGTH
+seed = SEED
+repeat = REPEAT
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], 'o:n:v:l:s:r:t:c:')
+except getopt.GetoptError:
+    usage()
+    sys.exit(2)
+
+for o, a in opts:
+    if o == '-o':  # report file
+        report_file = a
+    elif o == '-n':  # number of documents
+        documents = int(a)
+    elif o == '-v':  # number of distinct words
+        vocabulary = int(a)
+    elif o == '-l':  # words per document
+        length = int(a)
+    elif o == '-s':  # random seed of the corpus and the queries
+        seed = int(a)
+    elif o == '-r':  # timing repetitions
+        repeat = int(a)
+    elif o == '-t':  # work directory, kept after the run
+        work_directory = a
+    elif o == '-c':  # baseline report to compare with
+        baseline_file = a
+    else:
+        assert False, "unhandled option"
+
+if report_file == None:
+    usage()
+    sys.exit(2)
+
+if run_benchmark(report_file, documents, vocabulary, length, seed, repeat, work_directory, baseline_file):
+    sys.exit(1)
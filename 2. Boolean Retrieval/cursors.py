@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+import heapq
+import re
+
+from postings import Bitmap, gallop
+
+# Document-at-a-time evaluation: every operator of a plan is a pull-based cursor over sorted docIds.
+# A cursor starts before its first docId, and
+# - advance(target) moves it to its first docId >= target (it never moves back) and returns it
+# - next() moves it to its next docId and returns it
+# Both return None once the cursor is exhausted; the current docId is kept in the docId attribute.
+
+NONZERO_BYTE = re.compile(b'[^\x00]')
+
+
+# Index of the lowest set bit of a byte
+def lowest_bit(value):
+    return (value & -value).bit_length() - 1
+
+
+class Cursor:
+    def __init__(self):
+        self.docId = -1
+
+    def next(self):
+        if self.docId is None:
+            return None
+        return self.advance(self.docId + 1)
+
+    def advance(self, target):
+        raise NotImplementedError
+
+    def __iter__(self):
+        docId = self.next()
+        while docId is not None:
+            yield docId
+            docId = self.next()
+
+
+class ListCursor(Cursor):
+    def __init__(self, postings):
+        super().__init__()
+        self.postings = postings
+        self.position = 0
+
+    def advance(self, target):
+        if self.docId is None or self.docId >= target:
+            return self.docId
+        self.position = gallop(self.postings, target, self.position)
+        self.docId = self.postings[self.position] if self.position < len(self.postings) else None
+        return self.docId
+
+
+# Set bits are found with a byte lookup in the bitmap, then with a (C level) search of the next non-zero byte
+class BitmapCursor(Cursor):
+    def __init__(self, bitmap):
+        super().__init__()
+        self.data = bitmap.to_bytes()
+
+    def advance(self, target):
+        if self.docId is None or self.docId >= target:
+            return self.docId
+        index = target >> 3
+        if index >= len(self.data):
+            self.docId = None
+            return None
+        value = self.data[index] >> (target & 7)
+        if value:
+            self.docId = target + lowest_bit(value)
+            return self.docId
+        match = NONZERO_BYTE.search(self.data, index + 1)
+        if match is None:
+            self.docId = None
+            return None
+        index = match.start()
+        self.docId = (index << 3) + lowest_bit(self.data[index])
+        return self.docId
+
+
+# Leapfrog intersection: every required cursor is advanced to the candidate docId,
+# and the largest docId found becomes the next candidate until all of them agree.
+# A candidate found in any of the excluded cursors is skipped.
+class AndCursor(Cursor):
+    def __init__(self, required, excluded=()):
+        super().__init__()
+        self.required = required
+        self.excluded = excluded
+
+    def advance(self, target):
+        if self.docId is None or self.docId >= target:
+            return self.docId
+        candidate = target
+        while True:
+            for cursor in self.required:
+                docId = cursor.advance(candidate)
+                if docId is None:
+                    self.docId = None
+                    return None
+                if docId > candidate:
+                    candidate = docId
+                    break
+            else:
+                if any(cursor.advance(candidate) == candidate for cursor in self.excluded):
+                    candidate += 1
+                    continue
+                self.docId = candidate
+                return candidate
+
+
+# Union: the current docId of every operand is kept in a heap, the smallest one is the current docId of the union
+class OrCursor(Cursor):
+    def __init__(self, cursors):
+        super().__init__()
+        self.cursors = cursors
+        self.heap = [(-1, i) for i in range(len(cursors))]
+
+    def advance(self, target):
+        if self.docId is None or self.docId >= target:
+            return self.docId
+        heap = self.heap
+        while heap and heap[0][0] < target:
+            _, i = heap[0]
+            docId = self.cursors[i].advance(target)
+            if docId is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (docId, i))
+        self.docId = heap[0][0] if heap else None
+        return self.docId
+
+
+# Complement: docIds of the universe which the operand cursor doesn't stop at
+class NotCursor(Cursor):
+    def __init__(self, cursor, universe):
+        super().__init__()
+        self.cursor = cursor
+        self.universe = universe
+
+    def advance(self, target):
+        if self.docId is None or self.docId >= target:
+            return self.docId
+        docId = self.universe.advance(target)
+        while docId is not None and self.cursor.advance(docId) == docId:
+            docId = self.universe.advance(docId + 1)
+        self.docId = docId
+        return docId
+
+
+def cursor_of(postings):
+    if isinstance(postings, Bitmap):
+        return BitmapCursor(postings)
+    return ListCursor(postings)
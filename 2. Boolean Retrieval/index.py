@@ -1,173 +1,298 @@
 #!/usr/bin/python3
 import heapq
 import math
+import multiprocessing as mp
 import os
-import pickle
-import shelve
 import shutil
+import struct
+from array import array
 
 import sys
 import getopt
 
-from nltk import word_tokenize, sent_tokenize
-from nltk.stem.porter import PorterStemmer
-import dbm.gnu as gdbm
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.analysis import Analyzer
+from common.segments import (create_segment, delete_documents, merge_dictionaries, register_segment, reset_segments,
+                             run_merges, segment_files, start_background_merge)
+from common.termdict import TermDictionary, TermDictionaryWriter
+from common.token_cache import TokenCache
+from postings import Bitmap, decode_gaps, decode_postings, encode_gaps, encode_postings
+from wildcard import permuterm_path, write_term_index
 
-sys.setrecursionlimit(20000)
+# Default memory budget (in bytes) for the postings accumulated in memory before they are written to a run file
+MEMORY_LIMIT = 4 * 1024 * 1024
 
-# memory limit results in separate 11 index files
-MEMORY_LIMIT = 250000
+# Bytes taken by an empty term entry: the postings array object and its slot in the dictionary
+TERM_OVERHEAD = sys.getsizeof(array('I')) + 16
 
-def usage():
-    print("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file")
-
-
-class Node:
-    def __init__(self, val=None, next=None):
-        self.val = val
-        self.next = next
-        self.skip = None
+# Number of document chunks per worker in a parallel build (smaller chunks balance the load better)
+CHUNKS_PER_WORKER = 4
 
+# Run file record header: term size, postings length, postings size in bytes
+RUN_RECORD = struct.Struct('<HII')
 
-class LinkedList:
-    def __init__(self, head=None):
-        self.head = head
 
-
-def process_words(text):
-    sentences = sent_tokenize(text)
-    words = []
-    for s in sentences:
-        words.extend(word.lower() for word in word_tokenize(s) if word.isalnum())
-    stemmer = PorterStemmer()
-    return map(stemmer.stem, words)
+def usage():
+    options = "[-m memory-limit-bytes] [-w workers] [-t nltk|regex] [-c token-cache-directory]"
+    print("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file " + options)
+    print("       " + sys.argv[0] + " -i directory-of-new-documents -a " + options)
+    print("       " + sys.argv[0] + " -i directory-of-updated-documents -u " + options)
+    print("       " + sys.argv[0] + " -x file-of-deleted-docIds")
+    print("       " + sys.argv[0] + " -M")
 
 
-# All traversed terms
-terms = set()
+# Only alphanumeric tokens are indexed (see common/analysis.py), the tokenizer is chosen with -t.
+# With -c, the terms of the documents are read from (and added to) a token cache (see common/token_cache.py).
+analyzer = Analyzer(alphanumeric=True)
+token_cache = None
 
 
-def create_index(documents_directory_path):
+def process_words(text):
+    if token_cache is not None:
+        return token_cache.analyze(text)
+    return analyzer.analyze(text)
+
+
+# Write the in-memory index to a run file: records sorted by term, each record has a fixed size header
+# followed by the term and its gap encoded postings
+def write_run(inverted_index, run_path):
+    with open(run_path, 'wb') as run_file:
+        for term in sorted(inverted_index):
+            term_bytes = term.encode('utf-8')
+            postings = inverted_index[term]
+            data = encode_gaps(postings)
+            run_file.write(RUN_RECORD.pack(len(term_bytes), len(postings), len(data)))
+            run_file.write(term_bytes)
+            run_file.write(data)
+
+
+# Stream (term, run_number, postings) records of a run file in term order, one record in memory at a time
+def read_run(run_path, run_number):
+    with open(run_path, 'rb') as run_file:
+        while True:
+            header = run_file.read(RUN_RECORD.size)
+            if not header:
+                break
+            term_size, postings_length, data_size = RUN_RECORD.unpack(header)
+            term = run_file.read(term_size).decode('utf-8')
+            postings = decode_gaps(run_file.read(data_size), postings_length)
+            yield term, run_number, postings
+
+
+# Analyze the given documents (in ascending docId order) and write their postings to run files
+# {runs_directory}/{chunk_number}.{count}, starting a new run every time the memory limit is exceeded.
+# Returns the documents analyzed for the token cache (to be saved by the parent of a worker process).
+def index_documents(documents_directory_path, docIds, chunk_number=0, memory_limit=MEMORY_LIMIT,
+                    runs_directory='indexes'):
     count = 1
     inverted_index = dict()
-    os.makedirs('indexes', exist_ok=True)
-    docIds = sorted([int(name) for name in os.listdir(documents_directory_path)], reverse=True)
-    with open('docIds.pickle', 'wb') as handle:
-        pickle.dump(docIds, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    # bytes taken by the accumulated terms and postings
+    memory_used = 0
 
     for docId in docIds:
-        index_size = sys.getsizeof(inverted_index)
-        # SPIMI: disk-based indexing
-        if index_size > MEMORY_LIMIT:
-            Shelf = shelve.Shelf(gdbm.open(f'indexes/{count}', 'c'))
-            Shelf.update(inverted_index)
-            Shelf.close()
-
-            inverted_index.clear()
-            count += 1
-
         f = open(documents_directory_path + '/' + str(docId))
         text = f.read()
         words = process_words(text)
 
         for word in words:
-            terms.add(word)
-            node = Node(val=docId)
             if word in inverted_index:
-                # avoid duplicates by checking smallest value
-                if inverted_index[word].head.val != docId:
-                    node.next = inverted_index[word].head
-                    inverted_index[word].head = node
+                postings = inverted_index[word]
+                # avoid duplicates by checking the last (biggest) value
+                if postings[-1] != docId:
+                    postings.append(docId)
+                    memory_used += postings.itemsize
             else:
-                inverted_index[word] = LinkedList()
-                inverted_index[word].head = node
+                inverted_index[word] = array('I', [docId])
+                memory_used += sys.getsizeof(word) + TERM_OVERHEAD + inverted_index[word].itemsize
         f.close()
 
-    # Write last index
-    Shelf = shelve.Shelf(gdbm.open(f'indexes/{count}', 'c'))
-    Shelf.update(inverted_index)
-    Shelf.close()
-
-
-def n_merge(linked_lists):
-    length = 0
-    res = LinkedList()
-    heap = []
-    for l in linked_lists:
-        heapq.heappush(heap, (l.head.val, l.head.next))
-
-    last = None
-    while heap:
-        minVal, curr = heapq.heappop(heap)
-        if last is None:
-            res.head = Node(minVal)
-            last = res.head
-        else:
-            last.next = Node(minVal)
-            last = last.next
-        length += 1
-        if curr is not None:
-            heapq.heappush(heap, (curr.val, curr.next))
-
-    return res, length
-
-
-def merge_indexes(postings_path, dictionary_path):
-    postings_file = open(postings_path, 'ab')
-    dictionary = {}
-
-    indexes = sorted(os.listdir('indexes'), key=lambda s: int(s))
-    shelves = [shelve.open(f'indexes/{i}') for i in indexes]
-    for term in terms:
-        postings, postings_length = n_merge([s.get(term) for s in shelves if (term in s)])
-
-        pointers_offset = math.floor(math.sqrt(postings_length))
-        node = postings.head
-        count = 0
-        skip_from = node
-
-        while node:
-            if count % pointers_offset == 0 and count < postings_length:
-                if count > 0:
-                    skip_from.skip = node
-                    skip_from = node
-            node = node.next
+        # SPIMI: disk-based indexing
+        if memory_used > memory_limit:
+            write_run(inverted_index, f'{runs_directory}/{chunk_number}.{count}')
+            inverted_index.clear()
+            memory_used = 0
             count += 1
 
-        position = postings_file.tell()
+    # Write last index
+    if inverted_index:
+        write_run(inverted_index, f'{runs_directory}/{chunk_number}.{count}')
+
+    return token_cache.take_added() if token_cache is not None else None
+
+
+# Index the documents into run files, with the auxiliary files of the index written to index_directory.
+# Returns the number of indexed documents.
+def create_index(documents_directory_path, memory_limit=MEMORY_LIMIT, workers=1, index_directory='.'):
+    runs_directory = os.path.join(index_directory, 'indexes')
+    shutil.rmtree(runs_directory, ignore_errors=True)
+    os.makedirs(runs_directory)
+    docIds = sorted([int(name) for name in os.listdir(documents_directory_path)])
+    # all docIds are stored as a bitmap, used by search as the universe for NOT
+    with open(os.path.join(index_directory, 'docIds.bitmap'), 'wb') as handle:
+        handle.write(Bitmap.from_docIds(docIds).to_bytes())
+
+    if workers == 1:
+        added = index_documents(documents_directory_path, docIds, memory_limit=memory_limit,
+                                runs_directory=runs_directory)
+        if token_cache is not None:
+            token_cache.update(added)
+            token_cache.save()
+        return len(docIds)
+
+    # Parallel analysis: contiguous chunks of docIds are indexed by a pool of processes, each chunk into its own
+    # runs, so that the runs of chunk i only contain smaller docIds than the runs of chunk i + 1.
+    # The memory limit is shared by the workers.
+    chunk_size = math.ceil(len(docIds) / (workers * CHUNKS_PER_WORKER))
+    chunks = [docIds[i:i + chunk_size] for i in range(0, len(docIds), chunk_size)]
+    # The workers are forked: they inherit the analyzer and the token cache set by the options, and don't run this
+    # script again as spawned workers would
+    with mp.get_context('fork').Pool(workers) as pool:
+        analyzed = pool.starmap(index_documents, [(documents_directory_path, chunk, chunk_number,
+                                                   memory_limit // workers, runs_directory)
+                                                  for chunk_number, chunk in enumerate(chunks)])
+    if token_cache is not None:
+        for added in analyzed:
+            token_cache.update(added)
+        token_cache.save()
+    return len(docIds)
+
+
+def n_merge(postings_lists):
+    res = list(heapq.merge(*postings_lists))
+    return res, len(res)
+
+
+def merge_indexes(postings_path, dictionary_path, index_directory='.'):
+    postings_file = open(postings_path, 'wb')
+    # postings position, size in bytes and length of every term, written in term order
+    dictionary = TermDictionaryWriter(dictionary_path, 'QII')
+
+    # runs are ordered by chunk number, then by run count within the chunk
+    runs_directory = os.path.join(index_directory, 'indexes')
+    indexes = sorted(os.listdir(runs_directory), key=lambda s: tuple(int(part) for part in s.split('.')))
+    runs = [read_run(f'{runs_directory}/{i}', run_number) for run_number, i in enumerate(indexes)]
+
+    # k-way merge of the runs by term: records of the same term come out consecutively (in run order)
+    term = None
+    term_postings = []
+    for record_term, run_number, postings in heapq.merge(*runs):
+        if record_term != term:
+            if term is not None:
+                write_postings(postings_file, dictionary, term, term_postings)
+            term = record_term
+            term_postings = []
+        term_postings.append(postings)
+    if term is not None:
+        write_postings(postings_file, dictionary, term, term_postings)
+
+    dictionary.close()
+    postings_file.close()
 
-        postings_file.write(pickle.dumps(postings, protocol=pickle.HIGHEST_PROTOCOL))
-        dictionary[term] = (position, postings_length)
+    write_permuterm(dictionary_path, index_directory)
 
-    with open(dictionary_path, 'wb') as handle:
-        pickle.dump(dictionary, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    shutil.rmtree(runs_directory)
+
+
+# Permuterm index of the sorted terms for wildcard queries
+def write_permuterm(dictionary_path, index_directory):
+    terms = TermDictionary(dictionary_path)
+    write_term_index(permuterm_path(index_directory), terms)
+    terms.close()
+
+
+def write_postings(postings_file, dictionary, term, term_postings):
+    postings, postings_length = n_merge(term_postings)
+
+    position = postings_file.tell()
+    data = encode_postings(postings)
+
+    postings_file.write(data)
+    dictionary.add(term, (position, len(data), postings_length))
 
-    handle.close()
-    postings_file.close()
-    for s in shelves:
-        s.close()
 
-    shutil.rmtree('indexes')
+# SEGMENTS
 
+# Merge the postings of a term from several segments (their docIds are disjoint), without the deleted docIds
+def merge_segment_postings(term_postings, deleted):
+    postings, postings_length = n_merge([[docId for docId in decode_postings(data, value[2]) if docId not in deleted]
+                                         for data, value in term_postings])
+    if not postings:
+        return None
+    return encode_postings(postings), (postings_length,)
 
-def build_index(in_dir, out_dict, out_postings):
+
+def read_docIds(directory):
+    with open(os.path.join(directory, 'docIds.bitmap'), 'rb') as handle:
+        return Bitmap.from_bytes(handle.read())
+
+
+# Build the index of the given segment directories in a new segment directory, dropping the deleted docIds
+def merge_segments(directories, directory, deleted):
+    dictionary_path, postings_path = segment_files(directory)
+    merge_dictionaries([segment_files(d) for d in directories], dictionary_path, postings_path, 'QII',
+                       lambda term_postings: merge_segment_postings(term_postings, deleted))
+
+    all_docIds = Bitmap()
+    for d in directories:
+        all_docIds = all_docIds | read_docIds(d)
+    all_docIds = all_docIds - Bitmap.from_docIds(sorted(deleted))
+    with open(os.path.join(directory, 'docIds.bitmap'), 'wb') as handle:
+        handle.write(all_docIds.to_bytes())
+
+    write_permuterm(dictionary_path, directory)
+
+
+def build_index(in_dir, out_dict, out_postings, memory_limit=MEMORY_LIMIT, workers=1):
     """
     build index from documents stored in the input directory,
     then output the dictionary file and postings file
     """
     print('indexing...')
-    create_index(documents_directory_path=in_dir)
+    reset_segments()
+    create_index(documents_directory_path=in_dir, memory_limit=memory_limit, workers=workers)
 
     merge_indexes(dictionary_path=out_dict, postings_path=out_postings)
     print('DONE!')
-    # This is an empty method
-    # Pls implement your code in below
 
 
-input_directory = output_file_dictionary = output_file_postings = None
+def add_documents(in_dir, memory_limit=MEMORY_LIMIT, workers=1):
+    """
+    index the (new) documents stored in the input directory as a new segment, searchable as soon as it is
+    registered, then start merging segments in the background
+    """
+    print('indexing new documents...')
+    name, directory = create_segment()
+    documents = create_index(documents_directory_path=in_dir, memory_limit=memory_limit, workers=workers,
+                             index_directory=directory)
+    dictionary_path, postings_path = segment_files(directory)
+    merge_indexes(dictionary_path=dictionary_path, postings_path=postings_path, index_directory=directory)
+    register_segment(name, documents)
+    start_background_merge(os.path.abspath(__file__), ['-M'])
+    print('DONE!')
+
+
+def delete(docIds):
+    """
+    delete the given docIds from the base index and the segments containing them
+    """
+    print(f'{delete_documents(docIds, read_docIds)} documents deleted')
+
+
+def update_documents(in_dir, memory_limit=MEMORY_LIMIT, workers=1):
+    """
+    replace the documents stored in the input directory: delete their previous versions, then add them
+    """
+    delete([int(name) for name in os.listdir(in_dir)])
+    add_documents(in_dir, memory_limit, workers)
+
+
+input_directory = output_file_dictionary = output_file_postings = deleted_docIds_file = token_cache_directory = None
+memory_limit = MEMORY_LIMIT
+workers = 1
+add = update = merge = False
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:')
+    opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:m:w:t:c:aux:M')
 except getopt.GetoptError:
     usage()
     sys.exit(2)
@@ -179,11 +304,44 @@ for o, a in opts:
         output_file_dictionary = a
     elif o == '-p':  # postings file
         output_file_postings = a
+    elif o == '-m':  # memory limit for the in-memory index, in bytes
+        memory_limit = int(a)
+    elif o == '-w':  # number of worker processes analyzing documents
+        workers = int(a)
+    elif o == '-t':  # tokenizer of the documents
+        analyzer = Analyzer(tokenizer=a, alphanumeric=True)
+    elif o == '-c':  # token cache directory
+        token_cache_directory = a
+    elif o == '-a':  # add the documents as a new segment
+        add = True
+    elif o == '-u':  # replace the documents with their new versions
+        update = True
+    elif o == '-x':  # file of docIds to delete
+        deleted_docIds_file = a
+    elif o == '-M':  # merge segments
+        merge = True
     else:
         assert False, "unhandled option"
 
-if input_directory == None or output_file_postings == None or output_file_dictionary == None:
+if merge:
+    run_merges(merge_segments)
+    sys.exit(0)
+
+if deleted_docIds_file != None:
+    with open(deleted_docIds_file, 'r') as handle:
+        delete([int(docId) for docId in handle.read().split()])
+    sys.exit(0)
+
+if input_directory == None or (not (add or update) and (output_file_postings == None or output_file_dictionary == None)):
     usage()
     sys.exit(2)
 
-build_index(input_directory, output_file_dictionary, output_file_postings)
+if token_cache_directory != None:
+    token_cache = TokenCache(token_cache_directory, analyzer)
+
+if update:
+    update_documents(input_directory, memory_limit, workers)
+elif add:
+    add_documents(input_directory, memory_limit, workers)
+else:
+    build_index(input_directory, output_file_dictionary, output_file_postings, memory_limit, workers)
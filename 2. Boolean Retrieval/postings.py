@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+import math
+from bisect import bisect_left
+from functools import reduce
+
+# Postings lists are kept in memory in one of two containers:
+# - sparse lists are sorted lists of docIds, stored on disk as gaps between consecutive docIds,
+#   each gap compressed with variable byte encoding (7 payload bits per byte, the high bit marks the last byte)
+# - dense lists are bitmaps (bit docId is set), stored on disk as little-endian bytes
+# The container taking fewer bytes on disk is chosen for every list, marked by its first byte.
+
+ARRAY_CONTAINER = 0
+BITMAP_CONTAINER = 1
+
+# docIds of the set bits for every byte value
+BYTE_BITS = [[bit for bit in range(8) if value >> bit & 1] for value in range(256)]
+
+
+class Bitmap:
+    def __init__(self, bits=0):
+        self.bits = bits
+        self.data = None
+        self.length = None
+
+    @classmethod
+    def from_docIds(cls, docIds):
+        if isinstance(docIds, Bitmap):
+            return docIds
+        data = bytearray(docIds[-1] // 8 + 1 if docIds else 0)
+        for docId in docIds:
+            data[docId >> 3] |= 1 << (docId & 7)
+        return cls.from_bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(int.from_bytes(data, 'little'))
+
+    def to_bytes(self):
+        if self.data is None:
+            self.data = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, 'little')
+        return self.data
+
+    def __len__(self):
+        if self.length is None:
+            self.length = bin(self.bits).count('1')
+        return self.length
+
+    def __contains__(self, docId):
+        data = self.to_bytes()
+        index = docId >> 3
+        return index < len(data) and data[index] >> (docId & 7) & 1 == 1
+
+    # Sorted docIds of the set bits
+    def __iter__(self):
+        for index, value in enumerate(self.to_bytes()):
+            if value:
+                base = index << 3
+                for bit in BYTE_BITS[value]:
+                    yield base + bit
+
+    def __and__(self, other):
+        return Bitmap(self.bits & other.bits)
+
+    def __or__(self, other):
+        return Bitmap(self.bits | other.bits)
+
+    def __sub__(self, other):
+        return Bitmap(self.bits & ~other.bits)
+
+
+def encode_gaps(docIds):
+    data = bytearray()
+    previous = 0
+    for docId in docIds:
+        gap = docId - previous
+        previous = docId
+        while gap >= 128:
+            data.append(gap & 127)
+            gap >>= 7
+        data.append(gap | 128)
+    return data
+
+
+def decode_gaps(data, count):
+    docIds = []
+    gap = 0
+    shift = 0
+    previous = 0
+    for byte in data:
+        if byte & 128:
+            previous += gap | ((byte & 127) << shift)
+            docIds.append(previous)
+            if len(docIds) == count:
+                break
+            gap = 0
+            shift = 0
+        else:
+            gap |= byte << shift
+            shift += 7
+    return docIds
+
+
+def encode_postings(docIds):
+    data = encode_gaps(docIds)
+    bitmap_size = docIds[-1] // 8 + 1 if docIds else 0
+    if bitmap_size < len(data):
+        return bytes([BITMAP_CONTAINER]) + Bitmap.from_docIds(docIds).to_bytes()
+    return bytes([ARRAY_CONTAINER]) + data
+
+
+def decode_postings(data, count):
+    if data[0] == BITMAP_CONTAINER:
+        return Bitmap.from_bytes(data[1:])
+    return decode_gaps(memoryview(data)[1:], count)
+
+
+# SEARCH WITHIN POSTINGS LISTS
+
+# Probed lists at least this many times longer than the driving list are searched with galloping,
+# shorter ones are walked with block skips
+GALLOP_RATIO = 8
+
+
+# Exponential (galloping) search: first index >= low with postings[index] >= target
+def gallop(postings, target, low):
+    length = len(postings)
+    if low >= length or postings[low] >= target:
+        return low
+    bound = 1
+    while low + bound < length and postings[low + bound] < target:
+        bound *= 2
+    return bisect_left(postings, target, low + bound // 2 + 1, min(low + bound + 1, length))
+
+
+# Block skip search: jump whole blocks of sqrt(length) entries, then search inside the block
+def block_skip(postings, target, low, block):
+    length = len(postings)
+    while low + block < length and postings[low + block] < target:
+        low += block
+    return bisect_left(postings, target, low, min(low + block + 1, length))
+
+
+# POSTINGS LISTS OPERATIONS
+# Operations on two bitmaps are word-wise bit operations on the whole bitmap,
+# a list combined with a bitmap probes the bitmap bits (AND, AND NOT) or is converted to a bitmap (OR).
+
+# Find difference between 2 postings lists - used in AND NOT optimization
+def linked_list_differece(l1, l2):
+    if isinstance(l1, Bitmap):
+        res = l1 - Bitmap.from_docIds(l2)
+        return res, len(res)
+    if isinstance(l2, Bitmap):
+        res = [docId for docId in l1 if docId not in l2]
+        return res, len(res)
+
+    res = []
+    i = j = 0
+    len1, len2 = len(l1), len(l2)
+    while i < len1 and j < len2:
+        if l1[i] == l2[j]:
+            i += 1
+            j += 1
+        elif l1[i] < l2[j]:
+            res.append(l1[i])
+            i += 1
+        else:
+            j += 1
+    res.extend(l1[i:])
+    return res, len(res)
+
+
+# Find difference between postings list and all docIds bitmap - used in general NOT operation
+def not_difference(postings, all_docIds):
+    return all_docIds - Bitmap.from_docIds(postings)
+
+
+# Merge 2 postings lists with handling duplicates on the flow
+def two_merge(l1, l2):
+    if l1 is None or l2 is None:
+        return None
+    if isinstance(l1, Bitmap) or isinstance(l2, Bitmap):
+        return Bitmap.from_docIds(l1) | Bitmap.from_docIds(l2)
+
+    res = []
+    i = j = 0
+    len1, len2 = len(l1), len(l2)
+    while i < len1 and j < len2:
+        if l1[i] == l2[j]:
+            res.append(l1[i])
+            i += 1
+            j += 1
+        elif l1[i] < l2[j]:
+            res.append(l1[i])
+            i += 1
+        else:
+            res.append(l2[j])
+            j += 1
+    res.extend(l1[i:])
+    res.extend(l2[j:])
+    return res
+
+
+# Intersect any number of postings lists at once and exclude docIds found in any of the excluded lists.
+# The smallest list drives the intersection: each of its docIds is probed in all the other lists,
+# each list keeping its own position and a search method chosen by its size ratio to the driver.
+# Bitmaps are probed by testing the docId bit, when all operands are bitmaps they are simply ANDed.
+def intersect_many(postings_lists, excluded=()):
+    arrays = sorted([p for p in postings_lists if not isinstance(p, Bitmap)], key=len)
+    bitmaps = [p for p in postings_lists if isinstance(p, Bitmap)]
+    excluded_arrays = [p for p in excluded if not isinstance(p, Bitmap)]
+    excluded_bitmaps = [p for p in excluded if isinstance(p, Bitmap)]
+
+    if not arrays:
+        res = reduce(lambda b1, b2: b1 & b2, bitmaps)
+        for postings in excluded:
+            res = res - Bitmap.from_docIds(postings)
+        return res
+
+    driver = arrays[0]
+    if not driver:
+        return []
+
+    probes = []
+    for postings in arrays[1:] + excluded_arrays:
+        if len(postings) >= GALLOP_RATIO * len(driver):
+            probes.append([postings, 0, None])
+        else:
+            probes.append([postings, 0, max(1, math.floor(math.sqrt(len(postings))))])
+    required = len(arrays) - 1
+
+    res = []
+    for docId in driver:
+        matches = True
+        for i, probe in enumerate(probes):
+            postings, position, block = probe
+            if block is None:
+                position = gallop(postings, docId, position)
+            else:
+                position = block_skip(postings, docId, position, block)
+            probe[1] = position
+            found = position < len(postings) and postings[position] == docId
+            if found != (i < required):
+                matches = False
+                if i < required and position == len(postings):
+                    # a required list is exhausted, nothing else can match
+                    return res
+                break
+        if matches and all(docId in b for b in bitmaps) and not any(docId in b for b in excluded_bitmaps):
+            res.append(docId)
+    return res
+
+
+# Intersect 2 postings lists - used in AND operation
+def intersect(l1, l2):
+    if l1 is None or l2 is None:
+        return None
+    res = intersect_many([l1, l2])
+    return res, len(res)
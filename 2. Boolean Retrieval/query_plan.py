@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+from cursors import AndCursor, BitmapCursor, NotCursor, OrCursor, cursor_of
+from postings import intersect_many
+from result_cache import canonical_key
+from wildcard import is_wildcard
+
+# Boolean query planning: the postfix output of parse_query is turned into an expression tree,
+# normalized and compiled into a physical plan ordered by document frequencies.
+#
+# Expression tree nodes:  ('TERM', term), ('NOT', node), ('AND', [nodes]), ('OR', [nodes])
+# (a wildcard term is expanded into an OR of the dictionary terms it matches)
+# Physical plan nodes:    ('EMPTY',), ('TERM', term), ('UNION', [plans]), ('COMPLEMENT', plan),
+#                         ('INTERSECT', [plans], [excluded plans])
+
+operators = {'AND', 'OR', 'NOT'}
+
+
+def build_tree(parsed_query, term_index):
+    stack = []
+    for el in parsed_query:
+        if el == 'NOT':
+            if not stack:
+                raise Exception('Invalid query: NOT without operand')
+            stack.append(('NOT', stack.pop()))
+        elif el in operators:
+            if len(stack) < 2:
+                raise Exception(f'Invalid query: {el} without two operands')
+            node2 = stack.pop()
+            node1 = stack.pop()
+            stack.append((el, [node1, node2]))
+        elif is_wildcard(el):
+            stack.append(('OR', [('TERM', term) for term in term_index.expand(el)]))
+        else:
+            stack.append(('TERM', el))
+    if len(stack) != 1:
+        raise Exception('Invalid query: missing operator')
+    return stack[0]
+
+
+# Push NOTs down to the terms with De Morgan's laws and flatten nested ANDs and ORs
+def normalize(node, negate=False):
+    op = node[0]
+    if op == 'TERM':
+        return ('NOT', node) if negate else node
+    if op == 'NOT':
+        return normalize(node[1], not negate)
+
+    if negate:
+        op = 'OR' if op == 'AND' else 'AND'
+    children = []
+    for child in node[1]:
+        child = normalize(child, negate)
+        if child[0] == op:
+            children.extend(child[1])
+        else:
+            children.append(child)
+    return (op, children)
+
+
+# Estimated number of documents of a plan, exact for terms
+def estimate(plan, dictionary, all_docIds_length):
+    op = plan[0]
+    if op == 'EMPTY':
+        return 0
+    if op == 'TERM':
+        return dictionary[plan[1]][2]
+    if op == 'COMPLEMENT':
+        return all_docIds_length - estimate(plan[1], dictionary, all_docIds_length)
+    if op == 'UNION':
+        return min(all_docIds_length, sum(estimate(p, dictionary, all_docIds_length) for p in plan[1]))
+    return min(estimate(p, dictionary, all_docIds_length) for p in plan[1])
+
+
+# Compile a normalized expression tree into a physical plan:
+# - x AND NOT y becomes an intersection with y excluded, so the complement of y is never computed
+# - NOT x AND NOT y becomes the complement of (x OR y)
+# - x OR NOT y becomes the complement of (y AND NOT x)
+# - operands of intersections and unions are ordered by their (exact for terms) document frequencies
+# - terms missing from the dictionary are removed or make the whole intersection empty
+def compile_plan(node, dictionary, all_docIds_length):
+    op = node[0]
+    if op == 'TERM':
+        return ('TERM', node[1]) if node[1] in dictionary else ('EMPTY',)
+    if op == 'NOT':
+        return ('COMPLEMENT', compile_plan(node[1], dictionary, all_docIds_length))
+
+    by_size = lambda p: estimate(p, dictionary, all_docIds_length)
+    positive = [compile_plan(child, dictionary, all_docIds_length) for child in node[1] if child[0] != 'NOT']
+    negative = [compile_plan(child[1], dictionary, all_docIds_length) for child in node[1] if child[0] == 'NOT']
+
+    if op == 'AND':
+        if any(p[0] == 'EMPTY' for p in positive):
+            return ('EMPTY',)
+        # NOT of a missing term matches every document
+        negative = sorted([p for p in negative if p[0] != 'EMPTY'], key=by_size)
+        if not positive:
+            return ('COMPLEMENT', union_plan(negative, by_size))
+        return ('INTERSECT', sorted(positive, key=by_size), negative)
+
+    if any(p[0] == 'EMPTY' for p in negative):
+        return ('COMPLEMENT', ('EMPTY',))
+    positive = [p for p in positive if p[0] != 'EMPTY']
+    if not negative:
+        return union_plan(positive, by_size)
+    excluded = [union_plan(positive, by_size)] if positive else []
+    return ('COMPLEMENT', ('INTERSECT', sorted(negative, key=by_size), excluded))
+
+
+def union_plan(plans, by_size):
+    if not plans:
+        return ('EMPTY',)
+    if len(plans) == 1:
+        return plans[0]
+    return ('UNION', sorted(plans, key=by_size))
+
+
+def plan_query(parsed_query, dictionary, all_docIds_length, term_index):
+    return compile_plan(normalize(build_tree(parsed_query, term_index)), dictionary, all_docIds_length)
+
+
+# Terms whose postings are needed to execute the plan.
+# With a result cache, subplans with a cached result are not descended into: their results are pinned
+# in the cached dictionary, so that they can't be evicted before the plan is executed.
+def plan_terms(plan, cache=None, cached=None):
+    op = plan[0]
+    if op == 'EMPTY':
+        return set()
+    if cache is not None:
+        key = canonical_key(plan)
+        postings = cache.get(key)
+        if postings is not None:
+            cached[key] = postings
+            return set()
+    if op == 'TERM':
+        return {plan[1]}
+    if op == 'COMPLEMENT':
+        return plan_terms(plan[1], cache, cached)
+    terms = set()
+    for p in plan[1] + (plan[2] if op == 'INTERSECT' else []):
+        terms |= plan_terms(p, cache, cached)
+    return terms
+
+
+# Results of intersections are materialized: they are never larger than their smallest operand, and they are cheap
+# to compute with intersect_many when all the operands are in memory. Materialized results are stored in the cache.
+def is_materialized(plan, cache, cached):
+    if plan[0] in ('EMPTY', 'TERM', 'INTERSECT'):
+        return True
+    return cache is not None and canonical_key(plan) in cached
+
+
+def materialize(plan, term_postings, all_docIds, cache, cached):
+    op = plan[0]
+    if op == 'EMPTY':
+        return []
+    if cache is not None:
+        key = canonical_key(plan)
+        if key in cached:
+            return cached[key]
+
+    if op == 'TERM':
+        res = term_postings[plan[1]]
+    elif all(is_materialized(p, cache, cached) for p in plan[1] + plan[2]):
+        res = intersect_operands(plan, term_postings, all_docIds, cache, cached)
+    else:
+        required = [open_cursor(p, term_postings, all_docIds, cache, cached) for p in plan[1]]
+        excluded = [open_cursor(p, term_postings, all_docIds, cache, cached) for p in plan[2]]
+        res = list(AndCursor(required, excluded))
+
+    if cache is not None:
+        cache.put(key, res)
+    return res
+
+
+def intersect_operands(plan, term_postings, all_docIds, cache, cached):
+    required = []
+    for p in plan[1]:
+        postings = materialize(p, term_postings, all_docIds, cache, cached)
+        if not postings:
+            return []
+        required.append(postings)
+    excluded = [materialize(p, term_postings, all_docIds, cache, cached) for p in plan[2]]
+    return intersect_many(required, excluded)
+
+
+# Open a cursor evaluating a physical plan with the postings of its terms, document at a time.
+# Unions and complements are streamed, so that their (possibly huge) results are never held in memory.
+# With a result cache, the results pinned by plan_terms are reused.
+def open_cursor(plan, term_postings, all_docIds, cache=None, cached=None):
+    if is_materialized(plan, cache, cached):
+        return cursor_of(materialize(plan, term_postings, all_docIds, cache, cached))
+    if plan[0] == 'UNION':
+        return OrCursor([open_cursor(p, term_postings, all_docIds, cache, cached) for p in plan[1]])
+    return NotCursor(open_cursor(plan[1], term_postings, all_docIds, cache, cached), BitmapCursor(all_docIds))
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+import sys
+from collections import OrderedDict
+
+from postings import Bitmap
+
+# Cache of intermediate results shared by the queries of a batch (or of a server session).
+# Results are keyed by the canonical form of their plan node, so that the same subexpression is found
+# whatever the order of its operands in the query, and evicted in least recently used order
+# once the estimated size of all the cached results exceeds the byte budget.
+
+CACHE_LIMIT = 16 * 1024 * 1024  # 16MB
+
+# Estimated bytes taken by every docId of a postings list: the list slot and the int object
+INT_ENTRY_SIZE = 8 + 28
+
+
+# Canonical key of a physical plan node: terms are already stemmed by the parser,
+# operands of intersections and unions are sorted and deduplicated
+def canonical_key(plan):
+    op = plan[0]
+    if op == 'EMPTY' or op == 'TERM':
+        return plan
+    if op == 'COMPLEMENT':
+        return (op, canonical_key(plan[1]))
+    if op == 'UNION':
+        return (op, tuple(sorted(set(canonical_key(p) for p in plan[1]))))
+    return (op, tuple(sorted(set(canonical_key(p) for p in plan[1]))),
+            tuple(sorted(set(canonical_key(p) for p in plan[2]))))
+
+
+def result_size(postings):
+    if isinstance(postings, Bitmap):
+        return sys.getsizeof(postings.bits)
+    # arrays of the numpy backend
+    if hasattr(postings, 'nbytes'):
+        return postings.nbytes
+    return sys.getsizeof(postings) + INT_ENTRY_SIZE * len(postings)
+
+
+class ResultCache:
+    def __init__(self, limit=CACHE_LIMIT):
+        self.limit = limit
+        self.used = 0
+        self.entries = OrderedDict()  # key -> (postings, size)
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, postings):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        size = result_size(postings)
+        if size > self.limit:
+            return
+        self.entries[key] = (postings, size)
+        self.used += size
+        while self.used > self.limit:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.used -= evicted_size
@@ -1,19 +1,42 @@
 #!/usr/bin/python3
-from nltk import word_tokenize, sent_tokenize
-from nltk.stem.porter import PorterStemmer
-import pickle
+from nltk import word_tokenize
+import os
 import sys
 import getopt
+import re
+from functools import partial
+from itertools import islice
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.analysis import TOKENIZERS, Analyzer, stem
+from common.postings_io import SharedPostings, read_postings
+from common.segments import index_segments, index_version, read_deletions
+from common.server import serve_stdin, serve_unix_socket
+from common.termdict import TermDictionary
+from postings import Bitmap, decode_postings
+from cursors import AndCursor, BitmapCursor, ListCursor, OrCursor
+from query_plan import open_cursor, plan_query, plan_terms
+from result_cache import CACHE_LIMIT, ResultCache
+from wildcard import TermIndex, is_wildcard, permuterm_path
 
 
 def usage():
-    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results")
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results"
+                                    " [-t nltk|regex] [-b python|numpy]")
+    print("       " + sys.argv[0] + " -d dictionary-file -p postings-file -s | -u socket-path [-t nltk|regex]"
+                                    " [-b python|numpy]")
 
 
-dictionary_file = postings_file = file_of_queries = output_file_of_results = None
+BACKENDS = ('python', 'numpy')
+
+dictionary_file = postings_file = file_of_queries = file_of_output = socket_path = None
+serve = False
+backend = 'python'
+# Query words are tokenized with the tokenizer of the documents, chosen with -t (see common/analysis.py)
+tokenizer = 'nltk'
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:')
+    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:t:su:b:')
 except getopt.GetoptError:
     usage()
     sys.exit(2)
@@ -27,45 +50,28 @@ for o, a in opts:
         file_of_queries = a
     elif o == '-o':
         file_of_output = a
+    elif o == '-t':  # tokenizer used by index.py
+        tokenizer = a
+    elif o == '-s':  # serve queries from stdin
+        serve = True
+    elif o == '-u':  # serve queries on a Unix socket
+        serve = True
+        socket_path = a
+    elif o == '-b':  # execution backend
+        backend = a
     else:
         assert False, "unhandled option"
 
-if dictionary_file == None or postings_file == None or file_of_queries == None or file_of_output == None:
+if dictionary_file == None or postings_file == None or (not serve and (file_of_queries == None or file_of_output == None)) \
+        or backend not in BACKENDS or tokenizer not in TOKENIZERS:
     usage()
     sys.exit(2)
 
+analyzer = Analyzer(tokenizer=tokenizer, alphanumeric=True)
 
-class Node:
-    def __init__(self, val=None, next=None):
-        self.val = val
-        self.next = next
-        self.skip = None
-
-
-class LinkedList:
-    def __init__(self, head=None):
-        self.head = head
-
-    def __str__(self):
-        if self is None:
-            return ''
-        result_str = ''
-        node = self.head
-        while node:
-            result_str += str(node.val)
-            if node.next:
-                result_str += ' '
-            node = node.next
-        return result_str
-
-
-def process_words(text):
-    sentences = sent_tokenize(text)
-    words = []
-    for s in sentences:
-        words.extend(word.lower() for word in word_tokenize(s) if word.isalnum())
-    stemmer = PorterStemmer()
-    return map(stemmer.stem, words)
+if backend == 'numpy':
+    # NumPy is only needed by the vectorized backend
+    import vectorized
 
 
 operators = {'AND', 'OR', 'NOT'}
@@ -79,11 +85,38 @@ def is_word(token):
     return not is_operator(token) and token != '(' and token != ')'
 
 
+# Wildcard terms are kept whole, the rest of the query is tokenized as usual
+WILDCARD_TOKEN = re.compile(r'([^\s()]*\*[^\s()]*)')
+PARENTHESIS = re.compile(r'([()])')
+
+
+def tokenize_query(query):
+    tokens = []
+    for i, part in enumerate(WILDCARD_TOKEN.split(query)):
+        if i % 2:
+            tokens.append(part)
+        else:
+            tokens.extend(tokenize_words(part))
+    return tokens
+
+
+# The NLTK tokenizer splits the parentheses off, the regex tokenizer only yields alphanumeric tokens: the parentheses
+# are split off first, and the text between them is tokenized as the documents were
+def tokenize_words(text):
+    if tokenizer == 'nltk':
+        return word_tokenize(text)
+    tokens = []
+    for i, piece in enumerate(PARENTHESIS.split(text)):
+        if i % 2:
+            tokens.append(piece)
+        else:
+            tokens.extend(analyzer.tokenize(piece))
+    return tokens
+
+
 # Parse query with Shunting-yard algorithm
 def parse_query(query):
-    tokens = word_tokenize(query)
-    stemmer = PorterStemmer()
-
+    tokens = tokenize_query(query)
     precedence = {
         'OR': 0,
         'AND': 1,
@@ -94,7 +127,8 @@ def parse_query(query):
 
     for token in tokens:
         if is_word(token):
-            processed_token = stemmer.stem(token.lower())
+            # wildcard terms are expanded by the planner
+            processed_token = token if is_wildcard(token) else stem(token.lower())
             output.append(processed_token)
 
         elif token == '(':
@@ -112,10 +146,12 @@ def parse_query(query):
             operator_stack.pop()
 
         elif is_operator(token):
+            # NOT is a prefix operator, so it never pops another NOT waiting for its operand
             while (
                     len(operator_stack) > 0 and
                     operator_stack[-1] != '(' and
-                    precedence[operator_stack[-1]] >= precedence[token]):
+                    precedence[operator_stack[-1]] >= precedence[token] and
+                    token != 'NOT'):
                     output.append(operator_stack.pop())
 
             operator_stack.append(token)
@@ -125,297 +161,156 @@ def parse_query(query):
     return output
 
 
-with open('docIds.pickle', 'rb') as handle:
-    all_docIds = sorted(pickle.load(handle))
-
-all_docIds_length = len(all_docIds)
-
-
-# LINKED LISTS OPERATIONS
-
-# Find difference between 2 linked lists - used in AND NOT optimization
-def linked_list_differece(l1, l2):
-    res = LinkedList()
-    last = None
-    node1 = l1.head
-    node2 = l2.head
-    size = 0
-    while node1 and node2:
-        if node1.val == node2.val:
-            node1 = node1.next
-            node2 = node2.next
-        elif node1.val < node2.val:
-            if last is None:
-                res.head = Node(node1.val)
-                last = res.head
-            else:
-                last.next = Node(node1.val)
-                last = last.next
-            node1 = node1.next
-            size += 1
-        else:
-            node2 = node2.next
-    if node2 is None:
-        last.next = node1
-    return res, size
-
-
-# Find difference between postings linked list and all docIds - used in general NOT operation
-def not_difference(linked_list):
-    res = LinkedList()
-    last = None
-    node = linked_list.head
-    index = 0
-    while node and index < all_docIds_length:
-        if all_docIds[index] == node.val:
-            index += 1
-            node = node.next
-        elif index < all_docIds_length and all_docIds[index] > node.val:
-            node = node.next
-        elif index < all_docIds_length and all_docIds[index] < node.val:
-            if last is None:
-                res.head = Node(all_docIds[index])
-                last = res.head
-            else:
-                last.next = Node(all_docIds[index])
-                last = last.next
-            index += 1
-    if node is None:
-        for el in all_docIds[index:]:
-            last.next = Node(el)
-            last = last.next
-    return res
-
-
-# Merge 2 postings linked lists with handling duplicates on the flow
-def two_merge(l1, l2):
-    if l1 is None or l2 is None:
-        return None
-    res = LinkedList()
-    last = res.head
-    minNode = None
-
-    node1 = l1.head
-    node2 = l2.head
-    while node1 and node2:
-        if node1.val == node2.val:
-            minNode = Node(node1.val)
-            node1 = node1.next
-            node2 = node2.next
-
-        elif node1.val < node2.val:
-            minNode = Node(node1.val)
-            node1 = node1.next
-
-        elif node2.val < node1.val:
-            minNode = Node(node2.val)
-            node2 = node2.next
-
-        if last is None:
-            res.head = minNode
-            last = res.head
-        else:
-            last.next = minNode
-            last = last.next
-    if node1 is None:
-        last.next = node2
-    else:
-        last.next = node1
-    return res
-
-
-# Intersect 2 linked lists - used in AND operation (specifically, intersect_ands)
-def intersect(l1, l2):
-    res = LinkedList()
-    size = 0
-    last = None
-    if l1 is None or l2 is None:
-        return None
-    node1 = l1.head
-    node2 = l2.head
-    while node1 and node2:
-        if node1.val == node2.val:
-            new_node = Node(node1.val)
-            if last is None:
-                res.head = new_node
-                last = res.head
-            else:
-                last.next = new_node
-                last = last.next
-            size += 1
-            node1 = node1.next
-            node2 = node2.next
-        elif node1.val < node2.val:
-            if node1.skip and node1.skip.val < node2.val:
-                while node1.skip and node1.skip.val < node2.val:
-                    node1 = node1.skip
-            else:
-                node1 = node1.next
-        else:
-            if node2.skip and node2.skip.val < node1.val:
-                while node2.skip and node2.skip.val < node1.val:
-                    node2 = node2.skip
-            else:
-                node2 = node2.next
-    return res, size
-
-
-# Intersect accumulated list of AND operands in one flow
-def intersect_ands(ands):
-    r = ands[0][0]
-    size = 0
-    for i in range(1, len(ands)):
-        if ands[i][1] == 'NOT':
-            r, length = linked_list_differece(r, ands[i][0])
-        else:
-            r, length = intersect(r, ands[i][0])
-        size += length
-    return r, size
-
-
-def process_intermediate_query_element(element):
-    p, op, size = element
-    if op == 'AND':
-        postings, size = intersect_ands(p)
-    elif op == 'NOT':
-        postings = not_difference(p)
-        size = all_docIds_length - size
-    else:
-        postings = p
-    payload = (postings, None, size)
-    return payload
+# The base index or a segment (see common/segments.py), with its own universe of docIds for NOT (without its
+# deleted docIds) and a cache of the results of its queries.
+# The numpy backend also keeps the universe as a boolean mask and the deleted docIds as an array.
+class Segment:
+    def __init__(self, dictionary_path, postings_path, directory, cache_limit=CACHE_LIMIT):
+        self.dictionary = TermDictionary(dictionary_path)
+        self.term_index = TermIndex(self.dictionary, permuterm_path(directory))
+        self.postings_file = open(postings_path, 'rb')
+        with open(os.path.join(directory, 'docIds.bitmap'), 'rb') as handle:
+            self.all_docIds = Bitmap.from_bytes(handle.read())
+        self.deleted = Bitmap.from_docIds(sorted(read_deletions(directory)))
+        self.all_docIds = self.all_docIds - self.deleted
+        self.all_docIds_length = len(self.all_docIds)
+        self.cache = ResultCache(cache_limit)
+        if backend == 'numpy':
+            self.universe = vectorized.universe_mask(vectorized.bitmap_array(self.all_docIds))
+            self.deleted_array = vectorized.bitmap_array(self.deleted)
+
+    def close(self):
+        self.postings_file.close()
+        self.term_index.close()
+        self.dictionary.close()
+
+
+# The base index and all the live segments, sharing the cache budget
+def load_index(dictionary_path, postings_path):
+    paths = index_segments(dictionary_path, postings_path)
+    return [Segment(*segment_paths, cache_limit=CACHE_LIMIT // len(paths)) for segment_paths in paths]
+
+
+def close_index(segments):
+    for segment in segments:
+        segment.close()
 
 
-def search(query, dictionary_path, postings_path):
+# Number of docIds formatted and written at once when streaming a result
+OUTPUT_BATCH = 4096
+
+
+# The query is evaluated on every segment, and the results (of disjoint docIds) are merged by a union cursor
+def search(query, segments):
     if not query:
-        return []
-    result = []
+        return ListCursor([])
 
     parsed_query = parse_query(query)
-    with open(dictionary_path, 'rb') as handle:
-        dictionary = pickle.load(handle)
-    postings_file = open(postings_path, 'rb')
-
-    # term_data format for result stack: (postings_linked_list, operation, size)
-    for idx, el in enumerate(parsed_query):
-        if el == 'AND':
-            term_data1 = result.pop()
-            term_data2 = result.pop()
-            # Handling non-existing terms
-            if term_data1 is None or term_data2 is None:
-                result.append(None)
-
-            # Existing terms logic
-            else:
-                ands = []
-                postings1, op1, size1 = term_data1
-                postings2, op2, size2 = term_data2
-
-                # If operand is 'AND' - extend new ands by previous operands
-                if op1 == 'AND':
-                    ands.extend(postings1)
-                # Otherwise, add operand to ands
-                else:
-                    ands.append(term_data1)
-                if op2 == 'AND':
-                    ands.extend(postings2)
-                else:
-                    ands.append(term_data2)
-
-                # sort AND operands according to their sizes
-                ands = sorted(ands, key=lambda x: x[2])
-
-                # For last AND - compute intersection
-                if idx == len(parsed_query) - 1:
-                    postings, size = intersect_ands(ands)
-                    payload = (postings, None, size)
-                    result.append(payload)
-                else:
-                    size = ands[0][2]  # smallest length among all operands
-                    payload = (ands, 'AND', size)
-                    result.append(payload)
-
-        if el == 'OR':
-            term_data1 = result.pop()
-            term_data2 = result.pop()
-            # Handling non-existing terms
-            if term_data1 is None and term_data2 is None:
-                result.append(None)
-
-            elif term_data1 is None:
-                postings, op, size = process_intermediate_query_element(term_data2)
-                payload = (postings, 'OR', size)
-                result.append(payload)
-
-            elif term_data2 is None:
-                postings, op, size = process_intermediate_query_element(term_data1)
-                payload = (postings, 'OR', size)
-                result.append(payload)
-
-            # Existing terms logic
-            else:
-                postings1, op1, size1 = process_intermediate_query_element(term_data1)
-                postings2, op2, size2 = process_intermediate_query_element(term_data2)
-                postings = two_merge(postings1, postings2)
-                # approximate OR size by adding operands lengths
-                payload = (postings, 'OR', size1 + size2)
-                result.append(payload)
-
-        if el == 'NOT':
-            term_data = result.pop()
-            if term_data is None:
-                postings = LinkedList()
-                last = None
-                for docId in all_docIds:
-                    if last is None:
-                        postings.head = Node(docId)
-                        last = postings.head
-                    else:
-                        last.next = Node(docId)
-                        last = last.next
-                result.append((postings, None, all_docIds_length))
-            else:
-                postings, op, size = process_intermediate_query_element(term_data)
-                # For last NOT - compute difference
-                if idx == len(parsed_query) - 1:
-                    postings = not_difference(postings)
-                    size = all_docIds_length - size
-                    payload = (postings, None, size)
-                    result.append(payload)
-                else:
-                    not_postings_length = all_docIds_length - size
-                    payload = (postings, 'NOT', not_postings_length)
-                    result.append(payload)
-
-        if is_word(el):
-            term_data = dictionary.get(el)
-            if term_data is None:
-                result.append(None)
-            else:
-                position, postings_length = term_data
-                postings_file.seek(position)
-                data = postings_file.read()
-                postings = pickle.loads(data)
-                payload = (postings, None, postings_length)
-                result.append(payload)
-    return result[0][0] if result[0] is not None else None
-
-
-def search_and_write(output_path, queries_path, dictionary_path, postings_path):
+    cursors = [search_segment(parsed_query, segment) for segment in segments]
+    return cursors[0] if len(cursors) == 1 else OrCursor(cursors)
+
+
+def search_segment(parsed_query, segment):
+    plan = plan_query(parsed_query, segment.dictionary, segment.all_docIds_length, segment.term_index)
+
+    # Fetch postings of all plan terms at once: only their byte extents, in offset order.
+    # Terms only used by subexpressions with a cached result are not fetched at all.
+    cached = {}
+    extents = term_extents(segment, plan_terms(plan, segment.cache, cached))
+    term_postings = {}
+    for term, data in read_postings(segment.postings_file, extents):
+        term_postings[term] = decode_term(segment, term, data)
+    return evaluate(plan, segment, term_postings, cached)
+
+
+def term_extents(segment, terms):
+    extents = []
+    for term in terms:
+        term_data = segment.dictionary[term]
+        extents.append((term, term_data[0], term_data[1]))
+    return extents
+
+
+def decode_term(segment, term, data):
+    if backend == 'numpy':
+        return vectorized.decode_postings_array(data, segment.dictionary[term][2])
+    return decode_postings(data, segment.dictionary[term][2])
+
+
+# Result cursor of a plan on a segment, with the postings of its terms and the cached results pinned by plan_terms
+def evaluate(plan, segment, term_postings, cached):
+    cache = segment.cache
+    if backend == 'numpy':
+        res = vectorized.execute_plan(plan, term_postings, segment.universe, cache, cached)
+        return ListCursor(vectorized.difference_arrays(res, segment.deleted_array).tolist())
+
+    cursor = open_cursor(plan, term_postings, segment.all_docIds, cache, cached)
+    # deleted docIds are skipped on the result, so that cached results stay valid
+    if len(segment.deleted):
+        return AndCursor([cursor], [BitmapCursor(segment.deleted)])
+    return cursor
+
+
+def format_result(cursor):
+    return ' '.join(map(str, cursor))
+
+
+# Stream the docIds of a result cursor to the output file, a batch at a time
+def write_result(output_file, cursor):
+    docIds = iter(cursor)
+    separator = ''
+    while True:
+        batch = list(islice(docIds, OUTPUT_BATCH))
+        if not batch:
+            break
+        output_file.write(separator + ' '.join(map(str, batch)))
+        separator = ' '
+    output_file.write('\n')
+
+
+# Batch execution of a queries file: all the queries are parsed and planned up front, then the postings lists of
+# all their terms are fetched and decoded once per segment (in offset order) and shared by the queries, every list
+# being dropped when the last query reading it is done. Yields the result cursor of every query.
+def search_batch(queries, segments):
+    parsed_queries = [parse_query(query) if query else None for query in queries]
+    plans = []
+    shared = []
+    for segment in segments:
+        segment_plans = [plan_query(parsed_query, segment.dictionary, segment.all_docIds_length, segment.term_index)
+                         if parsed_query is not None else None for parsed_query in parsed_queries]
+        postings = SharedPostings()
+        postings.load(segment.postings_file,
+                      [term_extents(segment, plan_terms(plan)) if plan is not None else [] for plan in segment_plans],
+                      partial(decode_term, segment))
+        plans.append(segment_plans)
+        shared.append(postings)
+
+    for i in range(len(queries)):
+        if parsed_queries[i] is None:
+            yield ListCursor([])
+            continue
+        cursors = []
+        for segment, segment_plans, postings in zip(segments, plans, shared):
+            # the cached results are pinned as by search_segment, all the terms are fetched anyway
+            cached = {}
+            plan_terms(segment_plans[i], segment.cache, cached)
+            cursors.append(evaluate(segment_plans[i], segment, postings, cached))
+        yield cursors[0] if len(cursors) == 1 else OrCursor(cursors)
+        # the result has been written
+        for segment_plans, postings in zip(plans, shared):
+            postings.release(plan_terms(segment_plans[i]))
+
+
+def search_and_write(output_path, queries_path, segments):
     input_queries_file = open(queries_path, 'r')
     output_file = open(output_path, 'w')
 
     queries = input_queries_file.read().splitlines()
-    result = []
 
-    for q in queries:
-        postings_linked_list = search(q, dictionary_path, postings_path)
-        result_str = ''
-        if postings_linked_list is not None:
-            result_str = str(postings_linked_list)
+    for cursor in search_batch(queries, segments):
+        write_result(output_file, cursor)
+    output_file.close()
 
-        result.append(result_str + '\n')
-    output_file.writelines(result)
 
 def run_search(dict_file, postings_file, queries_file, results_file):
     """
@@ -423,9 +318,36 @@ def run_search(dict_file, postings_file, queries_file, results_file):
     perform searching on the given queries file and output the results to a file
     """
     print('running search on the queries...')
-    search_and_write(queries_path=queries_file, dictionary_path=dict_file, postings_path=postings_file,
-                     output_path=results_file)
+    segments = load_index(dict_file, postings_file)
+    search_and_write(queries_path=queries_file, segments=segments, output_path=results_file)
+    close_index(segments)
     print('DONE!')
 
 
-run_search(dictionary_file, postings_file, file_of_queries, file_of_output)
+def run_server(dict_file, postings_file, socket_path=None):
+    """
+    load the index once and answer queries (one per line) from stdin,
+    or from connections to the given Unix socket.
+    The index is reloaded when segments are added, merged or have documents deleted.
+    """
+    index = {'version': index_version(), 'segments': load_index(dict_file, postings_file)}
+
+    def answer(query):
+        version = index_version()
+        if version != index['version']:
+            close_index(index['segments'])
+            index['version'] = version
+            index['segments'] = load_index(dict_file, postings_file)
+        return format_result(search(query, index['segments']))
+
+    if socket_path is None:
+        serve_stdin(answer)
+    else:
+        serve_unix_socket(socket_path, answer)
+    close_index(index['segments'])
+
+
+if serve:
+    run_server(dictionary_file, postings_file, socket_path)
+else:
+    run_search(dictionary_file, postings_file, file_of_queries, file_of_output)
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+import numpy as np
+
+from postings import BITMAP_CONTAINER, Bitmap
+from result_cache import canonical_key
+
+# Vectorized execution backend (search.py -b numpy): postings lists are decoded into sorted NumPy arrays of docIds,
+# and a physical plan (see query_plan.py) is evaluated operator at a time with array operations instead of
+# per-docId Python loops:
+# - AND: every docId of the smaller array is located in the larger one with a binary search (searchsorted)
+# - OR: the operands are concatenated, then sorted and deduplicated, or set in a boolean mask when they are dense
+# - AND NOT: docIds of the left array found (searchsorted) in the excluded array are masked out
+# - NOT: the operand docIds are cleared in a boolean mask of the universe of docIds
+# Every intermediate result is materialized, which the document-at-a-time cursors of the Python backend avoid for
+# unions and complements, so this backend trades memory for speed on long postings lists.
+
+DOCID = np.int64
+
+EMPTY = np.empty(0, dtype=DOCID)
+
+# A union is computed with a boolean mask (of the largest docId bits) instead of a sort when its operands hold at
+# least one docId for every DENSE_UNION_RATIO docIds
+DENSE_UNION_RATIO = 32
+
+
+# Variable byte gaps decoded with array operations: the bytes of every gap are grouped by their terminating byte
+# (high bit set), their 7 bit payloads shifted into place and summed per group, then the gaps are accumulated
+def decode_gaps_array(data, count):
+    data = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(data & 128)[:count]
+    if not len(ends):
+        return EMPTY
+    data = data[:ends[-1] + 1]
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    group_starts = np.repeat(starts, ends - starts + 1)
+    shifts = (np.arange(len(data)) - group_starts) * 7
+    gaps = np.add.reduceat((data & 127).astype(DOCID) << shifts, starts)
+    return np.cumsum(gaps)
+
+
+def bitmap_array(bitmap):
+    bits = np.unpackbits(np.frombuffer(bitmap.to_bytes(), dtype=np.uint8), bitorder='little')
+    return np.flatnonzero(bits).astype(DOCID)
+
+
+def decode_postings_array(data, count):
+    if data[0] == BITMAP_CONTAINER:
+        return bitmap_array(Bitmap.from_bytes(data[1:]))
+    return decode_gaps_array(memoryview(data)[1:], count)
+
+
+def to_array(postings):
+    if isinstance(postings, Bitmap):
+        return bitmap_array(postings)
+    return np.asarray(postings, dtype=DOCID)
+
+
+# Boolean mask of the docIds of the universe, the complement of an array is taken against it
+def universe_mask(universe):
+    mask = np.zeros(universe[-1] + 1 if len(universe) else 0, dtype=bool)
+    mask[universe] = True
+    return mask
+
+
+# Whether every docId of a is in b
+def member(a, b):
+    if not len(b):
+        return np.zeros(len(a), dtype=bool)
+    positions = np.minimum(np.searchsorted(b, a), len(b) - 1)
+    return b[positions] == a
+
+
+def intersect_arrays(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return a[member(a, b)]
+
+
+def union_arrays(arrays):
+    arrays = [a for a in arrays if len(a)]
+    if not arrays:
+        return EMPTY
+    if len(arrays) == 1:
+        return arrays[0]
+    high = max(a[-1] for a in arrays)
+    if high > DENSE_UNION_RATIO * sum(len(a) for a in arrays):
+        return np.unique(np.concatenate(arrays))
+    mask = np.zeros(high + 1, dtype=bool)
+    for a in arrays:
+        mask[a] = True
+    return np.flatnonzero(mask).astype(DOCID)
+
+
+def difference_arrays(a, b):
+    if not len(a) or not len(b):
+        return a
+    return a[~member(a, b)]
+
+
+def complement_array(a, mask):
+    mask = mask.copy()
+    mask[a[a < len(mask)]] = False
+    return np.flatnonzero(mask).astype(DOCID)
+
+
+# Evaluate a physical plan with the arrays of its terms and the universe mask.
+# Intersections start with their smallest operand (the plan orders them by document frequency) and stop as soon as
+# the result is empty. With a result cache, results are cached as in the Python backend, and the results pinned by
+# plan_terms are reused.
+def execute_plan(plan, term_arrays, universe, cache=None, cached=None):
+    op = plan[0]
+    if op == 'EMPTY':
+        return EMPTY
+    if cache is not None:
+        key = canonical_key(plan)
+        if key in cached:
+            return cached[key]
+
+    if op == 'TERM':
+        res = term_arrays[plan[1]]
+    elif op == 'UNION':
+        res = union_arrays([execute_plan(p, term_arrays, universe, cache, cached) for p in plan[1]])
+    elif op == 'COMPLEMENT':
+        res = complement_array(execute_plan(plan[1], term_arrays, universe, cache, cached), universe)
+    else:
+        res = execute_plan(plan[1][0], term_arrays, universe, cache, cached)
+        for p in plan[1][1:]:
+            if not len(res):
+                break
+            res = intersect_arrays(res, execute_plan(p, term_arrays, universe, cache, cached))
+        for p in plan[2]:
+            if not len(res):
+                break
+            res = difference_arrays(res, execute_plan(p, term_arrays, universe, cache, cached))
+
+    if cache is not None:
+        cache.put(key, res)
+    return res
+
+
+# Vectorized counterparts of the postings lists operations of postings.py, with the same arguments and results
+# (as arrays), used by the differential checks and the timings of benchmark.py
+
+def intersect(l1, l2):
+    res = intersect_arrays(to_array(l1), to_array(l2))
+    return res, len(res)
+
+
+def two_merge(l1, l2):
+    return union_arrays([to_array(l1), to_array(l2)])
+
+
+def linked_list_differece(l1, l2):
+    res = difference_arrays(to_array(l1), to_array(l2))
+    return res, len(res)
+
+
+def not_difference(postings, all_docIds):
+    return complement_array(to_array(postings), universe_mask(to_array(all_docIds)))
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+import getopt
+import os
+import random
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from postings import Bitmap, intersect, linked_list_differece, not_difference, two_merge
+from query_plan import open_cursor, plan_terms
+from result_cache import ResultCache
+import vectorized
+
+# Differential check of the NumPy backend (vectorized.py) against the Python one, on seeded random postings lists:
+# - the postings lists operations (intersect, union, difference, complement) against postings.py, with both
+#   containers (sorted lists and bitmaps)
+# - random physical plans executed by execute_plan against the cursors of query_plan.py, with and without a result
+#   cache
+# The lists are drawn from universes of every size down to a single docId and no docId, with empty lists and lists
+# of the whole universe (whose complement is empty). Mismatches are printed and make the script exit with status 1.
+
+SEED = 3245
+ROUNDS = 200
+
+# Random pairs of postings lists checked for every operation by the check of the lists of an index (benchmark.py)
+CHECKED_PAIRS = 200
+
+# Largest universe of the random lists, and the universes always checked: no docId, a single docId (0 or not)
+UNIVERSE_SIZE = 2000
+EDGE_UNIVERSES = ([], [0], [7])
+
+# Terms of the random plans, and the depth of their trees
+PLAN_TERMS = 6
+PLAN_DEPTH = 3
+PLANS_PER_ROUND = 5
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " [-s seed] [-n rounds]")
+
+
+def as_docIds(result):
+    if isinstance(result, tuple):
+        result = result[0]
+    return result.tolist() if hasattr(result, 'tolist') else list(result)
+
+
+# Differential check of the vectorized postings lists operations: every operation on random pairs of postings lists
+# (both containers, all frequencies) and on the lists of the most frequent terms must give the same docIds with both
+# backends. Returns the descriptions of the mismatches.
+def check_operations(postings, all_docIds, seed):
+    rng = random.Random(seed)
+    pairs = [(0, 1), (1, 0), (0, len(postings) - 1)] + [(rng.randrange(len(postings)), rng.randrange(len(postings)))
+                                                       for _ in range(CHECKED_PAIRS)]
+    operations = [(intersect, vectorized.intersect), (two_merge, vectorized.two_merge),
+                  (linked_list_differece, vectorized.linked_list_differece)]
+    mismatches = []
+    for i, j in pairs:
+        for operation, vectorized_operation in operations:
+            if as_docIds(operation(postings[i], postings[j])) != as_docIds(vectorized_operation(postings[i],
+                                                                                                  postings[j])):
+                mismatches.append(f'{operation.__name__} of lists {i} and {j}')
+        l1 = list(postings[i]) if isinstance(postings[i], Bitmap) else postings[i]
+        if as_docIds(not_difference(l1, all_docIds)) != as_docIds(vectorized.not_difference(l1, all_docIds)):
+            mismatches.append(f'not_difference of list {i}')
+    return mismatches
+
+
+# A random universe of docIds (not contiguous, as in a real collection)
+def random_universe(rng):
+    size = rng.choice((1, 2, 10, 100, UNIVERSE_SIZE))
+    return sorted(rng.sample(range(3 * size), size))
+
+
+# Random postings lists of a universe: empty, the whole universe and sublists of every density, each as a sorted
+# list and as a bitmap
+def random_lists(rng, universe):
+    lists = [[], list(universe)]
+    for density in (0.001, 0.05, 0.5, 0.95):
+        lists.append([docId for docId in universe if rng.random() < density])
+    return lists + [Bitmap.from_docIds(docIds) for docIds in lists]
+
+
+# Random physical plan (see query_plan.py) over the given terms
+def random_plan(rng, terms, depth):
+    if depth == 0 or rng.random() < 0.25:
+        return ('EMPTY',) if rng.random() < 0.05 else ('TERM', rng.choice(terms))
+    op = rng.choice(('INTERSECT', 'UNION', 'COMPLEMENT'))
+    if op == 'COMPLEMENT':
+        return ('COMPLEMENT', random_plan(rng, terms, depth - 1))
+    operands = [random_plan(rng, terms, depth - 1) for _ in range(rng.randint(2, 3))]
+    if op == 'UNION':
+        return ('UNION', operands)
+    return ('INTERSECT', operands, [random_plan(rng, terms, depth - 1) for _ in range(rng.randint(0, 2))])
+
+
+# The results of a plan with the cursors and with execute_plan, without a cache and with a cache (run twice, so
+# that the second run reuses the cached results)
+def plan_results(plan, term_postings, universe):
+    all_docIds = Bitmap.from_docIds(universe)
+    term_arrays = {term: vectorized.to_array(postings) for term, postings in term_postings.items()}
+    universe_mask = vectorized.universe_mask(vectorized.to_array(universe))
+    results = [(list(open_cursor(plan, term_postings, all_docIds)),
+                as_docIds(vectorized.execute_plan(plan, term_arrays, universe_mask)))]
+
+    cache = ResultCache()
+    vectorized_cache = ResultCache()
+    for _ in range(2):
+        cached = {}
+        plan_terms(plan, cache, cached)
+        vectorized_cached = {}
+        plan_terms(plan, vectorized_cache, vectorized_cached)
+        results.append((list(open_cursor(plan, term_postings, all_docIds, cache, cached)),
+                        as_docIds(vectorized.execute_plan(plan, term_arrays, universe_mask, vectorized_cache,
+                                                          vectorized_cached))))
+    return results
+
+
+def check_universe(rng, universe, description):
+    mismatches = []
+    lists = random_lists(rng, universe)
+    all_docIds = Bitmap.from_docIds(universe)
+    for i, l1 in enumerate(lists):
+        for j, l2 in enumerate(lists):
+            for operation, vectorized_operation in ((intersect, vectorized.intersect),
+                                                    (two_merge, vectorized.two_merge),
+                                                    (linked_list_differece, vectorized.linked_list_differece)):
+                if as_docIds(operation(l1, l2)) != as_docIds(vectorized_operation(l1, l2)):
+                    mismatches.append(f'{operation.__name__} of lists {i} and {j} ({description})')
+        docIds = as_docIds(l1)
+        if as_docIds(not_difference(docIds, all_docIds)) != as_docIds(vectorized.not_difference(docIds, all_docIds)):
+            mismatches.append(f'not_difference of list {i} ({description})')
+
+    terms = [f't{i}' for i in range(PLAN_TERMS)]
+    for _ in range(PLANS_PER_ROUND):
+        term_postings = {term: rng.choice(lists) for term in terms}
+        plan = random_plan(rng, terms, PLAN_DEPTH)
+        for expected, result in plan_results(plan, term_postings, universe):
+            if expected != result:
+                mismatches.append(f'execute_plan of {plan} ({description})')
+                break
+    return mismatches
+
+
+def run_checks(seed, rounds):
+    """
+    check the vectorized operations and plans against the Python ones on the edge universes, then on random
+    universes for the given number of rounds.
+    Returns the descriptions of the mismatches.
+    """
+    rng = random.Random(seed)
+    mismatches = []
+    for universe in EDGE_UNIVERSES:
+        mismatches.extend(check_universe(rng, universe, f'universe {universe}'))
+    for round_number in range(rounds):
+        universe = random_universe(rng)
+        mismatches.extend(check_universe(rng, universe, f'round {round_number}, {len(universe)} docIds'))
+    return mismatches
+
+
+if __name__ == '__main__':
+    seed = SEED
+    rounds = ROUNDS
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 's:n:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-s':  # random seed of the lists and plans
+            seed = int(a)
+        elif o == '-n':  # number of random universes
+            rounds = int(a)
+        else:
+            assert False, "unhandled option"
+
+    mismatches = run_checks(seed, rounds)
+    for mismatch in mismatches:
+        print(f'backends differ: {mismatch}')
+    if mismatches:
+        sys.exit(1)
+    print('DONE!')
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+import os
+import re
+
+from common.termdict import TermDictionary, TermDictionaryWriter
+
+# Wildcard terms (foo*, *bar, f*o) are expanded to the dictionary terms they match with:
+# - the sorted term dictionary, searched with binary search for prefix patterns (foo*)
+# - a permuterm index for all other patterns: every rotation of term + '$' points to its term (by its ordinal),
+#   so a pattern X*Y is looked up as the prefix Y$X of the sorted rotations (and X*Y*Z as Z$X, then filtered).
+#   It is stored as a term dictionary (see common/termdict.py) of the rotations, whose values are the ordinals.
+# Patterns are matched against the terms as they are stored in the dictionary (stemmed), they are only lowercased.
+
+WILDCARD = '*'
+END_MARK = '$'
+
+PERMUTERM_FILE = 'permuterm.txt'
+
+
+def permuterm_path(index_directory):
+    return os.path.join(index_directory, PERMUTERM_FILE)
+
+
+def is_wildcard(token):
+    return WILDCARD in token
+
+
+def rotations(term):
+    marked = term + END_MARK
+    return [marked[i:] + marked[:i] for i in range(len(marked))]
+
+
+# Sorted rotations of all the (sorted) terms and the ordinal of the term of every rotation. A rotation has a single
+# END_MARK, so it is the rotation of a single term.
+def build_permuterm(terms):
+    return sorted((rotation, ordinal) for ordinal, term in enumerate(terms) for rotation in rotations(term))
+
+
+def write_term_index(term_index_path, terms):
+    permuterm = TermDictionaryWriter(term_index_path, 'I')
+    for rotation, ordinal in build_permuterm(terms):
+        permuterm.add(rotation, (ordinal,))
+    permuterm.close()
+
+
+# Smallest string greater than all the strings starting with the (non-empty) prefix
+def next_prefix(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+# Range [low, high) of the ordinals of the terms of a term dictionary starting with the prefix
+def prefix_range(dictionary, prefix):
+    low = dictionary.bisect(prefix)
+    if not prefix:
+        return low, len(dictionary)
+    return low, dictionary.bisect(next_prefix(prefix))
+
+
+# The permuterm index is only opened by the first pattern needing it, so opening an index and the queries without
+# wildcards (or with prefix patterns only) don't read it
+class TermIndex:
+    def __init__(self, dictionary, term_index_path):
+        self.dictionary = dictionary
+        self.term_index_path = term_index_path
+        self.opened = None
+
+    @property
+    def permuterm(self):
+        if self.opened is None:
+            self.opened = TermDictionary(self.term_index_path)
+        return self.opened
+
+    def close(self):
+        if self.opened is not None:
+            self.opened.close()
+            self.opened = None
+
+    # Sorted dictionary terms matching the wildcard pattern
+    def expand(self, pattern):
+        pattern = pattern.lower()
+        parts = pattern.split(WILDCARD)
+        first, last = parts[0], parts[-1]
+
+        if len(parts) == 2 and not last:
+            return list(self.dictionary.terms(*prefix_range(self.dictionary, first)))
+
+        ordinals = set(ordinal for _, (ordinal,) in self.permuterm.items(*prefix_range(self.permuterm,
+                                                                                          last + END_MARK + first)))
+        matches = [self.dictionary.term_at(ordinal) for ordinal in sorted(ordinals)]
+        if len(parts) > 2:
+            # the middle parts are only checked on the candidates matching the outer parts
+            regex = re.compile('.*'.join(map(re.escape, parts)), re.DOTALL)
+            matches = [term for term in matches if regex.fullmatch(term)]
+        return matches
@@ -1,50 +1,61 @@
 #!/usr/bin/python3
+import heapq
 import math
+import multiprocessing as mp
 import os
-import pickle
 import sys
 import getopt
 
-from nltk import word_tokenize, sent_tokenize
-from nltk.stem.porter import PorterStemmer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.analysis import Analyzer
+from common.doctable import open_table, table_path, write_table
+from common.segments import (create_segment, delete_documents, merge_dictionaries, register_segment, reset_segments,
+                             run_merges, segment_files, start_background_merge)
+from common.termdict import TermDictionary, TermDictionaryWriter
+from common.token_cache import TokenCache
+from postings import WEIGHT_TYPES, decode_frequencies, decode_header, document_weight, encode_postings
 
-sys.setrecursionlimit(20000)
+# Dictionary values: position and size of the postings, largest document weight of the term (see search.py) and
+# offset of the champion list of the term in its postings (0 without a champion list)
+DICTIONARY_FORMAT = 'QIdI'
 
-
-def usage():
-    print("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file")
+# Number of document chunks per worker in a parallel build (smaller chunks balance the load better)
+CHUNKS_PER_WORKER = 4
 
 
-class Node:
-    def __init__(self, docId=None, next=None, termFrequency=1):
-        self.docId = docId
-        self.termFrequency = termFrequency
-        self.next = next
+def usage():
+    options = "[-w workers] [-t nltk|regex] [-c token-cache-directory] [-q 8|16] [-m] [-r champions]"
+    print("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file " + options)
+    print("       " + sys.argv[0] + " -i directory-of-new-documents -a " + options)
+    print("       " + sys.argv[0] + " -i directory-of-updated-documents -u " + options)
+    print("       " + sys.argv[0] + " -x file-of-deleted-docIds")
+    print("       " + sys.argv[0] + " -M [-r champions]")
 
 
-class LinkedList:
-    def __init__(self, head=None):
-        self.head = head
+# The tokenizer (see common/analysis.py) is chosen with -t, search must use the same one.
+# With -c, the terms of the documents are read from (and added to) a token cache (see common/token_cache.py).
+analyzer = Analyzer()
+token_cache = None
+# With -m, a term-document matrix is written with every index (see matrix.py)
+term_document_matrix = False
+# With -r, the terms with more postings get a champion list of their r best documents (see encode_tiered_postings),
+# to be given to every add, update and merge of the index
+champions = 0
 
 
 def process_words(text):
-    sentences = sent_tokenize(text)
-    words = []
-    for s in sentences:
-        words.extend(word.lower() for word in word_tokenize(s))
-    stemmer = PorterStemmer()
-    return map(stemmer.stem, words)
+    if token_cache is not None:
+        return token_cache.analyze(text)
+    return analyzer.analyze(text)
 
 
-def create_index(documents_directory_path, postings_path, dictionary_path):
-    inverted_index = dict()
-    docIds = sorted([int(name) for name in os.listdir(documents_directory_path)], reverse=True)
-
-    with open('docIds.pickle', 'wb') as handle:
-        pickle.dump(docIds, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-    terms = set()
+# Analyze the given documents and return their partial index: (docId, termFrequency) postings of every term
+# in the order of the given docIds, the vector length and the (largest, average) term frequencies of every document,
+# and the documents analyzed for the token cache (to be saved by the parent of a worker process)
+def index_documents(documents_directory_path, docIds):
+    segment = dict()
     doc_lengths = dict()
+    doc_frequencies = dict()
     for docId in docIds:
         f = open(documents_directory_path + '/' + str(docId))
         text = f.read()
@@ -56,65 +67,220 @@ def create_index(documents_directory_path, postings_path, dictionary_path):
                 term_frequencies[word] += 1
             else:
                 term_frequencies[word] = 1
-
-            terms.add(word)
-            node = Node(docId=docId, termFrequency=1)
-
-            if word in inverted_index:
-                # Get postings list for the existing term in the index
-                postings_list = inverted_index[word][1]
-                # New term for the current document
-                if postings_list.head.docId != docId:
-                    # new document, so increment docFrequency
-                    inverted_index[word][0] += 1
-                    # add new node to postings_list
-                    node.next = inverted_index[word][1].head
-                    inverted_index[word][1].head = node
-                # Repeating term for this document (increment termFrequency)
-                else:
-                    inverted_index[word][1].head.termFrequency += 1
-
-            # New term for the index: docFrequency=1
-            else:
-                inverted_index[word] = [1, LinkedList(head=node)]
+        f.close()
 
         doc_length = 0
         for term, frequency in term_frequencies.items():
+            if term in segment:
+                segment[term].append((docId, frequency))
+            else:
+                segment[term] = [(docId, frequency)]
+
             tf = 1 + math.log10(frequency)
             doc_length += math.pow(tf, 2)
 
         doc_lengths[docId] = math.sqrt(doc_length)
+        doc_frequencies[docId] = (max(term_frequencies.values(), default=0),
+                                  len(words) / len(term_frequencies) if term_frequencies else 0.0)
+
+    return segment, doc_lengths, doc_frequencies, token_cache.take_added() if token_cache is not None else None
+
+
+# Write the document table of an index (see common/doctable.py): docId, vector length, largest and average term
+# frequency of every document, in docId order
+def write_documents(index_directory, docIds, doc_lengths, doc_frequencies):
+    write_table(table_path(index_directory), [
+        ('docId', 'q', docIds),
+        ('length', 'd', [doc_lengths[docId] for docId in docIds]),
+        ('max_tf', 'I', [doc_frequencies[docId][0] for docId in docIds]),
+        ('avg_tf', 'd', [doc_frequencies[docId][1] for docId in docIds]),
+    ])
+
+
+# Index the documents, with the auxiliary files of the index written to index_directory and the document weights
+# stored with the given bits (see postings.py).
+# Returns the number of indexed documents.
+def create_index(documents_directory_path, postings_path, dictionary_path, workers=1, index_directory='.', bits=64):
+    docIds = sorted([int(name) for name in os.listdir(documents_directory_path)])
+
+    if workers == 1:
+        segments = [index_documents(documents_directory_path, docIds)]
+    else:
+        # Parallel analysis: contiguous chunks of docIds are analyzed by a pool of processes
+        chunk_size = math.ceil(len(docIds) / (workers * CHUNKS_PER_WORKER))
+        chunks = [docIds[i:i + chunk_size] for i in range(0, len(docIds), chunk_size)]
+        # The workers are forked: they inherit the analyzer and the token cache set by the options, and don't run
+        # this script again as spawned workers would
+        with mp.get_context('fork').Pool(workers) as pool:
+            segments = pool.starmap(index_documents, [(documents_directory_path, chunk) for chunk in chunks])
+
+    # Merge partial indexes in chunk order, so that postings keep the order of docIds
+    inverted_index = dict()
+    doc_lengths = dict()
+    doc_frequencies = dict()
+    for segment, segment_doc_lengths, segment_doc_frequencies, added in segments:
+        if token_cache is not None:
+            token_cache.update(added)
+        doc_lengths.update(segment_doc_lengths)
+        doc_frequencies.update(segment_doc_frequencies)
+        for term, postings in segment.items():
+            if term in inverted_index:
+                inverted_index[term].extend(postings)
+            else:
+                inverted_index[term] = postings
+    if token_cache is not None:
+        token_cache.save()
 
     # clear existing postings file
     open(postings_path, 'w').close()
 
-    # Write postings, dictionary, doc_lengths
+    # Write postings, dictionary, document table
     postings_file = open(postings_path, 'ab')
-    dictionary = {}
-    for term in terms:
-        payload = inverted_index[term]
+    dictionary = TermDictionaryWriter(dictionary_path, DICTIONARY_FORMAT)
+    for term in sorted(inverted_index):
+        data, values = encode_tiered_postings(inverted_index[term], doc_lengths, bits)
+
         position = postings_file.tell()
+        postings_file.write(data)
+        dictionary.add(term, (position, len(data)) + values)
+
+    postings_file.close()
+    dictionary.close()
+
+    write_documents(index_directory, docIds, doc_lengths, doc_frequencies)
+
+    if term_document_matrix:
+        write_term_document_matrix(index_directory, dictionary_path, postings_path, docIds)
+    elif has_term_document_matrix(index_directory):
+        # the matrix of a previous build
+        import matrix
+        matrix.remove_matrix(index_directory)
+
+    return len(docIds)
+
 
-        postings_file.write(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
-        dictionary[term] = position
+# The term-document matrix of an index, built from its dictionary and postings (NumPy is only needed by the matrices)
+def write_term_document_matrix(index_directory, dictionary_path, postings_path, docIds):
+    import matrix
+    dictionary = TermDictionary(dictionary_path)
+    matrix.write_matrix(index_directory, dictionary, postings_path, docIds)
+    dictionary.close()
 
-    with open(dictionary_path, 'wb') as dictionary_handle:
-        pickle.dump(dictionary, dictionary_handle, protocol=pickle.HIGHEST_PROTOCOL)
 
-    with open('docLengths.pickle', 'wb') as doc_lengths_handle:
-        pickle.dump(doc_lengths, doc_lengths_handle, protocol=pickle.HIGHEST_PROTOCOL)
+def has_term_document_matrix(index_directory):
+    return os.path.isdir(os.path.join(index_directory, 'matrix'))
 
 
-def build_index(in_dir, out_dict, out_postings):
+# Postings of (docId, termFrequency) in ascending docId order, with the precomputed document weights,
+# and the largest (stored) document weight
+def encode_term_postings(postings, doc_lengths, bits):
+    docIds = [docId for docId, _ in postings]
+    term_frequencies = [term_frequency for _, term_frequency in postings]
+    weights = [document_weight(term_frequency, doc_lengths[docId]) for docId, term_frequency in postings]
+    return encode_postings(docIds, term_frequencies, weights, bits)
+
+
+# Tiered postings of a term for the approximate search (search.py -a): the postings of a term with more than
+# `champions` documents are followed by its champion list, the postings of its `champions` highest weighted documents
+# (the high tier, ties broken by the largest docIds as the rankings of search.py do) in docId order. The champion list
+# holds the largest weight, so its quantized weights have the scale of the postings and are the same. Returns the data
+# and the dictionary values after the position and the size: the largest weight and the offset of the champion list
+# (0 without one).
+def encode_tiered_postings(postings, doc_lengths, bits):
+    data, max_weight = encode_term_postings(postings, doc_lengths, bits)
+    if not champions or len(postings) <= champions:
+        return data, (max_weight, 0)
+
+    weights = [document_weight(term_frequency, doc_lengths[docId]) for docId, term_frequency in postings]
+    best = heapq.nlargest(champions, range(len(postings)), key=lambda i: (weights[i], postings[i][0]))
+    champion_data, _ = encode_term_postings([postings[i] for i in sorted(best)], doc_lengths, bits)
+    return data + champion_data, (max_weight, len(data))
+
+
+# SEGMENTS
+
+# Merge the postings of a term from several segments (their docIds are disjoint), without the deleted docIds.
+# The document weights are recomputed from the term frequencies, with the weight bits of the merged postings.
+def merge_segment_postings(term_postings, deleted, doc_lengths):
+    postings = []
+    for data, _ in term_postings:
+        postings.extend(posting for posting in zip(*decode_frequencies(data)) if posting[0] not in deleted)
+    if not postings:
+        return None
+    postings.sort()
+    _, bits, _ = decode_header(term_postings[0][0])
+    return encode_tiered_postings(postings, doc_lengths, bits)
+
+
+def read_docIds(directory):
+    with open_table(directory) as table:
+        return set(table.docIds)
+
+
+# Build the index of the given segment directories in a new segment directory, dropping the deleted docIds
+def merge_segments(directories, directory, deleted):
+    docIds = []
+    doc_lengths = dict()
+    doc_frequencies = dict()
+    for d in directories:
+        with open_table(d) as table:
+            for docId, length, max_tf, avg_tf in zip(table.docIds, table.column('length'), table.column('max_tf'),
+                                                     table.column('avg_tf')):
+                if docId not in deleted:
+                    docIds.append(docId)
+                    doc_lengths[docId] = length
+                    doc_frequencies[docId] = (max_tf, avg_tf)
+    docIds.sort()
+
+    dictionary_path, postings_path = segment_files(directory)
+    merge_dictionaries([segment_files(d) for d in directories], dictionary_path, postings_path, DICTIONARY_FORMAT,
+                       lambda term_postings: merge_segment_postings(term_postings, deleted, doc_lengths))
+
+    write_documents(directory, docIds, doc_lengths, doc_frequencies)
+
+    # the merged segment has a matrix if all the merged segments have one
+    if all(has_term_document_matrix(d) for d in directories):
+        write_term_document_matrix(directory, dictionary_path, postings_path, docIds)
+
+
+def build_index(in_dir, out_dict, out_postings, workers=1, bits=64):
     print('indexing...')
-    create_index(documents_directory_path=in_dir, dictionary_path=out_dict, postings_path=out_postings)
+    reset_segments()
+    create_index(documents_directory_path=in_dir, dictionary_path=out_dict, postings_path=out_postings,
+                 workers=workers, bits=bits)
     print('DONE!')
 
 
-input_directory = output_file_dictionary = output_file_postings = None
+# Index the (new) documents of the input directory as a new segment, then merge segments in the background
+def add_documents(in_dir, workers=1, bits=64):
+    print('indexing new documents...')
+    name, directory = create_segment()
+    dictionary_path, postings_path = segment_files(directory)
+    documents = create_index(documents_directory_path=in_dir, dictionary_path=dictionary_path,
+                             postings_path=postings_path, workers=workers, index_directory=directory, bits=bits)
+    register_segment(name, documents)
+    start_background_merge(os.path.abspath(__file__), ['-M'] + (['-r', str(champions)] if champions else []))
+    print('DONE!')
+
+
+# Delete the docIds from the base index and the segments containing them
+def delete(docIds):
+    print(f'{delete_documents(docIds, read_docIds)} documents deleted')
+
+
+# Replace the documents of the input directory: delete their previous versions, then add them
+def update_documents(in_dir, workers=1, bits=64):
+    delete([int(name) for name in os.listdir(in_dir)])
+    add_documents(in_dir, workers, bits)
+
+
+input_directory = output_file_dictionary = output_file_postings = deleted_docIds_file = token_cache_directory = None
+workers = 1
+bits = 64
+add = update = merge = False
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:')
+    opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:w:t:c:q:aux:Mmr:')
 except getopt.GetoptError:
     usage()
     sys.exit(2)
@@ -126,11 +292,49 @@ for o, a in opts:
         output_file_dictionary = a
     elif o == '-p':  # postings file
         output_file_postings = a
+    elif o == '-w':  # number of worker processes analyzing documents
+        workers = int(a)
+    elif o == '-t':  # tokenizer of the documents
+        analyzer = Analyzer(tokenizer=a)
+    elif o == '-c':  # token cache directory
+        token_cache_directory = a
+    elif o == '-q':  # bits of the quantized document weights
+        bits = int(a)
+    elif o == '-a':  # add the documents as a new segment
+        add = True
+    elif o == '-u':  # replace the documents with their new versions
+        update = True
+    elif o == '-x':  # file of docIds to delete
+        deleted_docIds_file = a
+    elif o == '-M':  # merge segments
+        merge = True
+    elif o == '-m':  # write term-document matrices
+        term_document_matrix = True
+    elif o == '-r':  # size of the champion lists
+        champions = int(a)
     else:
         assert False, "unhandled option"
 
-if input_directory == None or output_file_postings == None or output_file_dictionary == None:
+if merge:
+    run_merges(merge_segments)
+    sys.exit(0)
+
+if deleted_docIds_file != None:
+    with open(deleted_docIds_file, 'r') as handle:
+        delete([int(docId) for docId in handle.read().split()])
+    sys.exit(0)
+
+if input_directory == None or (not (add or update) and (output_file_postings == None or output_file_dictionary == None)) \
+        or bits not in WEIGHT_TYPES or champions < 0:
     usage()
     sys.exit(2)
 
-build_index(input_directory, output_file_dictionary, output_file_postings)
+if token_cache_directory != None:
+    token_cache = TokenCache(token_cache_directory, analyzer)
+
+if update:
+    update_documents(input_directory, workers, bits)
+elif add:
+    add_documents(input_directory, workers, bits)
+else:
+    build_index(input_directory, output_file_dictionary, output_file_postings, workers, bits)
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+import os
+import shutil
+
+import numpy as np
+
+from common.dense import top_documents
+from postings import decode_postings
+
+# Term-document weight matrix of an index (index.py -m), to score whole batches of queries with matrix products
+# (search.py -m) instead of one query at a time.
+#
+# The matrix is stored by term, in the CSC layout of the document-term matrix: the column of a term (its ordinal in
+# the term dictionary) holds the ordinals of its documents (their ranks in the sorted docIds of the index) and their
+# stored weights, which are multiplied by the scale of the column (see postings.py). Every array is a NumPy file,
+# memory-mapped by search:
+# - indptr.npy: start of every column in ordinals.npy and weights.npy, then their length
+# - ordinals.npy, weights.npy: document ordinals and stored weights of all the columns
+# - scales.npy: scale of every column
+# - docIds.npy: docId of every document ordinal, written last
+
+MATRIX_DIRECTORY = 'matrix'
+
+ORDINAL = np.int32
+
+# Memory budget of the dense scores of a block of queries (8 bytes of score and 1 byte of mask per document)
+SCORE_BLOCK_BYTES = 1 << 26
+
+
+def matrix_directory(index_directory):
+    return os.path.join(index_directory, MATRIX_DIRECTORY)
+
+
+def has_matrix(index_directory):
+    return os.path.exists(os.path.join(matrix_directory(index_directory), 'docIds.npy'))
+
+
+def remove_matrix(index_directory):
+    shutil.rmtree(matrix_directory(index_directory), ignore_errors=True)
+
+
+# Write the matrix of an index from its dictionary (TermDictionary), postings file and sorted docIds
+def write_matrix(index_directory, dictionary, postings_path, docIds):
+    remove_matrix(index_directory)
+    directory = matrix_directory(index_directory)
+    os.makedirs(directory)
+
+    docIds = np.asarray(docIds, dtype=np.int64)
+    indptr = [0]
+    ordinals = []
+    weights = []
+    scales = []
+    with open(postings_path, 'rb') as postings_file:
+        for _, (position, size, _, champion_offset) in dictionary.items():
+            # the postings of the term, without its champion list
+            postings_file.seek(position)
+            term_docIds, term_weights, scale = decode_postings(postings_file.read(champion_offset or size))
+            ordinals.append(np.searchsorted(docIds, np.asarray(term_docIds)).astype(ORDINAL))
+            weights.append(np.asarray(term_weights))
+            scales.append(scale)
+            indptr.append(indptr[-1] + len(term_docIds))
+
+    np.save(os.path.join(directory, 'indptr.npy'), np.asarray(indptr, dtype=np.int64))
+    np.save(os.path.join(directory, 'ordinals.npy'), np.concatenate(ordinals) if ordinals else np.empty(0, ORDINAL))
+    np.save(os.path.join(directory, 'weights.npy'), np.concatenate(weights) if weights else np.empty(0))
+    np.save(os.path.join(directory, 'scales.npy'), np.asarray(scales, dtype=np.float64))
+    np.save(os.path.join(directory, 'docIds.npy'), docIds)
+
+
+# The memory-mapped matrix of an index, and the liveness (not deleted) of its documents
+class TermDocumentMatrix:
+    def __init__(self, index_directory, deleted=()):
+        directory = matrix_directory(index_directory)
+        self.indptr = np.load(os.path.join(directory, 'indptr.npy'), mmap_mode='r')
+        self.ordinals = np.load(os.path.join(directory, 'ordinals.npy'), mmap_mode='r')
+        self.weights = np.load(os.path.join(directory, 'weights.npy'), mmap_mode='r')
+        self.scales = np.load(os.path.join(directory, 'scales.npy'), mmap_mode='r')
+        self.docIds = np.load(os.path.join(directory, 'docIds.npy'), mmap_mode='r')
+        self.size = len(self.docIds)
+        self.live = np.ones(self.size, dtype=bool)
+        if deleted:
+            deleted = np.asarray(sorted(deleted), dtype=np.int64)
+            positions = np.minimum(np.searchsorted(self.docIds, deleted), max(self.size - 1, 0))
+            if self.size:
+                self.live[positions[self.docIds[positions] == deleted]] = False
+
+    def column(self, column):
+        start, end = self.indptr[column], self.indptr[column + 1]
+        return self.ordinals[start:end], self.weights[start:end], self.scales[column]
+
+    # Number of documents of a column which are not deleted
+    def live_count(self, column):
+        ordinals, _, _ = self.column(column)
+        return int(np.count_nonzero(self.live[ordinals]))
+
+    # Number of queries scored at once, so that their dense scores fit in SCORE_BLOCK_BYTES
+    def block_size(self):
+        return max(1, SCORE_BLOCK_BYTES // (9 * max(self.size, 1)))
+
+    # Product of the sparse query-term matrix of a block of queries and the term-document matrix: the scores of all
+    # the documents for every query, and the mask of the documents with a posting of a query term (they can score 0).
+    # The query-term matrix is given by column: (column, rows of the queries with the term, their query weights), a
+    # column possibly repeated with other rows. The products of every column (an outer product) are laid out in the
+    # given order at the flat positions row * size + ordinal of the scores, and summed by a single bincount. bincount
+    # adds its input in order, so the products of a document are added in the order of the columns of its row, which
+    # search.py gives in query order.
+    def multiply(self, query_columns, rows):
+        positions = []
+        products = []
+        for column, query_rows, query_weights in query_columns:
+            ordinals, weights, scale = self.column(column)
+            positions.append((np.asarray(query_rows)[:, None] * self.size + ordinals[None, :]).ravel())
+            products.append(np.outer(np.asarray(query_weights) * scale, weights).ravel())
+        scored = np.zeros(rows * self.size, dtype=bool)
+        if not positions:
+            return np.zeros((rows, self.size)), scored.reshape(rows, self.size)
+        positions = np.concatenate(positions)
+        scored[positions] = True
+        scores = np.bincount(positions, np.concatenate(products), minlength=rows * self.size)
+        return scores.reshape(rows, self.size), scored.reshape(rows, self.size)
+
+    # The k best (score, docId) pairs of a row of scores normalized by the query length
+    def top_documents(self, scores, scored, query_length, k):
+        candidates = np.flatnonzero(scored & self.live)
+        return top_documents(scores[candidates] / query_length, self.docIds[candidates], k)
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+import math
+import struct
+from array import array
+
+# Postings of a term: its documents in ascending docId order, with the term frequency and the precomputed weight
+# of the term in every document, the document side of the lnc.ltc scheme: (1 + log10(tf)) / doc_length.
+# The weight is query independent, so scoring a posting is a single multiply-accumulate with the query weight.
+#
+# Layout: header (number of postings, weight bits, scale), docIds (4 bytes each), term frequencies (4 bytes each)
+# and weights. Search only reads the docIds and the weights, merges recompute the weights from the term frequencies.
+# The decoders only read the postings they count, so the bytes after them (a champion list, see index.py) are ignored.
+#
+# Weights are stored as 64 bit floats, or quantized to 16 or 8 bit integers q = round(weight / scale) with
+# scale = (largest weight of the term) / (2^bits - 1). The dequantized weight q * scale is within scale / 2 of the
+# weight, and since a cosine normalized weight is at most 1, scale <= 1 / (2^bits - 1). The cosine score of a document
+# for a query of terms t with weights wq(t) is then off by at most
+#     sum(wq(t) * scale(t) / 2) / |q|  <=  sqrt(number of query terms) / (2 * (2^bits - 1))
+# (Cauchy-Schwarz), i.e. 0.00196 * sqrt(n) with 8 bits and 7.6e-6 * sqrt(n) with 16 bits.
+
+HEADER = struct.Struct('<IBd')
+
+WEIGHT_TYPES = {64: 'd', 16: 'H', 8: 'B'}
+DOCID = 'I'
+TERM_FREQUENCY = 'I'
+
+
+def document_weight(term_frequency, doc_length):
+    return (1 + math.log10(term_frequency)) / doc_length
+
+
+# Encoded postings and the largest stored weight (dequantized), the upper bound of the document weights of the term
+def encode_postings(docIds, term_frequencies, weights, bits=64):
+    if bits == 64:
+        scale = 1.0
+        stored = array(WEIGHT_TYPES[bits], weights)
+    else:
+        high = max(weights)
+        scale = high / ((1 << bits) - 1) if high else 1.0
+        stored = array(WEIGHT_TYPES[bits], [round(weight / scale) for weight in weights])
+    data = (HEADER.pack(len(docIds), bits, scale) + array(DOCID, docIds).tobytes()
+            + array(TERM_FREQUENCY, term_frequencies).tobytes() + stored.tobytes())
+    return data, max(stored) * scale
+
+
+# Number of postings, weight bits and scale of encoded postings
+def decode_header(data):
+    return HEADER.unpack_from(data)
+
+
+# docIds, stored weights and scale (a stored weight times the scale is the document weight)
+def decode_postings(data):
+    count, bits, scale = HEADER.unpack_from(data)
+    docIds = array(DOCID)
+    docIds.frombytes(data[HEADER.size:HEADER.size + docIds.itemsize * count])
+    weights = array(WEIGHT_TYPES[bits])
+    start = HEADER.size + (docIds.itemsize + array(TERM_FREQUENCY).itemsize) * count
+    weights.frombytes(data[start:start + weights.itemsize * count])
+    return docIds, weights, scale
+
+
+# Number of postings of encoded postings of the given size in bytes, with the given weight bits
+def postings_count(size, bits):
+    return (size - HEADER.size) // (array(DOCID).itemsize + array(TERM_FREQUENCY).itemsize
+                                    + array(WEIGHT_TYPES[bits]).itemsize)
+
+
+# docIds and term frequencies
+def decode_frequencies(data):
+    count, _, _ = HEADER.unpack_from(data)
+    docIds = array(DOCID)
+    docIds.frombytes(data[HEADER.size:HEADER.size + docIds.itemsize * count])
+    term_frequencies = array(TERM_FREQUENCY)
+    start = HEADER.size + docIds.itemsize * count
+    term_frequencies.frombytes(data[start:start + term_frequencies.itemsize * count])
+    return docIds, term_frequencies
@@ -1,128 +1,555 @@
 #!/usr/bin/python3
 import math
-import pickle
+import os
 import sys
 import getopt
 import heapq
+from bisect import bisect_left
+from functools import partial
 
-from nltk import word_tokenize, sent_tokenize
-from nltk.stem.porter import PorterStemmer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.analysis import Analyzer
+from common.doctable import open_table
+from common.postings_io import SharedPostings, read_postings
+from common.segments import index_segments, index_version, read_deletions
+from common.server import serve_stdin, serve_unix_socket
+from common.termdict import TermDictionary
+from postings import decode_header, decode_postings, postings_count
 
 
 def usage():
-    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results")
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results"
+                                    " [-t nltk|regex] [-e] [-b python|numpy] [-m] [-a [-r]]")
+    print("       " + sys.argv[0] + " -d dictionary-file -p postings-file -s | -u socket-path [-t nltk|regex] [-e]"
+                                    " [-b python|numpy] [-a]")
 
 
-class Node:
-    def __init__(self, docId=None, next=None, termFrequency=1):
-        self.docId = docId
-        self.termFrequency = termFrequency
-        self.next = next
+BACKENDS = ('python', 'numpy')
 
 
-class LinkedList:
-    def __init__(self, head=None):
-        self.head = head
+# Number of documents returned for a query
+TOP_K = 10
+# Relative margin of the comparisons of score bounds with the threshold of MaxScore, far larger than rounding errors
+BOUND_SLACK = 1e-9
 
-
-with open('docIds.pickle', 'rb') as handle:
-    all_docIds_length = len(pickle.load(handle))
+# Queries are analyzed with the tokenizer of the documents, chosen with -t (see common/analysis.py)
+analyzer = Analyzer()
 
 
 def process_words(text):
-    sentences = sent_tokenize(text)
-    words = []
-    for s in sentences:
-        words.extend(word.lower() for word in word_tokenize(s))
-    stemmer = PorterStemmer()
-    return map(stemmer.stem, words)
+    return analyzer.analyze(text)
 
 
-def cosine_similarity(query, dictionary_path, postings_path):
-    scores = dict()
+# Open the base index and all the live segments (see common/segments.py): (dictionary, postings file, deleted docIds)
+# of every segment, the number of (not deleted) documents of all segments and, with the numpy backend, the dense
+# ordinals of their docIds (None otherwise). The document tables are memory-mapped, only the numpy backend reads their
+# docIds. The document lengths are not needed, the postings hold the normalized document weights.
+def load_index(dictionary_path, postings_path):
+    segments = []
+    all_docIds_length = 0
+    tables = []
+    for segment_dictionary, segment_postings, directory in index_segments(dictionary_path, postings_path):
+        deleted = read_deletions(directory)
+        segments.append((TermDictionary(segment_dictionary), open(segment_postings, 'rb'), deleted))
 
-    query_terms = process_words(query)
-    postings_file = open(postings_path, 'rb')
+        table = open_table(directory)
+        tables.append(table)
+        all_docIds_length += len(table) - len(deleted)
 
-    with open(dictionary_path, 'rb') as dictionary_file:
-        dictionary = pickle.load(dictionary_file)
+    ordinals = None
+    if backend == 'numpy':
+        ordinals = dense.DocumentOrdinals([table.docIds for table in tables],
+                                          [deleted for _, _, deleted in segments])
+    for table in tables:
+        table.close()
+    return segments, all_docIds_length, ordinals
 
-    query_frequencies = dict()
-    query_length = 0
 
-    # Fill query_terms dictionary
-    for query_term in query_terms:
+def close_index(segments):
+    for dictionary, postings_file, _ in segments:
+        postings_file.close()
+        dictionary.close()
+
+
+# Number of deleted docIds in a postings list
+def deleted_count(docIds, deleted):
+    return sum(1 for docId in docIds if docId in deleted)
+
+
+def query_frequencies_of(query):
+    query_frequencies = dict()
+    for query_term in process_words(query):
         if query_term in query_frequencies:
             query_frequencies[query_term] += 1
         else:
             query_frequencies[query_term] = 1
-
-    # For each query term, compute a product with documents terms and add to the score
-    for query_term, query_term_frequency in query_frequencies.items():
-        position = dictionary.get(query_term)
-        if position is None:
+    return query_frequencies
+
+
+# Byte extents of the postings (or of the champion lists) of the query terms found in the dictionary of a segment
+def term_extents(query_frequencies, dictionary, champions=False):
+    extents = []
+    for query_term in query_frequencies:
+        term_data = dictionary.get(query_term)
+        if term_data is not None:
+            extents.append((query_term,) + term_extent(term_data, champions))
+    return extents
+
+
+# Position and size of the postings of a term, or of its champion list: the postings of a term are followed by its
+# champion list, if it has one (see index.py), and are their own champion list otherwise
+def term_extent(term_data, champions):
+    position, size, _, champion_offset = term_data
+    if champions:
+        return position + champion_offset, size - champion_offset
+    return position, champion_offset or size
+
+
+# Number of postings of a term with a champion list, counted from the size of its postings (0 without one)
+def lower_tier_count(term_data, data):
+    champion_offset = term_data[3]
+    if not champion_offset:
+        return 0
+    count, bits, _ = decode_header(data)
+    return postings_count(champion_offset, bits) - count
+
+
+# Document frequency (without the deleted documents), postings (docIds, weights, scale) and largest document weight
+# (from the dictionary) of a term in a segment. The document frequency of a champion list is the one of the term,
+# though its deleted documents out of the champion list are counted until its segment is merged.
+def decode_term(dictionary, deleted, champions, query_term, data):
+    term_data = dictionary[query_term]
+    postings = decode_postings(data)
+    doc_frequency = len(postings[0])
+    if champions:
+        doc_frequency += lower_tier_count(term_data, data)
+    if deleted:
+        doc_frequency -= deleted_count(postings[0], deleted)
+    return doc_frequency, postings, term_data[2]
+
+
+# With the numpy backend, the docIds of the postings are replaced by their ordinals and the weights are an array
+def decode_term_dense(dictionary, ordinals, segment, champions, query_term, data):
+    term_data = dictionary[query_term]
+    docIds, weights, scale = decode_postings(data)
+    term_ordinals = ordinals.of(segment, docIds)
+    doc_frequency = ordinals.live_count(term_ordinals)
+    if champions:
+        doc_frequency += lower_tier_count(term_data, data)
+    return doc_frequency, (term_ordinals, dense.as_array(weights), scale), term_data[2]
+
+
+# Decoder of the postings (or of the champion lists) of a segment for the backend
+def term_decoder(segments, ordinals, segment, champions=False):
+    dictionary, _, deleted = segments[segment]
+    if backend == 'numpy':
+        return partial(decode_term_dense, dictionary, ordinals, segment, champions)
+    return partial(decode_term, dictionary, deleted, champions)
+
+
+def cosine_similarity(query, segments, all_docIds_length, ordinals):
+    query_frequencies = query_frequencies_of(query)
+    fetched = fetch_postings(query_frequencies, segments, ordinals, approximate)
+    return rank(query_frequencies, fetched, segments, all_docIds_length, ordinals)
+
+
+# Fetch postings (or champion lists) of all query terms from every segment, each segment in one batch of byte extents
+# in offset order
+def fetch_postings(query_frequencies, segments, ordinals, champions=False):
+    fetched = []
+    for segment, (dictionary, postings_file, _) in enumerate(segments):
+        decode = term_decoder(segments, ordinals, segment, champions)
+        fetched.append({query_term: decode(query_term, data) for query_term, data
+                        in read_postings(postings_file, term_extents(query_frequencies, dictionary, champions))})
+    return fetched
+
+
+# Weight w(t, q) of every query term found in the segments (in query order, the order of the score sums) and the
+# query vector length. Document frequencies are summed over the segments, without the deleted documents.
+def query_weights(query_frequencies, fetched, all_docIds_length):
+    doc_frequencies = dict()
+    for segment_postings in fetched:
+        for query_term in query_frequencies:
+            if query_term in segment_postings:
+                doc_frequencies[query_term] = doc_frequencies.get(query_term, 0) + segment_postings[query_term][0]
+    return weigh_query(query_frequencies, doc_frequencies, all_docIds_length)
+
+
+# Weights and vector length of a query, with the document frequencies of its terms found in the segments
+def weigh_query(query_frequencies, doc_frequencies, all_docIds_length):
+    weights = []
+    query_length = 0
+    for query_term in query_frequencies:
+        doc_frequency = doc_frequencies.get(query_term, 0)
+        # the term isn't in the index, or all its documents are deleted
+        if doc_frequency == 0:
             continue
-        postings_file.seek(position)
-        data = postings_file.read()
-        doc_frequency, postings_list = pickle.loads(data)
 
         # calculate w(t, q)
-        wq = math.log10(all_docIds_length / doc_frequency) * (1 + math.log10(query_term_frequency))
-
+        wq = math.log10(all_docIds_length / doc_frequency) * (1 + math.log10(query_frequencies[query_term]))
+        weights.append((query_term, wq))
         query_length += pow(wq, 2)
+    return weights, math.sqrt(query_length)
+
+
+# Rank the documents for the query terms, with the (document frequency, postings, largest weight) of the terms
+# fetched from every segment (their champion lists in approximate mode): the TOP_K best documents, by score then by
+# increasing docId
+def rank(query_frequencies, fetched, segments, all_docIds_length, ordinals):
+    if approximate:
+        return rank_champions(query_frequencies, fetched, segments, all_docIds_length, ordinals)
+    return rank_postings(query_frequencies, fetched, segments, all_docIds_length, ordinals)
+
+
+def rank_postings(query_frequencies, fetched, segments, all_docIds_length, ordinals):
+    weights, query_length = query_weights(query_frequencies, fetched, all_docIds_length)
+    if backend == 'numpy':
+        return rank_dense(weights, query_length, fetched, ordinals)
+    if exhaustive:
+        return rank_exhaustive(weights, query_length, fetched, segments)
+    return rank_maxscore(weights, query_length, fetched, segments)
+
+
+# Approximate ranking with the champion lists (search.py -a): only the postings of the high tier of every term, its
+# champion list, are scored, exhaustively, and the documents are ranked by these partial scores. A document only gets
+# the contributions of the terms it is a champion of, which are the exact ones, so a document which is a champion of
+# all its query terms gets its exact score. If fewer than TOP_K documents are found and a query term has a lower tier,
+# the query falls back to the full postings of its terms, ranked exactly.
+def rank_champions(query_frequencies, fetched, segments, all_docIds_length, ordinals):
+    weights, query_length = query_weights(query_frequencies, fetched, all_docIds_length)
+    if backend == 'numpy':
+        result = rank_dense(weights, query_length, fetched, ordinals)
+    else:
+        result = rank_exhaustive(weights, query_length, fetched, segments)
+    if len(result) < TOP_K and has_lower_tier(weights, segments):
+        return rank_postings(query_frequencies, fetch_postings(query_frequencies, segments, ordinals), segments,
+                             all_docIds_length, ordinals)
+    return result
+
 
-        node = postings_list.head
+# Whether a weighted query term has postings out of its champion list in a segment
+def has_lower_tier(weights, segments):
+    for query_term, _ in weights:
+        for dictionary, _, _ in segments:
+            term_data = dictionary.get(query_term)
+            if term_data is not None and term_data[3]:
+                return True
+    return False
 
-        # get w(t, d) and add the product to final score the product of weights
-        while node is not None:
-            tfd = node.termFrequency
-            docId = node.docId
-            if docId in scores:
-                scores[docId] += (1 + math.log10(tfd)) * wq
-            else:
-                scores[docId] = (1 + math.log10(tfd)) * wq
-            node = node.next
 
-    with open('docLengths.pickle', 'rb') as doc_lengths_handle:
-        doc_lengths = pickle.load(doc_lengths_handle)
+# Score every posting of every query term
+def rank_exhaustive(weights, query_length, fetched, segments):
+    # all the query terms are in every document (or in none): no document has a cosine score
+    if query_length == 0:
+        return []
+
+    scores = dict()
+
+    # For each query term (in query order, whatever the number of segments), compute a product with documents terms
+    # and add to the score
+    for query_term, wq in weights:
+        for segment_postings, (_, _, deleted) in zip(fetched, segments):
+            if query_term not in segment_postings:
+                continue
+            _, (docIds, postings_weights, scale), _ = segment_postings[query_term]
+            # the precomputed w(t, d) (a stored weight times the scale) is multiplied by w(t, q) and added to the
+            # score, skipping deleted documents
+            factor = wq * scale
+            for docId, weight in zip(docIds, postings_weights):
+                if docId in deleted:
+                    continue
+                if docId in scores:
+                    scores[docId] += weight * factor
+                else:
+                    scores[docId] = weight * factor
 
     heap = []
-    query_length = math.sqrt(query_length)
 
     for docId in scores:
         # Limit heap to 100 entries
         heap_capacity = len(heap)
         if heap_capacity < 100:
-            heapq.heappush(heap, (scores[docId] / doc_lengths[docId] / query_length, docId))
+            heapq.heappush(heap, (scores[docId] / query_length, docId))
         else:
-            heapq.heapreplace(heap, (scores[docId] / doc_lengths[docId] / query_length, docId))
+            heapq.heapreplace(heap, (scores[docId] / query_length, docId))
 
-    k = len(heap) if len(heap) < 10 else 10
+    k = len(heap) if len(heap) < TOP_K else TOP_K
     #  return ranked documents sorted by increasing docId
     return sorted(heapq.nlargest(k, heap), key=lambda x: (-x[0], x[1]))
 
 
-def search_and_write(queries_path, output_path, dictionary_path, postings_path):
+# Score every posting as rank_exhaustive does, a term (in a segment) at a time with a scatter-add of its weights into
+# the dense scores of the documents (see common/dense.py)
+def rank_dense(weights, query_length, fetched, ordinals):
+    if query_length == 0:
+        return []
+
+    accumulator = dense.Accumulator(ordinals.size)
+    for query_term, wq in weights:
+        for segment_postings in fetched:
+            if query_term in segment_postings:
+                _, (term_ordinals, postings_weights, scale), _ = segment_postings[query_term]
+                accumulator.add(term_ordinals, postings_weights * (wq * scale))
+
+    candidates = accumulator.candidates(ordinals.live)
+    if not len(candidates):
+        return []
+    return dense.top_documents(accumulator.scores[candidates] / query_length, ordinals.docIds[candidates], TOP_K)
+
+
+# MaxScore dynamic pruning: the top TOP_K documents are kept in a heap, and the score of its last document is the
+# threshold a document must reach to enter it. The upper bound of the score of a query term is w(t, q) times the
+# largest document weight of the term (stored in the dictionary). Sorting the terms by upper bound, the terms whose
+# bounds sum (with the bounds of all the lower terms) to less than the threshold are non-essential: a document
+# containing only non-essential terms can't enter the top documents. So only the postings of the essential terms are
+# traversed (document at a time, in docId order), and the non-essential terms of a candidate document are looked up
+# (binary search forward in their postings) from the highest bound down, until the bounds left can't lift its score
+# over the threshold.
+#
+# A fully scored document gets the score computed by rank_exhaustive (the same products added in query order), so the
+# ranking is exactly the same, ties included; bounds are compared with a relative margin (BOUND_SLACK) so that
+# rounding never prunes a document which could enter the top documents.
+def rank_maxscore(weights, query_length, fetched, segments):
+    if query_length == 0:
+        return []
+
+    heap = []
+    # the documents of the segments are disjoint, they share the top documents and the threshold
+    for segment_postings, (_, _, deleted) in zip(fetched, segments):
+        lists = []
+        for order, (query_term, wq) in enumerate(weights):
+            if query_term in segment_postings:
+                _, (docIds, postings_weights, scale), max_weight = segment_postings[query_term]
+                lists.append((wq * max_weight, order, docIds, postings_weights, wq * scale))
+        if lists:
+            maxscore_segment(sorted(lists, key=lambda l: l[0]), deleted, heap, query_length)
+
+    return sorted(heap, key=lambda x: (-x[0], x[1]))
+
+
+def maxscore_segment(lists, deleted, heap, query_length):
+    count = len(lists)
+    bounds = [l[0] for l in lists]
+    # prefix_bounds[i]: sum of the bounds of the lists before i
+    prefix_bounds = [0]
+    for bound in bounds:
+        prefix_bounds.append(prefix_bounds[-1] + bound)
+    positions = [0] * count
+
+    def threshold():
+        return heap[0][0] * query_length if len(heap) == TOP_K else 0
+
+    # the first essential list: the lists before it can't lift a document over the threshold
+    def first_essential(start, limit):
+        while start < count and prefix_bounds[start + 1] * (1 + BOUND_SLACK) < limit:
+            start += 1
+        return start
+
+    essential = first_essential(0, threshold())
+    # the current docIds of the lists, the smallest first; the entries of the lists which became non-essential are
+    # dropped when they come up
+    cursors = [(l[2][0], i) for i, l in enumerate(lists) if len(l[2])]
+    heapq.heapify(cursors)
+    while cursors and essential < count:
+        candidate, i = cursors[0]
+        if i < essential:
+            heapq.heappop(cursors)
+            continue
+
+        contributions = {}
+        upper = prefix_bounds[essential]
+        while cursors and cursors[0][0] == candidate:
+            _, i = heapq.heappop(cursors)
+            if i < essential:
+                continue
+            _, order, docIds, postings_weights, factor = lists[i]
+            position = positions[i]
+            contributions[order] = postings_weights[position] * factor
+            upper += contributions[order]
+            positions[i] = position + 1
+            if position + 1 < len(docIds):
+                heapq.heappush(cursors, (docIds[position + 1], i))
+        if candidate in deleted:
+            continue
+
+        limit = threshold()
+        pruned = False
+        for i in range(essential - 1, -1, -1):
+            if upper * (1 + BOUND_SLACK) < limit:
+                pruned = True
+                break
+            _, order, docIds, postings_weights, factor = lists[i]
+            position = bisect_left(docIds, candidate, positions[i])
+            positions[i] = position
+            upper -= bounds[i]
+            if position < len(docIds) and docIds[position] == candidate:
+                contributions[order] = postings_weights[position] * factor
+                upper += contributions[order]
+        if pruned or upper * (1 + BOUND_SLACK) < limit:
+            continue
+
+        score = 0
+        for order in sorted(contributions):
+            score += contributions[order]
+        entry = (score / query_length, candidate)
+        if len(heap) < TOP_K:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+        else:
+            continue
+        essential = first_essential(essential, threshold())
+
+
+# Open the term dictionaries and the term-document matrices (see matrix.py) of the base index and all the live
+# segments, and the number of (not deleted) documents of all segments
+def load_matrices(dictionary_path, postings_path):
+    segments = []
+    all_docIds_length = 0
+    for segment_dictionary, _, directory in index_segments(dictionary_path, postings_path):
+        if not matrix.has_matrix(directory):
+            raise Exception(f'No term-document matrix in {directory!r}, the index must be built with index.py -m')
+        deleted = read_deletions(directory)
+        segment_matrix = matrix.TermDocumentMatrix(directory, deleted)
+        segments.append((TermDictionary(segment_dictionary), segment_matrix))
+        all_docIds_length += segment_matrix.size - len(deleted)
+
+    return segments, all_docIds_length
+
+
+def close_matrices(segments):
+    for dictionary, _ in segments:
+        dictionary.close()
+
+
+# Batch execution of a queries file with the term-document matrices (search.py -m): the weights of all the queries
+# make a sparse query-term matrix, multiplied by the term-document matrix of every segment a block of queries at a
+# time, then the best documents of every query are selected from its row of scores. The scores are the scores of
+# rank_exhaustive, bit for bit, so are the results.
+def search_and_write_matrices(queries_path, output_path, segments, all_docIds_length):
     input_queries_file = open(queries_path, 'r')
     output_file = open(output_path, 'w')
 
     queries = input_queries_file.read().splitlines()
+    batch_frequencies = [query_frequencies_of(q) for q in queries]
+
+    # Columns of the query terms in every segment (their ordinals in the term dictionary), and their document
+    # frequencies without the deleted documents
+    terms = sorted(set().union(*batch_frequencies))
+    segment_columns = []
+    doc_frequencies = dict()
+    for dictionary, segment_matrix in segments:
+        columns = dict()
+        for term in terms:
+            if term in dictionary:
+                columns[term] = dictionary.bisect(term)
+                doc_frequencies[term] = doc_frequencies.get(term, 0) + segment_matrix.live_count(columns[term])
+        segment_columns.append(columns)
+
+    batch_weights = [weigh_query(query_frequencies, {query_term: doc_frequencies[query_term]
+                                                     for query_term in query_frequencies
+                                                     if query_term in doc_frequencies}, all_docIds_length)
+                     for query_frequencies in batch_frequencies]
+
+    results = [[] for _ in queries]
+    for (_, segment_matrix), columns in zip(segments, segment_columns):
+        block_size = segment_matrix.block_size()
+        for start in range(0, len(queries), block_size):
+            block = batch_weights[start:start + block_size]
+            # the query-term matrix of the block, by rank of the term in its query then by column: rows of the
+            # queries with the term at that rank, their weights. The products of a query are then added in query
+            # order, as the other modes do.
+            query_columns = dict()
+            for row, (weights, _) in enumerate(block):
+                for rank, (query_term, wq) in enumerate(weights):
+                    if query_term in columns:
+                        rows, values = query_columns.setdefault((rank, columns[query_term]), ([], []))
+                        rows.append(row)
+                        values.append(wq)
+
+            scores, scored = segment_matrix.multiply(
+                [(column, rows, values) for (_, column), (rows, values) in sorted(query_columns.items())], len(block))
+            for row, (weights, query_length) in enumerate(block):
+                if query_length:
+                    results[start + row].extend(
+                        segment_matrix.top_documents(scores[row], scored[row], query_length, TOP_K))
+
     lines = []
-    for q in queries:
-        result_str = ''
-        result = cosine_similarity(query=q, dictionary_path=dictionary_path, postings_path=postings_path)
-        if len(result) > 0:
-            result_str = ' '.join([str(r[1]) for r in result][:10])
+    for result in results:
+        # the best documents of all the segments, ties broken as in rank_exhaustive
+        top = heapq.nlargest(TOP_K, result)
+        lines.append(format_result(sorted(top, key=lambda x: (-x[0], x[1]))) + '\n')
+
+    output_file.writelines(lines)
+
+
+def format_result(result):
+    return ' '.join([str(r[1]) for r in result][:10])
+
+
+# Batch execution of a queries file: all the queries are analyzed up front, then the postings lists of all their
+# terms are fetched and decoded once per segment (in offset order) and shared by the queries, every list being
+# dropped when the last query reading it is done
+def search_and_write(queries_path, output_path, segments, all_docIds_length, ordinals):
+    input_queries_file = open(queries_path, 'r')
+    output_file = open(output_path, 'w')
+
+    queries = input_queries_file.read().splitlines()
+    batch_frequencies = [query_frequencies_of(q) for q in queries]
+    shared = []
+    for segment, (dictionary, postings_file, _) in enumerate(segments):
+        postings = SharedPostings()
+        postings.load(postings_file, [term_extents(query_frequencies, dictionary, approximate)
+                                      for query_frequencies in batch_frequencies],
+                      term_decoder(segments, ordinals, segment, approximate))
+        shared.append(postings)
 
-        lines.append(result_str + '\n')
+    lines = []
+    results = []
+    for query_frequencies in batch_frequencies:
+        result = rank(query_frequencies, shared, segments, all_docIds_length, ordinals)
+        lines.append(format_result(result) + '\n')
+        results.append(result)
+        for postings in shared:
+            postings.release(query_frequencies)
 
     output_file.writelines(lines)
 
+    if report_recall:
+        recall, count = measure_recall(batch_frequencies, results, segments, all_docIds_length, ordinals)
+        print(f'recall@{TOP_K} against exhaustive search: {recall:.4f} ({count} queries)')
+
+
+# Recall@TOP_K of the results of the queries (search.py -a -r): the mean fraction of the TOP_K documents of the
+# exhaustive evaluation of a query which are in its results, over the queries with results. Returns the recall and the
+# number of queries it is measured on.
+def measure_recall(batch_frequencies, results, segments, all_docIds_length, ordinals):
+    total = 0
+    count = 0
+    for query_frequencies, result in zip(batch_frequencies, results):
+        fetched = fetch_postings(query_frequencies, segments, ordinals)
+        weights, query_length = query_weights(query_frequencies, fetched, all_docIds_length)
+        if backend == 'numpy':
+            expected = rank_dense(weights, query_length, fetched, ordinals)
+        else:
+            expected = rank_exhaustive(weights, query_length, fetched, segments)
+        if not expected:
+            continue
+        found = set(docId for _, docId in result)
+        total += sum(1 for _, docId in expected if docId in found) / len(expected)
+        count += 1
+    return (total / count if count else 1.0), count
+
 
-dictionary_file = postings_file = file_of_queries = output_file_of_results = None
+dictionary_file = postings_file = file_of_queries = file_of_output = socket_path = None
+serve = False
+exhaustive = False
+backend = 'python'
+batch_matrices = False
+approximate = report_recall = False
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:')
+    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:t:su:eb:mar')
 except getopt.GetoptError:
     usage()
     sys.exit(2)
@@ -136,13 +563,39 @@ for o, a in opts:
         file_of_queries = a
     elif o == '-o':
         file_of_output = a
+    elif o == '-t':  # tokenizer used by index.py
+        analyzer = Analyzer(tokenizer=a)
+    elif o == '-e':  # score every posting instead of pruning with MaxScore
+        exhaustive = True
+    elif o == '-s':  # serve queries from stdin
+        serve = True
+    elif o == '-u':  # serve queries on a Unix socket
+        serve = True
+        socket_path = a
+    elif o == '-b':  # scoring backend
+        backend = a
+    elif o == '-m':  # score the queries file with the term-document matrices
+        batch_matrices = True
+    elif o == '-a':  # approximate ranking with the champion lists
+        approximate = True
+    elif o == '-r':  # report the recall of the approximate ranking against the exhaustive one
+        report_recall = True
     else:
         assert False, "unhandled option"
 
-if dictionary_file == None or postings_file == None or file_of_queries == None or file_of_output == None:
+if dictionary_file == None or postings_file == None or (not serve and (file_of_queries == None or file_of_output == None)) \
+        or backend not in BACKENDS or (approximate and batch_matrices) or (report_recall and not approximate):
     usage()
     sys.exit(2)
 
+if backend == 'numpy':
+    # NumPy is only needed by the dense scoring backend
+    from common import dense
+
+if batch_matrices:
+    # NumPy is only needed by the term-document matrices
+    import matrix
+
 
 def run_search(dict_file, postings_file, queries_file, results_file):
     """
@@ -150,9 +603,45 @@ def run_search(dict_file, postings_file, queries_file, results_file):
     perform searching on the given queries file and output the results to a file
     """
     print('running search on the queries...')
-    search_and_write(queries_path=queries_file, dictionary_path=dict_file, postings_path=postings_file,
-                     output_path=results_file)
+    if batch_matrices:
+        segments, all_docIds_length = load_matrices(dict_file, postings_file)
+        search_and_write_matrices(queries_path=queries_file, segments=segments, all_docIds_length=all_docIds_length,
+                                  output_path=results_file)
+        close_matrices(segments)
+        print('DONE!')
+        return
+
+    segments, all_docIds_length, ordinals = load_index(dict_file, postings_file)
+    search_and_write(queries_path=queries_file, segments=segments, all_docIds_length=all_docIds_length,
+                     ordinals=ordinals, output_path=results_file)
+    close_index(segments)
     print('DONE!')
 
 
-run_search(dictionary_file, postings_file, file_of_queries, file_of_output)
+def run_server(dict_file, postings_file, socket_path=None):
+    """
+    load the index once and answer queries (one per line) from stdin,
+    or from connections to the given Unix socket.
+    The index is reloaded when segments are added, merged or have documents deleted.
+    """
+    index = {'version': index_version(), 'index': load_index(dict_file, postings_file)}
+
+    def answer(query):
+        version = index_version()
+        if version != index['version']:
+            close_index(index['index'][0])
+            index['version'] = version
+            index['index'] = load_index(dict_file, postings_file)
+        return format_result(cosine_similarity(query, *index['index']))
+
+    if socket_path is None:
+        serve_stdin(answer)
+    else:
+        serve_unix_socket(socket_path, answer)
+    close_index(index['index'][0])
+
+
+if serve:
+    run_server(dictionary_file, postings_file, socket_path)
+else:
+    run_search(dictionary_file, postings_file, file_of_queries, file_of_output)
@@ -1,12 +1,16 @@
 import math
+import os
 import pickle
 
-from nltk import sent_tokenize
-from nltk import word_tokenize
-from nltk.stem.porter import PorterStemmer
 import sys
 import getopt
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.analysis import Analyzer
+from common.doctable import open_table
+from common.postings_io import read_postings
+from common.termdict import TermDictionary
+
 
 # Alternative search with blind RF feedback
 
@@ -14,13 +18,11 @@ def usage():
     print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results")
 
 
+analyzer = Analyzer(alphanumeric=True, excluded=('AND',))
+
+
 def process_words(text):
-    stemmer = PorterStemmer()
-    processed_words = []
-    for word in word_tokenize(text):
-        if word != 'AND' and word.isalnum():
-            processed_words.append(stemmer.stem(word))
-    return processed_words
+    return analyzer.analyze(text)
 
 
 query_vector = {}
@@ -28,8 +30,8 @@ docs_vector = {}
 
 
 def cosine_similarity(query_terms, dictionary, postings_file):
-    with open('docIds.txt', 'rb') as handle:
-        all_docIds_length = len(pickle.load(handle))
+    with open_table('.') as table:
+        all_docIds_length = len(table)
 
     scores = dict()
 
@@ -42,14 +44,20 @@ def cosine_similarity(query_terms, dictionary, postings_file):
         else:
             query_frequencies[query_term] = 1
 
+    extents = []
+    for query_term in query_frequencies:
+        term_data = dictionary.get(query_term)
+        if term_data is not None:
+            extents.append((query_term, term_data[0], term_data[1]))
+
+    # Postings are read in offset order, the terms are scored in query order
+    fetched = dict(read_postings(postings_file, extents))
+
     # For each query term, compute a product with documents terms and add to the score
     for query_term, query_term_frequency in query_frequencies.items():
-        position = dictionary.get(query_term)
-        if position is None:
+        if query_term not in fetched:
             continue
-        postings_file.seek(position)
-        data = postings_file.read()
-        postings_list = pickle.loads(data)
+        postings_list = pickle.loads(fetched[query_term])
         docFrequency = len(postings_list)
         # calculate w(t, q)
         wq = max(0, math.log10((all_docIds_length - docFrequency) / docFrequency)) * (
@@ -95,8 +103,7 @@ def search_and_write(queries_path, output_path, dictionary_path, postings_path):
     queries = input_queries_file.read().splitlines()
     lines = []
 
-    with open(dictionary_path, 'rb') as dictionary_file:
-        dictionary = pickle.load(dictionary_file)
+    dictionary = TermDictionary(dictionary_path)
     postings_file = open(postings_path, 'rb')
 
     for q in queries:
@@ -110,13 +117,17 @@ def search_and_write(queries_path, output_path, dictionary_path, postings_path):
         low_docs = result[-10:]
         new_query = query_vector
 
+        extents = []
+        for term in query_vector:
+            term_data = dictionary.get(term)
+            if term_data is not None:
+                extents.append((term, term_data[0], term_data[1]))
+
+        fetched = dict(read_postings(postings_file, extents))
         for term in query_vector:
-            position = dictionary.get(term)
-            if position is None:
+            if term not in fetched:
                 continue
-            postings_file.seek(position)
-            data = postings_file.read()
-            postings_list = pickle.loads(data)
+            postings_list = pickle.loads(fetched[term])
 
             # find a centroid of top docs and add its value to a corresponding term of new query vector
             for doc in top_docs:
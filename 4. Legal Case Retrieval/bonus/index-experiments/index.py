@@ -1,21 +1,20 @@
 import multiprocessing as mp
-from nltk import word_tokenize, sent_tokenize
-from nltk.stem.porter import PorterStemmer
+import os
 import pickle
 import pandas as pd
 import math
 import sys
 
-sys.setrecursionlimit(20000)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from common.analysis import Analyzer
+from common.token_cache import TokenCache
 
+sys.setrecursionlimit(20000)
 
-def process_words(text):
-    sentences = sent_tokenize(text)
-    words = []
-    for s in sentences:
-        words.extend(word.lower() for word in word_tokenize(s))
-    stemmer = PorterStemmer()
-    return map(stemmer.stem, words)
+analyzer = Analyzer()
+# The experiments rebuild the index of the same dataset with other weightings, the zones are only analyzed once
+TOKEN_CACHE_DIR = 'token_cache'
+token_cache = TokenCache(TOKEN_CACHE_DIR, analyzer)
 
 
 df = pd.read_csv('dataset.csv')
@@ -36,12 +35,10 @@ additional_data = {}
 def mapper(docId):
     other_data = {}
 
-    content = process_words(df[df['document_id'] == docId]['content'].values[0])
-    title = process_words(df[df['document_id'] == docId]['title'].values[0])
-    date = process_words(df[df['document_id'] == docId]['date_posted'].values[0])
-    court_name = df[df['document_id'] == docId]['court'].values[0]
-    court = process_words(court_name)
-    values = [content, title, date, court]
+    document = df[df['document_id'] == docId]
+    court_name = document['court'].values[0]
+    values = token_cache.analyze_batch([document['content'].values[0], document['title'].values[0],
+                                        document['date_posted'].values[0], court_name])
     # content, title, date, court
     # [0, 0, 0, 0]
     term_frequencies = {}
@@ -102,7 +99,8 @@ def mapper(docId):
 
     return {
         'index': result,
-        'other_data': other_data
+        'other_data': other_data,
+        'tokens': token_cache.take_added()
     }
 
 
@@ -114,6 +112,7 @@ def combine(data_list):
         index = data['index']
         other_data = data['other_data']
         additional_data.update(other_data)
+        token_cache.update(data['tokens'])
         for key in index:
             if key in index_result:
                 index_result[key].extend(index[key])
@@ -128,6 +127,7 @@ with mp.Pool(mp.cpu_count()) as pool:
     indexes = pool.map(mapper, docIds)
 
 inverted_index = combine(indexes)
+token_cache.save()
 
 dictionary = {}
 postings_file = open('postings.txt', 'ab')
@@ -1,19 +1,21 @@
+import os
+import sys
+
 from query_expansion import expand_query
 from search import cosine_similarity
-from nltk import word_tokenize, sent_tokenize
-from nltk.stem.porter import PorterStemmer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from common.analysis import Analyzer
 
 # The manual testing file for trying different experiments (SMART schemes, zone weighting, query expansion)
 methods = ['tf_n', 'tf_l', 'tf_a', 'tf_ave']
 
 
+analyzer = Analyzer(alphanumeric=True, excluded=('AND',))
+
+
 def process_words(text):
-    stemmer = PorterStemmer()
-    processed_words = []
-    for word in word_tokenize(text):
-        if word != 'AND' and word.isalnum():
-            processed_words.append(stemmer.stem(word))
-    return processed_words
+    return analyzer.analyze(text)
 
 
 def search_and_write(with_expansion, tf_method, with_titles=False, with_courts=False):
@@ -1,33 +1,105 @@
 #!/usr/bin/python3
 
 import multiprocessing as mp
-from nltk import word_tokenize, sent_tokenize
-from nltk.stem.porter import PorterStemmer
+import os
 import pickle
 from lib import pandas as pd
 import sys
 import getopt
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.analysis import Analyzer
+from common.doctable import open_table, table_path, write_table
+from common.segments import (create_segment, delete_documents, merge_dictionaries, register_segment, reset_segments,
+                             run_merges, segment_files, start_background_merge)
+from common.termdict import TermDictionaryWriter
+from common.token_cache import TokenCache
+
 sys.setrecursionlimit(20000)
 
 
 def usage():
-    print("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file")
+    options = "[-t nltk|regex] [-c token-cache-directory]"
+    print("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file " + options)
+    print("       " + sys.argv[0] + " -i dataset-of-new-documents -a " + options)
+    print("       " + sys.argv[0] + " -i dataset-of-updated-documents -u " + options)
+    print("       " + sys.argv[0] + " -x file-of-deleted-docIds")
+    print("       " + sys.argv[0] + " -M")
+
+
+# The tokenizer (see common/analysis.py) is chosen with -t, search must use the same one.
+# With -c, the terms of the zones are read from (and added to) a token cache (see common/token_cache.py).
+analyzer = Analyzer()
+token_cache = None
 
 
 def process_words(text):
-    sentences = sent_tokenize(text)
-    words = []
-    for s in sentences:
-        words.extend(word.lower() for word in word_tokenize(s))
-    stemmer = PorterStemmer()
-    return map(stemmer.stem, words)
+    if token_cache is not None:
+        return token_cache.analyze(text)
+    return analyzer.analyze(text)
+
+
+def process_batch(texts):
+    if token_cache is not None:
+        return token_cache.analyze_batch(texts)
+    return analyzer.analyze_batch(texts)
+
+
+# SEGMENTS
+
+# Merge the postings of a term from several segments (their docIds are disjoint), without the deleted docIds
+def merge_segment_postings(term_postings, deleted):
+    postings_list = []
+    for data, _ in term_postings:
+        postings_list.extend(node for node in pickle.loads(data) if node[0] not in deleted)
+    if not postings_list:
+        return None
+    return pickle.dumps(postings_list, protocol=pickle.HIGHEST_PROTOCOL), ()
+
+
+def read_docIds(directory):
+    with open_table(directory) as table:
+        return set(table.docIds)
+
+
+# Write the document table of an index (see common/doctable.py), a row for every docId of the dataset in docId order:
+# docId, court (an id in the table of court names), length in terms, largest and average term frequency (all zones)
+def write_documents(index_directory, docIds, documents):
+    courts = sorted(set(documents[docId][0] for docId in docIds))
+    court_ids = {court: i for i, court in enumerate(courts)}
+    write_table(table_path(index_directory), [
+        ('docId', 'q', docIds),
+        ('court', 'H', [court_ids[documents[docId][0]] for docId in docIds]),
+        ('length', 'I', [documents[docId][1] for docId in docIds]),
+        ('max_tf', 'I', [documents[docId][2] for docId in docIds]),
+        ('avg_tf', 'd', [documents[docId][3] for docId in docIds]),
+    ], courts)
 
 
-dataset_file = output_file_dictionary = output_file_postings = None
+# Build the index of the given segment directories in a new segment directory, dropping the deleted docIds
+def merge_segments(directories, directory, deleted):
+    dictionary_path, postings_path = segment_files(directory)
+    merge_dictionaries([segment_files(d) for d in directories], dictionary_path, postings_path, 'QI',
+                       lambda term_postings: merge_segment_postings(term_postings, deleted))
+
+    segment_docIds = []
+    segment_documents = {}
+    for d in directories:
+        with open_table(d) as table:
+            for ordinal, docId in enumerate(table.docIds):
+                if docId not in deleted:
+                    segment_docIds.append(docId)
+                    segment_documents[docId] = (table.string('court', ordinal), table.value('length', ordinal),
+                                                table.value('max_tf', ordinal), table.value('avg_tf', ordinal))
+
+    write_documents(directory, sorted(segment_docIds), segment_documents)
+
+
+dataset_file = output_file_dictionary = output_file_postings = deleted_docIds_file = token_cache_directory = None
+add = update = merge = False
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:')
+    opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:t:c:aux:M')
 except getopt.GetoptError:
     usage()
     sys.exit(2)
@@ -39,36 +111,66 @@ for o, a in opts:
         output_file_dictionary = a
     elif o == '-p':  # postings file
         output_file_postings = a
+    elif o == '-t':  # tokenizer of the documents
+        analyzer = Analyzer(tokenizer=a)
+    elif o == '-c':  # token cache directory
+        token_cache_directory = a
+    elif o == '-a':  # add the documents of the dataset as a new segment
+        add = True
+    elif o == '-u':  # replace the documents of the dataset with their new versions
+        add = update = True
+    elif o == '-x':  # file of docIds to delete
+        deleted_docIds_file = a
+    elif o == '-M':  # merge segments
+        merge = True
     else:
         assert False, "unhandled option"
 
-if dataset_file == None or output_file_postings == None or output_file_dictionary == None:
+if merge:
+    run_merges(merge_segments)
+    sys.exit(0)
+
+if deleted_docIds_file != None:
+    with open(deleted_docIds_file, 'r') as handle:
+        print(f'{delete_documents([int(docId) for docId in handle.read().split()], read_docIds)} documents deleted')
+    sys.exit(0)
+
+if dataset_file == None or (not add and (output_file_postings == None or output_file_dictionary == None)):
     usage()
     sys.exit(2)
 
+if token_cache_directory != None:
+    token_cache = TokenCache(token_cache_directory, analyzer)
+
+# New documents are indexed into a new segment directory, a full build resets the segments
+if add:
+    segment_name, index_directory = create_segment()
+    output_file_dictionary, output_file_postings = segment_files(index_directory)
+else:
+    reset_segments()
+    index_directory = '.'
+
 df = pd.read_csv(dataset_file)
 
 # Record docIds
 docIds = sorted(df['document_id'].tolist())
 
-with open('docIds.txt', 'wb') as docIds_handle:
-    pickle.dump(docIds, docIds_handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-docIds_handle.close()
+# An update deletes the previous versions of the documents, then adds them as a new segment
+if update:
+    print(f'{delete_documents(docIds, read_docIds)} documents deleted')
 
-additional_data = {}
+# docId -> (court, length, largest term frequency, average term frequency), for the document table
+documents = {}
 
 
 def mapper(docId):
     other_data = {}
 
-    # Split zones data
-    content = process_words(df[df['document_id'] == docId]['content'].values[0])
-    title = process_words(df[df['document_id'] == docId]['title'].values[0])
-    date = process_words(df[df['document_id'] == docId]['date_posted'].values[0])
-    court_name = df[df['document_id'] == docId]['court'].values[0]
-    court = process_words(court_name)
-    values = [content, title, date, court]
+    # Split zones data, analyzed in one batch
+    document = df[df['document_id'] == docId]
+    court_name = document['court'].values[0]
+    values = process_batch([document['content'].values[0], document['title'].values[0],
+                            document['date_posted'].values[0], court_name])
 
     # content, title, date, court - record term frequencies by zone
     # [0, 0, 0, 0, 0]
@@ -86,11 +188,15 @@ def mapper(docId):
     for term, frequencies in term_frequencies.items():
         result[term] = [[docId, term_frequencies[term]]]
 
-    other_data[docId] = court_name
+    totals = [sum(frequencies) for frequencies in term_frequencies.values()]
+    other_data[docId] = (court_name, sum(totals), max(totals, default=0),
+                         sum(totals) / len(totals) if totals else 0.0)
 
     return {
         'index': result,
-        'other_data': other_data
+        'other_data': other_data,
+        # zones analyzed for the token cache, saved by the parent process
+        'tokens': token_cache.take_added() if token_cache is not None else None
     }
 
 
@@ -101,7 +207,9 @@ def combine(data_list):
         data = data_list.pop()
         index = data['index']
         other_data = data['other_data']
-        additional_data.update(other_data)
+        documents.update(other_data)
+        if token_cache is not None:
+            token_cache.update(data['tokens'])
         for key in index:
             if key in index_result:
                 index_result[key].extend(index[key])
@@ -113,36 +221,35 @@ def combine(data_list):
 
 
 def create_index(postings_path, dictionary_path):
-    # Concurrent MapReduce
-    with mp.Pool(mp.cpu_count()) as pool:
+    # Concurrent MapReduce: the workers are forked, so they inherit the analyzer and token cache set by the options
+    # and the loaded documents on every platform where fork is available
+    with mp.get_context('fork').Pool(mp.cpu_count()) as pool:
         # MapReduce for all docIds
         indexes = pool.map(mapper, docIds)
 
     # Final reduce
     inverted_index = combine(indexes)
+    if token_cache is not None:
+        token_cache.save()
 
-    dictionary = {}
+    # the term dictionary is written in term order
+    dictionary = TermDictionaryWriter(dictionary_path, 'QI')
     postings_file = open(postings_path, 'ab')
 
-    for key in inverted_index:
+    for key in sorted(inverted_index):
         payload = inverted_index[key]
         position = postings_file.tell()
+        data = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
 
-        postings_file.write(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
-        dictionary[key] = position
+        postings_file.write(data)
+        dictionary.add(key, (position, len(data)))
 
     postings_file.close()
 
-    print('Dumping dictionary and additionals...')
-    with open(dictionary_path, 'wb') as dictionary_handle:
-        pickle.dump(dictionary, dictionary_handle, protocol=pickle.HIGHEST_PROTOCOL)
+    print('Dumping dictionary and document table...')
+    dictionary.close()
 
-    dictionary_handle.close()
-
-    with open('additional.txt', 'wb') as additional_data_handle:
-        pickle.dump(additional_data, additional_data_handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-    additional_data_handle.close()
+    write_documents(index_directory, docIds, documents)
 
 
 def build_index(out_dict, out_postings):
@@ -152,3 +259,8 @@ def build_index(out_dict, out_postings):
 
 
 build_index(output_file_dictionary, output_file_postings)
+
+if add:
+    # the segment is searchable once registered, then segments are merged in the background
+    register_segment(segment_name, len(docIds))
+    start_background_merge(os.path.abspath(__file__), ['-M'])
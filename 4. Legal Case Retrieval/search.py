@@ -1,16 +1,30 @@
 #!/usr/bin/python3
 
 import math
+import os
 import pickle
+from functools import partial
 
-from nltk import word_tokenize
-from nltk.stem.porter import PorterStemmer
 import sys
 import getopt
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.analysis import Analyzer
+from common.doctable import open_table
+from common.postings_io import SharedPostings, read_postings
+from common.segments import index_segments, index_version, read_deletions
+from common.server import serve_stdin, serve_unix_socket
+from common.termdict import TermDictionary
+
 
 def usage():
-    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results")
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results"
+                                    " [-t nltk|regex] [-b python|numpy]")
+    print("       " + sys.argv[0] + " -d dictionary-file -p postings-file -s | -u socket-path [-t nltk|regex]"
+                                    " [-b python|numpy]")
+
+
+BACKENDS = ('python', 'numpy')
 
 
 # Experiment: impact ordering using custom weights for courts with different hierarchy
@@ -31,53 +45,133 @@ def usage():
 #         if court in key:
 #             return courts[key]
 #     return 1
+#
+# (the court of a document is in the document table of its segment: table.string('court', table.ordinal(docId)))
+
+# Query words are alphanumeric tokens, without the AND operators of boolean queries
+analyzer = Analyzer(alphanumeric=True, excluded=('AND',))
+
 
 def process_words(text):
-    stemmer = PorterStemmer()
-    processed_words = []
-    for word in word_tokenize(text):
-        if word != 'AND' and word.isalnum():
-            processed_words.append(stemmer.stem(word))
-    return processed_words
+    return analyzer.analyze(text)
+
+
+# Open the base index and all the live segments (see common/segments.py): (dictionary, postings file, deleted docIds)
+# of every segment, the number of (not deleted) documents of all segments and, with the numpy backend, the dense
+# ordinals of their docIds (None otherwise). The document tables are memory-mapped, only the numpy backend reads their
+# docIds.
+def load_index(dictionary_path, postings_path):
+    segments = []
+    all_docIds_length = 0
+    tables = []
+    for segment_dictionary, segment_postings, directory in index_segments(dictionary_path, postings_path):
+        deleted = read_deletions(directory)
+        segments.append((TermDictionary(segment_dictionary), open(segment_postings, 'rb'), deleted))
+        table = open_table(directory)
+        tables.append(table)
+        all_docIds_length += len(table) - len(deleted)
+
+    ordinals = None
+    if backend == 'numpy':
+        ordinals = dense.DocumentOrdinals([table.docIds for table in tables], [deleted for _, _, deleted in segments])
+    for table in tables:
+        table.close()
+    return segments, all_docIds_length, ordinals
+
+
+def close_index(segments):
+    for dictionary, postings_file, _ in segments:
+        postings_file.close()
+        dictionary.close()
+
+
+def query_frequencies_of(query):
+    query_frequencies = dict()
+    for query_term in process_words(query):
+        if query_term in query_frequencies:
+            query_frequencies[query_term] += 1
+        else:
+            query_frequencies[query_term] = 1
+    return query_frequencies
 
 
-with open('additional.txt', 'rb') as other_data_handle:
-    otherData = pickle.load(other_data_handle)
+# Byte extents of the postings of the query terms found in the dictionary of a segment
+def term_extents(query_frequencies, dictionary):
+    extents = []
+    for query_term in query_frequencies:
+        term_data = dictionary.get(query_term)
+        if term_data is not None:
+            extents.append((query_term, term_data[0], term_data[1]))
+    return extents
 
 
-def cosine_similarity(query, dictionary_path, postings_path):
-    with open('docIds.txt', 'rb') as handle:
-        all_docIds_length = len(pickle.load(handle))
+# Postings list of a term in a segment, without the deleted documents
+def decode_term(deleted, query_term, data):
+    postings_list = pickle.loads(data)
+    if deleted:
+        postings_list = [node for node in postings_list if node[0] not in deleted]
+    return postings_list
 
-    scores = dict()
-    query_terms = process_words(query)
-    postings_file = open(postings_path, 'rb')
 
-    with open(dictionary_path, 'rb') as dictionary_file:
-        dictionary = pickle.load(dictionary_file)
+# With the numpy backend, a postings list becomes the ordinals of its documents and the l_tf weights of the term in
+# them, computed once when the postings are decoded
+def decode_term_dense(deleted, ordinals, segment, query_term, data):
+    postings_list = decode_term(deleted, query_term, data)
+    return (ordinals.of(segment, [node[0] for node in postings_list]),
+            dense.as_array([1 + math.log10(sum(node[1])) for node in postings_list]))
 
-    query_frequencies = dict()
 
-    # Fill query_terms dictionary
-    for query_term in query_terms:
-        if query_term in query_frequencies:
-            query_frequencies[query_term] += 1
-        else:
-            query_frequencies[query_term] = 1
+# Decoder of the postings of a segment for the backend
+def term_decoder(segments, ordinals, segment):
+    _, _, deleted = segments[segment]
+    if backend == 'numpy':
+        return partial(decode_term_dense, deleted, ordinals, segment)
+    return partial(decode_term, deleted)
+
+
+def cosine_similarity(query, segments, all_docIds_length, ordinals):
+    query_frequencies = query_frequencies_of(query)
+
+    # Fetch postings of all query terms from every segment, each segment in one batch of byte extents
+    # in offset order
+    fetched = []
+    for segment, (dictionary, postings_file, _) in enumerate(segments):
+        decode = term_decoder(segments, ordinals, segment)
+        fetched.append({query_term: decode(query_term, data) for query_term, data
+                        in read_postings(postings_file, term_extents(query_frequencies, dictionary))})
+    return rank(query_frequencies, fetched, all_docIds_length, ordinals)
+
 
-    # For each query term, compute a product with documents terms and add to the score
+# w(t, q) of a query term, query scheme: lpn
+def query_weight(query_term_frequency, docFrequency, all_docIds_length):
+    return max(0, math.log10((all_docIds_length - docFrequency) / docFrequency)) * (
+            1 + math.log10(query_term_frequency))
+
+
+# Rank the documents for the query terms, with the postings lists of the terms fetched from every segment.
+# The postings lists of a term in all segments are concatenated (their docIds are disjoint).
+def rank(query_frequencies, fetched, all_docIds_length, ordinals):
+    if backend == 'numpy':
+        return rank_dense(query_frequencies, fetched, all_docIds_length, ordinals)
+
+    scores = dict()
+
+    term_postings = dict()
+    for segment_postings in fetched:
+        for query_term in query_frequencies:
+            postings_list = segment_postings.get(query_term)
+            if postings_list:
+                term_postings.setdefault(query_term, []).extend(postings_list)
+
+    # For each query term (in query order, skipping the terms without postings), compute a product with documents
+    # terms and add to the score
     for query_term, query_term_frequency in query_frequencies.items():
-        position = dictionary.get(query_term)
-        if position is None:
+        if query_term not in term_postings:
             continue
-        postings_file.seek(position)
-        data = postings_file.read()
-        postings_list = pickle.loads(data)
+        postings_list = term_postings[query_term]
         docFrequency = len(postings_list)
         # calculate w(t, q)
-        # query scheme: lpn
-        wq = max(0, math.log10((all_docIds_length - docFrequency) / docFrequency)) * (
-                    1 + math.log10(query_term_frequency))
+        wq = query_weight(query_term_frequency, docFrequency, all_docIds_length)
 
         for node in postings_list:
             frequencies = node[1]
@@ -103,25 +197,67 @@ def cosine_similarity(query, dictionary_path, postings_path):
     return sorted(result, key=lambda x: -x[1])
 
 
-def search_and_write(queries_path, output_path, dictionary_path, postings_path):
+# Rank as rank does, a term (in a segment) at a time with a scatter-add of its weights into the dense scores of the
+# documents (see common/dense.py). Ties keep the order in which the documents were first scored, as the stable sort
+# of rank does.
+def rank_dense(query_frequencies, fetched, all_docIds_length, ordinals):
+    doc_frequencies = dict()
+    for segment_postings in fetched:
+        for query_term in query_frequencies:
+            if query_term in segment_postings:
+                doc_frequencies[query_term] = doc_frequencies.get(query_term, 0) + len(segment_postings[query_term][0])
+
+    accumulator = dense.Accumulator(ordinals.size)
+    for query_term in query_frequencies:
+        if not doc_frequencies.get(query_term):
+            continue
+        wq = query_weight(query_frequencies[query_term], doc_frequencies[query_term], all_docIds_length)
+        for segment_postings in fetched:
+            if query_term in segment_postings:
+                term_ordinals, tfds = segment_postings[query_term]
+                accumulator.add(term_ordinals, tfds * wq)
+
+    candidates = accumulator.candidates(ordinals.live)
+    return dense.ranking(accumulator.scores[candidates], ordinals.docIds[candidates],
+                         accumulator.first_scored[candidates])
+
+
+def format_result(result):
+    return ' '.join([str(r[0]) for r in result])
+
+
+# Batch execution of a queries file: all the queries are analyzed up front, then the postings lists of all their
+# terms are fetched and decoded once per segment (in offset order) and shared by the queries, every list being
+# dropped when the last query reading it is done
+def search_and_write(queries_path, output_path, segments, all_docIds_length, ordinals):
     input_queries_file = open(queries_path, 'r')
     output_file = open(output_path, 'w')
     queries = input_queries_file.read().splitlines()
+    batch_frequencies = [query_frequencies_of(q) for q in queries]
+    shared = []
+    for segment, (dictionary, postings_file, _) in enumerate(segments):
+        postings = SharedPostings()
+        postings.load(postings_file, [term_extents(query_frequencies, dictionary)
+                                      for query_frequencies in batch_frequencies],
+                      term_decoder(segments, ordinals, segment))
+        shared.append(postings)
+
     lines = []
-    for q in queries:
-        result_str = ''
-        result = cosine_similarity(query=q, dictionary_path=dictionary_path, postings_path=postings_path)
-        if len(result) > 0:
-            result_str = ' '.join([str(r[0]) for r in result])
-        lines.append(result_str + '\n')
+    for query_frequencies in batch_frequencies:
+        result = rank(query_frequencies, shared, all_docIds_length, ordinals)
+        lines.append(format_result(result) + '\n')
+        for postings in shared:
+            postings.release(query_frequencies)
 
     output_file.writelines(lines)
 
 
-dictionary_file = postings_file = file_of_queries = output_file_of_results = None
+dictionary_file = postings_file = file_of_queries = file_of_output = socket_path = None
+serve = False
+backend = 'python'
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:')
+    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:t:su:b:')
 except getopt.GetoptError:
     usage()
     sys.exit(2)
@@ -135,13 +271,27 @@ for o, a in opts:
         file_of_queries = a
     elif o == '-o':
         file_of_output = a
+    elif o == '-t':  # tokenizer used by index.py
+        analyzer = Analyzer(tokenizer=a, alphanumeric=True, excluded=('AND',))
+    elif o == '-s':  # serve queries from stdin
+        serve = True
+    elif o == '-u':  # serve queries on a Unix socket
+        serve = True
+        socket_path = a
+    elif o == '-b':  # scoring backend
+        backend = a
     else:
         assert False, "unhandled option"
 
-if dictionary_file == None or postings_file == None or file_of_queries == None or file_of_output == None:
+if dictionary_file == None or postings_file == None or (not serve and (file_of_queries == None or file_of_output == None)) \
+        or backend not in BACKENDS:
     usage()
     sys.exit(2)
 
+if backend == 'numpy':
+    # NumPy is only needed by the dense scoring backend
+    from common import dense
+
 
 def run_search(dict_file, postings_file, queries_file, results_file):
     """
@@ -149,9 +299,37 @@ def run_search(dict_file, postings_file, queries_file, results_file):
     perform searching on the given queries file and output the results to a file
     """
     print('running search on the queries...')
-    search_and_write(queries_path=queries_file, dictionary_path=dict_file, postings_path=postings_file,
-                     output_path=results_file)
+    segments, all_docIds_length, ordinals = load_index(dict_file, postings_file)
+    search_and_write(queries_path=queries_file, segments=segments, all_docIds_length=all_docIds_length,
+                     ordinals=ordinals, output_path=results_file)
+    close_index(segments)
     print('DONE!')
 
 
-run_search(dictionary_file, postings_file, file_of_queries, file_of_output)
+def run_server(dict_file, postings_file, socket_path=None):
+    """
+    load the index once and answer queries (one per line) from stdin,
+    or from connections to the given Unix socket.
+    The index is reloaded when segments are added, merged or have documents deleted.
+    """
+    index = {'version': index_version(), 'index': load_index(dict_file, postings_file)}
+
+    def answer(query):
+        version = index_version()
+        if version != index['version']:
+            close_index(index['index'][0])
+            index['version'] = version
+            index['index'] = load_index(dict_file, postings_file)
+        return format_result(cosine_similarity(query, *index['index']))
+
+    if socket_path is None:
+        serve_stdin(answer)
+    else:
+        serve_unix_socket(socket_path, answer)
+    close_index(index['index'][0])
+
+
+if serve:
+    run_server(dictionary_file, postings_file, socket_path)
+else:
+    run_search(dictionary_file, postings_file, file_of_queries, file_of_output)
@@ -0,0 +1,180 @@
+import getopt
+import os
+import re
+import sys
+from collections import Counter
+from functools import lru_cache
+
+from nltk import sent_tokenize, word_tokenize
+from nltk.stem.porter import PorterStemmer
+
+# Text analysis shared by the retrieval projects: tokenization, then Porter stemming of the tokens.
+#
+# Two tokenizers are available:
+# - 'nltk': Punkt sentence splitting, then the NLTK word tokenizer (an improved Treebank tokenizer) on every sentence,
+#   exactly the tokens of word_tokenize
+# - 'regex': a single pass of regular expressions reproducing the Treebank rules which decide whether an
+#   alphanumeric token comes out of a word (punctuation split off, contractions, commas and colons, final periods).
+#   It only yields alphanumeric tokens, and the end of a sentence is guessed from the next character instead of
+#   Punkt, so its output can differ on abbreviations; validate it on a collection with `python3 analysis.py`.
+#
+# The vocabulary of a collection is very repetitive, so stems are memoized in a bounded LRU cache (STEM_CACHE words)
+# shared by all the analyzers of a process. Tokens are lowercased before stemming, as the stemmer does.
+
+STEM_CACHE = 1 << 17
+
+# Version of the analysis output, to change whenever the terms of a text change (see common/token_cache.py)
+ANALYSIS_VERSION = 1
+
+TOKENIZERS = ('nltk', 'regex')
+
+stemmer = PorterStemmer()
+
+
+@lru_cache(maxsize=STEM_CACHE)
+def stem(word):
+    return stemmer.stem(word)
+
+
+def nltk_tokens(text):
+    tokens = []
+    for sentence in sent_tokenize(text):
+        # the sentence is already split, word_tokenize would run Punkt on it again
+        tokens.extend(word_tokenize(sentence, preserve_line=True))
+    return tokens
+
+
+# Characters always split off by the Treebank rules, which never belong to an alphanumeric token
+SEPARATORS = '\\s\\[\\](){}<>;@#$%&?!*"`«»“”‘’„‒-―'
+CHUNK = re.compile(f'[^{SEPARATORS}]+')
+# Ellipses and double dashes are split off too
+SPLIT_MARKS = re.compile(r'\.{2,}|--')
+# Commas and colons are split off, unless followed by a digit (1,000 and 10:30 stay whole)
+COMMA = re.compile(r'[,:](?!\d)')
+# Contractions split off the end of a word
+CONTRACTION = re.compile(r"(?i)^(.*?[^' ])(n't|'s|'m|'d|'ll|'re|'ve|')$")
+# Leading quote split off, unless it starts a contraction
+LEADING_QUOTE = re.compile(r"(?i)^'(?!(?:re|ve|ll|m|t|s|d|n)\b)(?=\w)")
+# Words split in two by the Treebank rules
+SPLIT_WORDS = {'cannot': 3, 'gimme': 3, 'gonna': 3, 'gotta': 3, 'lemme': 3, 'wanna': 3}
+# A final period ends the sentence (and is split off) when followed by the end of the text or an uppercase letter
+SENTENCE_END = re.compile(r'[\s"\')\]»”’]*(?:$|[A-Z0-9"“‘(\[])')
+
+
+def regex_tokens(text):
+    text = SPLIT_MARKS.sub(lambda match: ' ' * len(match.group()), text)
+    tokens = []
+    for chunk in CHUNK.finditer(text):
+        pieces = COMMA.split(chunk.group())
+        for i, piece in enumerate(pieces):
+            if piece.endswith('.'):
+                if i == len(pieces) - 1 and SENTENCE_END.match(text, chunk.end()):
+                    piece = piece[:-1]
+                else:
+                    continue
+            if piece.startswith("'"):
+                piece = LEADING_QUOTE.sub('', piece)
+            contraction = CONTRACTION.match(piece)
+            if contraction is not None:
+                piece = contraction.group(1)
+            if not piece.isalnum():
+                continue
+            split = SPLIT_WORDS.get(piece.lower())
+            if split is None:
+                tokens.append(piece)
+            else:
+                tokens.append(piece[:split])
+                tokens.append(piece[split:])
+    return tokens
+
+
+class Analyzer:
+    """
+    tokenize texts with the given tokenizer ('nltk' or 'regex'), drop the excluded tokens (compared before
+    lowercasing) and, if alphanumeric is set, the tokens which are not alphanumeric, then stem the lowercased tokens
+    """
+
+    def __init__(self, tokenizer='nltk', alphanumeric=False, excluded=()):
+        if tokenizer not in TOKENIZERS:
+            raise Exception(f'Unknown tokenizer {tokenizer!r}, expected one of {", ".join(TOKENIZERS)}')
+        self.tokenize = nltk_tokens if tokenizer == 'nltk' else regex_tokens
+        self.alphanumeric = alphanumeric
+        self.excluded = frozenset(excluded)
+        # identifies the analysis settings, the terms of a text only depend on the text and the key
+        self.key = f'v{ANALYSIS_VERSION}-{tokenizer}-{int(alphanumeric)}-{",".join(sorted(self.excluded))}'
+
+    def tokens(self, text):
+        excluded = self.excluded
+        alphanumeric = self.alphanumeric
+        return [token.lower() for token in self.tokenize(text)
+                if token not in excluded and (not alphanumeric or token.isalnum())]
+
+    def analyze(self, text):
+        return [stem(token) for token in self.tokens(text)]
+
+    # Analyze many texts at once: every distinct token of the batch is stemmed once
+    def analyze_batch(self, texts):
+        batch_tokens = [self.tokens(text) for text in texts]
+        stems = {token: stem(token) for token in set().union(*batch_tokens)}
+        return [[stems[token] for token in tokens] for tokens in batch_tokens]
+
+
+# Compare the terms of the regex tokenizer with the terms of the NLTK tokenizer on the given texts:
+# the share of the NLTK terms also found by the regex tokenizer (per document, with multiplicity),
+# the numbers of terms and the most frequent differences
+def validate_regex(texts, excluded=()):
+    nltk_analyzer = Analyzer('nltk', alphanumeric=True, excluded=excluded)
+    regex_analyzer = Analyzer('regex', alphanumeric=True, excluded=excluded)
+    nltk_count = regex_count = matched = 0
+    missing = Counter()
+    extra = Counter()
+    for text in texts:
+        expected = Counter(nltk_analyzer.analyze(text))
+        found = Counter(regex_analyzer.analyze(text))
+        nltk_count += sum(expected.values())
+        regex_count += sum(found.values())
+        matched += sum((expected & found).values())
+        missing.update(expected - found)
+        extra.update(found - expected)
+    return {
+        'agreement': matched / nltk_count if nltk_count else 1.0,
+        'nltk_terms': nltk_count,
+        'regex_terms': regex_count,
+        'missing': missing.most_common(10),
+        'extra': extra.most_common(10),
+    }
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -i directory-of-documents")
+
+
+if __name__ == '__main__':
+    input_directory = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-i':  # directory of the documents to validate the regex tokenizer on
+            input_directory = a
+        else:
+            assert False, "unhandled option"
+
+    if input_directory == None:
+        usage()
+        sys.exit(2)
+
+    def read_documents(directory):
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name), 'r') as handle:
+                yield handle.read()
+
+    report = validate_regex(read_documents(input_directory))
+    print(f"agreement: {report['agreement']:.4%} ({report['regex_terms']} regex terms, "
+          f"{report['nltk_terms']} nltk terms)")
+    print(f"missing from regex: {report['missing']}")
+    print(f"extra in regex: {report['extra']}")
@@ -0,0 +1,93 @@
+import numpy as np
+
+# Dense score accumulation for the ranked retrieval engines (search.py -b numpy).
+#
+# The docIds of all the segments of an index are remapped to dense ordinals: the ordinals of a segment are the ranks
+# of its (sorted) docIds, after the ordinals of the segments before it. A postings list then becomes parallel arrays
+# of ordinals and weights, and scoring a query term is one vectorized scatter-add of its weights into an array of
+# scores indexed by ordinal, instead of one dictionary update per posting. The best documents are selected with a
+# partial sort (argpartition) of the scores.
+#
+# Scores are accumulated as 64 bit floats, term by term and segment by segment as the Python engines do, so that every
+# document gets exactly the same score and the rankings are the same, ties included.
+
+ORDINAL = np.int64
+
+
+# Ordinals of the docIds of all the segments, and the docId and liveness (not deleted) of every ordinal
+class DocumentOrdinals:
+    def __init__(self, segment_docIds, segment_deleted):
+        self.offsets = []
+        self.segment_docIds = []
+        offset = 0
+        for docIds in segment_docIds:
+            docIds = np.unique(np.asarray(docIds, dtype=ORDINAL))
+            self.offsets.append(offset)
+            self.segment_docIds.append(docIds)
+            offset += len(docIds)
+        self.size = offset
+        self.docIds = np.concatenate(self.segment_docIds) if self.segment_docIds else np.empty(0, dtype=ORDINAL)
+        self.live = np.ones(self.size, dtype=bool)
+        for segment, deleted in enumerate(segment_deleted):
+            if deleted:
+                self.live[self.of(segment, [docId for docId in deleted if self.contains(segment, docId)])] = False
+
+    def contains(self, segment, docId):
+        docIds = self.segment_docIds[segment]
+        position = np.searchsorted(docIds, docId)
+        return position < len(docIds) and docIds[position] == docId
+
+    # Ordinals of docIds of a segment (all in the segment)
+    def of(self, segment, docIds):
+        return self.offsets[segment] + np.searchsorted(self.segment_docIds[segment], np.asarray(docIds, dtype=ORDINAL))
+
+    def live_count(self, ordinals):
+        return int(np.count_nonzero(self.live[ordinals]))
+
+
+# Weights of a postings list as an array (without copying an array.array)
+def as_array(weights):
+    return np.asarray(weights)
+
+
+# Scores of the documents for a query, by ordinal. The documents with a posting of a query term are marked
+# (a document can score 0), and so is the order in which they were first scored, for rankings breaking ties by it.
+class Accumulator:
+    def __init__(self, size):
+        self.scores = np.zeros(size)
+        self.scored = np.zeros(size, dtype=bool)
+        self.first_scored = np.zeros(size, dtype=ORDINAL)
+        self.count = 0
+
+    # The ordinals of a postings list are distinct, so an indexed add is a scatter-add (no np.add.at needed)
+    def add(self, ordinals, contributions):
+        new = ordinals[~self.scored[ordinals]]
+        self.first_scored[new] = np.arange(self.count, self.count + len(new))
+        self.count += len(new)
+        self.scores[ordinals] += contributions
+        self.scored[ordinals] = True
+
+    # Ordinals of the scored documents which are not deleted
+    def candidates(self, live):
+        return np.flatnonzero(self.scored & live)
+
+
+# The k best (score, docId) pairs, by decreasing score then increasing docId. Among the documents tied with the k-th
+# score, the ones with the largest docIds are kept, as a heap of (score, docId) pairs does.
+def top_documents(scores, docIds, k):
+    if len(scores) > k:
+        kth = scores[np.argpartition(scores, len(scores) - k)[len(scores) - k]]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)
+        ties = ties[np.argsort(docIds[ties], kind='stable')[len(ties) - (k - len(above)):]]
+        selected = np.concatenate((above, ties))
+        scores = scores[selected]
+        docIds = docIds[selected]
+    order = np.lexsort((docIds, -scores))
+    return list(zip(scores[order].tolist(), docIds[order].tolist()))
+
+
+# All the (docId, score) pairs, by decreasing score then by the order in which the documents were first scored
+def ranking(scores, docIds, first_scored):
+    order = np.lexsort((first_scored, -scores))
+    return list(zip(docIds[order].tolist(), scores[order].tolist()))
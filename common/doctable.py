@@ -0,0 +1,129 @@
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+
+# Columnar document table of an index: one row per document, in ascending docId order (the row number is the ordinal
+# of the document), and fixed-width columns (docId, lengths, term frequency statistics, ...) stored one after the
+# other in a single file. The file is memory-mapped and every column is a typed view of its bytes, so opening a
+# table only reads its header and a lookup by ordinal is a single indexed read, whatever the number of documents.
+# Columns of strings (court names) are stored as ids into a small string table.
+#
+# Layout:
+# - header: magic, number of rows, number of columns, number of strings
+# - column descriptors: name (16 bytes), array typecode, offset of the column data
+# - column data, each column aligned to 8 bytes
+# - strings: length (4 bytes) and UTF-8 bytes of every string
+
+TABLE_FILE = 'documents.table'
+
+MAGIC = b'DOCTABL1'
+HEADER = struct.Struct('<8sQII')
+COLUMN = struct.Struct('<16scQ')
+STRING_LENGTH = struct.Struct('<I')
+ALIGNMENT = 8
+
+
+def table_path(directory):
+    return os.path.join(directory, TABLE_FILE)
+
+
+def aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+# Write a table: columns is a list of (name, array typecode, values of the rows), strings the string table of the
+# string columns
+def write_table(path, columns, strings=()):
+    rows = len(columns[0][2]) if columns else 0
+    data = [array(typecode, values) for _, typecode, values in columns]
+    for (name, _, _), column_data in zip(columns, data):
+        if len(column_data) != rows:
+            raise Exception(f'Column {name!r} has {len(column_data)} rows instead of {rows}')
+
+    offset = HEADER.size + COLUMN.size * len(columns)
+    offsets = []
+    for column_data in data:
+        offset = aligned(offset)
+        offsets.append(offset)
+        offset += len(column_data) * column_data.itemsize
+
+    with open(path + '.tmp', 'wb') as handle:
+        handle.write(HEADER.pack(MAGIC, rows, len(columns), len(strings)))
+        for (name, typecode, _), column_offset in zip(columns, offsets):
+            handle.write(COLUMN.pack(name.encode('utf-8'), typecode.encode('ascii'), column_offset))
+        for column_data, column_offset in zip(data, offsets):
+            handle.write(b'\0' * (column_offset - handle.tell()))
+            handle.write(column_data.tobytes())
+        for string in strings:
+            encoded = string.encode('utf-8')
+            handle.write(STRING_LENGTH.pack(len(encoded)) + encoded)
+    os.replace(path + '.tmp', path)
+
+
+class DocumentTable:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.data)
+        magic, self.rows, column_count, string_count = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise Exception(f'{path!r} is not a document table')
+
+        self.columns = {}
+        end = HEADER.size + COLUMN.size * column_count
+        for i in range(column_count):
+            name, typecode, offset = COLUMN.unpack_from(self.data, HEADER.size + COLUMN.size * i)
+            typecode = typecode.decode('ascii')
+            size = self.rows * array(typecode).itemsize
+            self.columns[name.rstrip(b'\0').decode('utf-8')] = self.view[offset:offset + size].cast(typecode)
+            end = max(end, offset + size)
+
+        self.strings = []
+        for _ in range(string_count):
+            length, = STRING_LENGTH.unpack_from(self.data, end)
+            self.strings.append(bytes(self.data[end + STRING_LENGTH.size:end + STRING_LENGTH.size + length]).decode('utf-8'))
+            end += STRING_LENGTH.size + length
+
+    def __len__(self):
+        return self.rows
+
+    def column(self, name):
+        return self.columns[name]
+
+    def value(self, name, ordinal):
+        return self.columns[name][ordinal]
+
+    # Value of a string column
+    def string(self, name, ordinal):
+        return self.strings[self.columns[name][ordinal]]
+
+    @property
+    def docIds(self):
+        return self.columns['docId']
+
+    # Ordinal of a docId (binary search in the docId column), None if it isn't in the table
+    def ordinal(self, docId):
+        docIds = self.columns['docId']
+        position = bisect_left(docIds, docId)
+        if position < len(docIds) and docIds[position] == docId:
+            return position
+        return None
+
+    def close(self):
+        for column in self.columns.values():
+            column.release()
+        self.view.release()
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_table(directory):
+    return DocumentTable(table_path(directory))
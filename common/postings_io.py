@@ -0,0 +1,90 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Postings are fetched with positioned reads limited to each term's byte extent
+# (position, length) recorded in the dictionary. Extents are sorted by offset and nearby
+# ones are coalesced, so a query touches every region of the postings file at most once
+# and always in file order.
+
+# Extents separated by fewer bytes than this are fetched with a single read
+COALESCE_GAP = 4096
+# Number of coalesced reads that may be in flight ahead of the consumer
+READ_AHEAD = 4
+
+
+def coalesce_extents(extents, max_gap=COALESCE_GAP):
+    # extents: list of (key, position, length) -> list of (start, end, extents in the range)
+    groups = []
+    for extent in sorted(extents, key=lambda e: e[1]):
+        key, position, length = extent
+        if groups and position - groups[-1][1] <= max_gap:
+            groups[-1][1] = max(groups[-1][1], position + length)
+            groups[-1][2].append(extent)
+        else:
+            groups.append([position, position + length, [extent]])
+    return groups
+
+
+def read_postings(postings_file, extents):
+    # Yield (key, data) for every extent in offset order. The coalesced reads are issued from
+    # a background thread up to READ_AHEAD reads ahead, so they overlap with decoding and scoring
+    # of the postings that were already yielded.
+    fd = postings_file.fileno()
+    groups = coalesce_extents(extents)
+    if not groups:
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque()
+        next_group = 0
+        while next_group < len(groups) or pending:
+            while next_group < len(groups) and len(pending) < READ_AHEAD:
+                start, end, group_extents = groups[next_group]
+                pending.append((start, group_extents, executor.submit(os.pread, fd, end - start, start)))
+                next_group += 1
+
+            start, group_extents, future = pending.popleft()
+            data = future.result()
+            for key, position, length in group_extents:
+                yield key, data[position - start:position - start + length]
+
+
+# Postings lists shared by the queries of a batch: every postings list read by any query of the batch is fetched
+# and decoded once, in offset order with the other lists, and dropped when the last query reading it is done.
+class SharedPostings:
+    def __init__(self):
+        self.postings = {}
+        self.consumers = {}
+
+    # extents_by_query: the (key, position, length) extents read by every query of the batch,
+    # decode(key, data) returns the decoded postings list
+    def load(self, postings_file, extents_by_query, decode):
+        extents = {}
+        for query_extents in extents_by_query:
+            for extent in query_extents:
+                extents[extent[0]] = extent
+                self.consumers[extent[0]] = self.consumers.get(extent[0], 0) + 1
+        for key, data in read_postings(postings_file, list(extents.values())):
+            self.postings[key] = decode(key, data)
+
+    def __getitem__(self, key):
+        return self.postings[key]
+
+    def __contains__(self, key):
+        return key in self.postings
+
+    def get(self, key, default=None):
+        return self.postings.get(key, default)
+
+    # A query reading the given keys is done
+    def release(self, keys):
+        for key in keys:
+            consumers = self.consumers.get(key)
+            if consumers is None:
+                continue
+            if consumers == 1:
+                del self.consumers[key]
+                del self.postings[key]
+            else:
+                self.consumers[key] = consumers - 1
@@ -0,0 +1,254 @@
+import fcntl
+import heapq
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+from contextlib import contextmanager
+from itertools import groupby
+
+from common.termdict import TermDictionary, TermDictionaryWriter
+
+# Incremental indexing: the index built from the whole collection (the base index) is extended with segments.
+# A segment is a small index of newly added documents, stored with the same files as the base index
+# (dictionary.txt, postings.txt and the auxiliary files of the engine) in its own directory segments/{name}.
+# The manifest lists the live segments, and search fans out across the base index and all of them.
+#
+# Segments are compacted in the background with a tiered merge policy: segments are grouped in tiers by their
+# number of documents (tier t holds segments of MERGE_FACTOR^t up to MERGE_FACTOR^(t+1) documents), and as soon as
+# a tier holds MERGE_FACTOR segments, they are merged into a single segment of a higher tier.
+# The base index is never merged: a full rebuild replaces it and removes all the segments.
+#
+# Documents are deleted with tombstones: every index (the base index or a segment) may have a deletions bitmap
+# (bit docId is set for every deleted docId of the index) in its directory, and search skips the deleted docIds.
+# The postings of deleted documents are dropped when their segment is merged, or by a full rebuild of the base index.
+# Updating documents is deleting them, then adding their new versions as a new segment.
+
+SEGMENTS_DIR = 'segments'
+MANIFEST_PATH = os.path.join(SEGMENTS_DIR, 'manifest.json')
+MANIFEST_LOCK_PATH = os.path.join(SEGMENTS_DIR, 'manifest.lock')
+MERGE_LOCK_PATH = os.path.join(SEGMENTS_DIR, 'merge.lock')
+
+DICTIONARY_FILE = 'dictionary.txt'
+POSTINGS_FILE = 'postings.txt'
+DELETIONS_FILE = 'deletions.bitmap'
+
+MERGE_FACTOR = 4
+
+
+def segment_directory(name):
+    return os.path.join(SEGMENTS_DIR, name)
+
+
+# Dictionary and postings paths of the index stored in the directory
+def segment_files(directory):
+    return os.path.join(directory, DICTIONARY_FILE), os.path.join(directory, POSTINGS_FILE)
+
+
+# The manifest is only read and written with the manifest lock held, and replaced atomically
+@contextmanager
+def manifest_lock():
+    os.makedirs(SEGMENTS_DIR, exist_ok=True)
+    with open(MANIFEST_LOCK_PATH, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def read_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return {'next': 1, 'segments': []}
+    with open(MANIFEST_PATH, 'r') as handle:
+        return json.load(handle)
+
+
+def write_manifest(manifest):
+    with open(MANIFEST_PATH + '.tmp', 'w') as handle:
+        json.dump(manifest, handle)
+    os.replace(MANIFEST_PATH + '.tmp', MANIFEST_PATH)
+
+
+# Version of the segments, changed by every update of the manifest (new segments, merges and deletions),
+# so that a resident index can tell when to reload
+def index_version():
+    try:
+        status = os.stat(MANIFEST_PATH)
+    except FileNotFoundError:
+        return None
+    return status.st_ino, status.st_mtime_ns
+
+
+# Remove all the segments and the deletions of the base index, used by a full rebuild of the base index
+def reset_segments():
+    shutil.rmtree(SEGMENTS_DIR, ignore_errors=True)
+    if os.path.exists(DELETIONS_FILE):
+        os.remove(DELETIONS_FILE)
+
+
+# Reserve a name and a directory for a new segment, which becomes searchable once registered
+def create_segment():
+    with manifest_lock():
+        manifest = read_manifest()
+        name = str(manifest['next'])
+        manifest['next'] += 1
+        write_manifest(manifest)
+    directory = segment_directory(name)
+    os.makedirs(directory)
+    return name, directory
+
+
+def register_segment(name, documents):
+    with manifest_lock():
+        manifest = read_manifest()
+        manifest['segments'].append({'name': name, 'documents': documents})
+        write_manifest(manifest)
+
+
+# Dictionary path, postings path and directory (of the auxiliary files) of the base index and of all live segments
+def index_segments(dictionary_path, postings_path):
+    segments = []
+    if os.path.exists(MANIFEST_PATH):
+        with manifest_lock():
+            segments = read_manifest()['segments']
+    return [(dictionary_path, postings_path, '.')] + [
+        segment_files(segment_directory(segment['name'])) + (segment_directory(segment['name']),)
+        for segment in segments]
+
+
+# Deleted docIds of the index stored in the directory
+def read_deletions(directory):
+    path = os.path.join(directory, DELETIONS_FILE)
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'rb') as handle:
+        data = handle.read()
+    return {index << 3 | bit for index, value in enumerate(data) if value for bit in range(8) if value >> bit & 1}
+
+
+def write_deletions(directory, docIds):
+    data = bytearray(max(docIds) // 8 + 1 if docIds else 0)
+    for docId in docIds:
+        data[docId >> 3] |= 1 << (docId & 7)
+    path = os.path.join(directory, DELETIONS_FILE)
+    with open(path + '.tmp', 'wb') as handle:
+        handle.write(data)
+    os.replace(path + '.tmp', path)
+
+
+# Mark the docIds as deleted in the indexes containing them (the base index and the live segments), where
+# index_docIds(directory) returns the docIds of the index stored in the directory.
+# Returns the number of documents deleted.
+def delete_documents(docIds, index_docIds):
+    docIds = set(docIds)
+    deleted = 0
+    with manifest_lock():
+        manifest = read_manifest()
+        for directory in ['.'] + [segment_directory(segment['name']) for segment in manifest['segments']]:
+            contained = index_docIds(directory)
+            deletions = read_deletions(directory)
+            found = {docId for docId in docIds if docId in contained} - deletions
+            if found:
+                write_deletions(directory, deletions | found)
+                deleted += len(found)
+        # rewriting the manifest changes the version seen by resident indexes
+        write_manifest(manifest)
+    return deleted
+
+
+def tier(segment):
+    return int(math.log(max(1, segment['documents']), MERGE_FACTOR))
+
+
+# The oldest MERGE_FACTOR segments of the lowest tier holding at least MERGE_FACTOR segments
+def select_merge(segments):
+    tiers = {}
+    for segment in segments:
+        tiers.setdefault(tier(segment), []).append(segment)
+    for t in sorted(tiers):
+        if len(tiers[t]) >= MERGE_FACTOR:
+            return tiers[t][:MERGE_FACTOR]
+    return None
+
+
+def tagged_items(dictionary, number):
+    for term, value in dictionary.items():
+        yield term, number, value
+
+
+# Merge the dictionaries and postings of several indexes with a k-way merge of their (sorted) terms.
+# merge_postings receives the (postings data, dictionary value) of a term in every index containing it,
+# and returns the merged postings data with the values stored after its position and size in the dictionary,
+# or None to drop the term (when all its postings are of deleted documents).
+def merge_dictionaries(sources, dictionary_path, postings_path, value_format, merge_postings):
+    dictionaries = [TermDictionary(source_dictionary) for source_dictionary, _ in sources]
+    postings_fds = [os.open(source_postings, os.O_RDONLY) for _, source_postings in sources]
+    dictionary = TermDictionaryWriter(dictionary_path, value_format)
+
+    with open(postings_path, 'wb') as postings_file:
+        entries = heapq.merge(*[tagged_items(d, number) for number, d in enumerate(dictionaries)])
+        for term, group in groupby(entries, key=lambda entry: entry[0]):
+            term_postings = [(os.pread(postings_fds[number], value[1], value[0]), value) for _, number, value in group]
+            merged = merge_postings(term_postings)
+            if merged is None:
+                continue
+            data, values = merged
+            position = postings_file.tell()
+            postings_file.write(data)
+            dictionary.add(term, (position, len(data)) + values)
+
+    dictionary.close()
+    for d in dictionaries:
+        d.close()
+    for fd in postings_fds:
+        os.close(fd)
+
+
+# Merge segments while the policy selects some. merge_segments(directories, directory, deleted) builds the index of
+# the given segment directories in a new segment directory, without the deleted docIds. Only one merging process
+# runs at a time: it picks up the segments added while it runs, other processes return immediately.
+def run_merges(merge_segments):
+    os.makedirs(SEGMENTS_DIR, exist_ok=True)
+    with open(MERGE_LOCK_PATH, 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        while True:
+            with manifest_lock():
+                merged = select_merge(read_manifest()['segments'])
+                if merged is not None:
+                    directories = [segment_directory(segment['name']) for segment in merged]
+                    deleted = set().union(*map(read_deletions, directories))
+            if merged is None:
+                break
+
+            name, directory = create_segment()
+            merge_segments(directories, directory, deleted)
+
+            merged_names = {segment['name'] for segment in merged}
+            with manifest_lock():
+                # documents deleted from the merged segments while merging are deleted from the new segment
+                late_deletions = set().union(*map(read_deletions, directories)) - deleted
+                if late_deletions:
+                    write_deletions(directory, late_deletions)
+                manifest = read_manifest()
+                manifest['segments'] = [segment for segment in manifest['segments']
+                                        if segment['name'] not in merged_names]
+                manifest['segments'].append({'name': name,
+                                             'documents': sum(segment['documents'] for segment in merged)
+                                                          - len(deleted)})
+                write_manifest(manifest)
+            for merged_name in merged_names:
+                shutil.rmtree(segment_directory(merged_name), ignore_errors=True)
+
+
+# Run the merges in a detached process (the given index script with the given arguments), so that adding documents
+# returns as soon as the new segment is searchable
+def start_background_merge(script_path, args):
+    subprocess.Popen([sys.executable, script_path] + args, start_new_session=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
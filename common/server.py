@@ -0,0 +1,40 @@
+import os
+import socketserver
+import sys
+
+# Line protocol for serving queries from a resident index: one query per line in,
+# one result line out (in the same format as a line of the results file).
+# A query that fails gets an empty result line, with the error reported on stderr.
+
+
+def answer_line(answer, query):
+    try:
+        return answer(query) + '\n'
+    except Exception as e:
+        print(f'query {query!r} failed: {e}', file=sys.stderr)
+        return '\n'
+
+
+def serve_stdin(answer):
+    for line in sys.stdin:
+        sys.stdout.write(answer_line(answer, line.rstrip('\n')))
+        sys.stdout.flush()
+
+
+def serve_unix_socket(socket_path, answer):
+    class QueryHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                self.wfile.write(answer_line(answer, line.decode('utf-8').rstrip('\n')).encode('utf-8'))
+                self.wfile.flush()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socketserver.UnixStreamServer(socket_path, QueryHandler) as server:
+        print(f'serving queries on {socket_path}', file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
@@ -0,0 +1,166 @@
+import mmap
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+
+# On-disk term dictionary: sorted terms mapped to fixed size tuples of integers (e.g. postings position and size).
+#
+# The terms are stored in blocks of BLOCK_SIZE terms. Inside a block, every term is front coded against the
+# previous one: the length of their common prefix, the remaining suffix and the value of the term.
+# The first term of every block is stored whole in the block index at the end of the file, which is the only
+# part read into memory on open; the blocks are read through a memory map, so opening the dictionary doesn't
+# depend on the size of the vocabulary. A lookup is a binary search in the block index and the decoding of one block.
+#
+# Layout: header | blocks | block index (offset, first term size, first term for every block)
+
+MAGIC = b'TDIC'
+HEADER = struct.Struct('<4s8sIIQ')  # magic, value format, number of terms, number of blocks, block index offset
+BLOCK_ENTRY = struct.Struct('<HH')  # common prefix size, suffix size
+INDEX_ENTRY = struct.Struct('<QH')  # block offset, first term size
+
+BLOCK_SIZE = 16
+BLOCK_CACHE = 256  # decoded blocks kept in memory
+
+
+class TermDictionaryWriter:
+    def __init__(self, path, value_format):
+        self.file = open(path, 'wb')
+        self.value_struct = struct.Struct('<' + value_format)
+        self.value_format = value_format
+        self.file.write(bytes(HEADER.size))
+        self.block_offsets = []
+        self.first_terms = []
+        self.previous = None
+        self.count = 0
+
+    def add(self, term, value):
+        encoded = term.encode('utf-8')
+        if self.previous is not None and encoded <= self.previous:
+            raise Exception(f'Terms must be added in sorted order: {term!r}')
+
+        shared = 0
+        if self.count % BLOCK_SIZE == 0:
+            self.block_offsets.append(self.file.tell())
+            self.first_terms.append(encoded)
+        else:
+            limit = min(len(encoded), len(self.previous))
+            while shared < limit and encoded[shared] == self.previous[shared]:
+                shared += 1
+
+        self.file.write(BLOCK_ENTRY.pack(shared, len(encoded) - shared))
+        self.file.write(encoded[shared:])
+        self.file.write(self.value_struct.pack(*value))
+        self.previous = encoded
+        self.count += 1
+
+    def close(self):
+        index_offset = self.file.tell()
+        for offset, first_term in zip(self.block_offsets, self.first_terms):
+            self.file.write(INDEX_ENTRY.pack(offset, len(first_term)))
+            self.file.write(first_term)
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, self.value_format.encode('ascii'), self.count, len(self.block_offsets),
+                                    index_offset))
+        self.file.close()
+
+
+class TermDictionary:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, value_format, self.count, block_count, index_offset = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise Exception(f'{path} is not a term dictionary')
+        self.value_struct = struct.Struct('<' + value_format.rstrip(b'\0').decode('ascii'))
+        self.index_offset = index_offset
+
+        self.block_offsets = array('Q')
+        self.first_terms = []
+        position = index_offset
+        for _ in range(block_count):
+            offset, size = INDEX_ENTRY.unpack_from(self.data, position)
+            position += INDEX_ENTRY.size
+            self.block_offsets.append(offset)
+            self.first_terms.append(self.data[position:position + size].decode('utf-8'))
+            position += size
+
+        self.block = lru_cache(maxsize=BLOCK_CACHE)(self.decode_block)
+
+    # Terms and values of a block
+    def decode_block(self, block):
+        data = self.data
+        value_struct = self.value_struct
+        position = self.block_offsets[block]
+        count = min(BLOCK_SIZE, self.count - block * BLOCK_SIZE)
+        terms = []
+        values = []
+        previous = b''
+        for _ in range(count):
+            shared, size = BLOCK_ENTRY.unpack_from(data, position)
+            position += BLOCK_ENTRY.size
+            term = previous[:shared] + data[position:position + size]
+            position += size
+            terms.append(term.decode('utf-8'))
+            values.append(value_struct.unpack_from(data, position))
+            position += value_struct.size
+            previous = term
+        return terms, values
+
+    def get(self, term, default=None):
+        block = bisect_right(self.first_terms, term) - 1
+        if block < 0:
+            return default
+        terms, values = self.block(block)
+        i = bisect_left(terms, term)
+        if i < len(terms) and terms[i] == term:
+            return values[i]
+        return default
+
+    def __getitem__(self, term):
+        value = self.get(term)
+        if value is None:
+            raise KeyError(term)
+        return value
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __len__(self):
+        return self.count
+
+    # Ordinal (rank in sorted order) of the first term >= term
+    def bisect(self, term):
+        if not self.first_terms:
+            return 0
+        block = max(0, bisect_right(self.first_terms, term) - 1)
+        terms, _ = self.block(block)
+        return block * BLOCK_SIZE + bisect_left(terms, term)
+
+    def term_at(self, ordinal):
+        terms, _ = self.block(ordinal // BLOCK_SIZE)
+        return terms[ordinal % BLOCK_SIZE]
+
+    # Terms and values with ordinals in [low, high), in sorted order
+    def items(self, low=0, high=None):
+        high = self.count if high is None else min(high, self.count)
+        ordinal = low
+        while ordinal < high:
+            block = ordinal // BLOCK_SIZE
+            terms, values = self.decode_block(block)
+            start = ordinal - block * BLOCK_SIZE
+            end = min(len(terms), high - block * BLOCK_SIZE)
+            yield from zip(terms[start:end], values[start:end])
+            ordinal += end - start
+
+    def terms(self, low=0, high=None):
+        return (term for term, _ in self.items(low, high))
+
+    def __iter__(self):
+        return self.terms()
+
+    def close(self):
+        self.block.cache_clear()
+        self.data.close()
+        self.file.close()
@@ -0,0 +1,153 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+from array import array
+
+# Persisted cache of analyzed texts, so that rebuilding an index (with another weighting scheme, zone layout or
+# postings format) reads the terms of unchanged texts instead of tokenizing and stemming them again.
+#
+# The terms of every text are stored as a stream of term ids, keyed by the hash of the text. A cache directory holds
+# one sub-directory per analyzer settings (Analyzer.key), with
+# - vocabulary.pickle: the terms, by term id
+# - tokens.bin: the term id streams of all the texts, packed as 4-byte integers, appended to by every save
+# - index.pickle: hash of a text -> (offset, count) of its term ids in tokens.bin
+#
+# Lookups only read the cache loaded on open, so a cache opened by a parent process can be used by worker processes:
+# every process records the texts it analyzed (added), the workers hand them over to the parent (take_added, update),
+# which saves them. Saving appends to the files on disk under a lock, so concurrent builds don't lose entries.
+
+VOCABULARY_FILE = 'vocabulary.pickle'
+TOKENS_FILE = 'tokens.bin'
+INDEX_FILE = 'index.pickle'
+LOCK_FILE = 'lock'
+
+TERM_ID = 'I'
+
+
+def text_hash(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+def write_pickle(path, data):
+    with open(path + '.tmp', 'wb') as handle:
+        pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+class TokenCache:
+    def __init__(self, directory, analyzer):
+        self.analyzer = analyzer
+        self.directory = os.path.join(directory, analyzer.key)
+        os.makedirs(self.directory, exist_ok=True)
+        self.vocabulary, self.index = self.read()
+        self.tokens = None
+        self.tokens_file = None
+        self.open_tokens()
+        self.added = {}
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self):
+        if not os.path.exists(self.path(INDEX_FILE)):
+            return [], {}
+        with open(self.path(VOCABULARY_FILE), 'rb') as handle:
+            vocabulary = pickle.load(handle)
+        with open(self.path(INDEX_FILE), 'rb') as handle:
+            index = pickle.load(handle)
+        return vocabulary, index
+
+    def open_tokens(self):
+        if self.tokens is not None:
+            self.tokens.close()
+            self.tokens_file.close()
+            self.tokens = self.tokens_file = None
+        if os.path.exists(self.path(TOKENS_FILE)) and os.path.getsize(self.path(TOKENS_FILE)):
+            self.tokens_file = open(self.path(TOKENS_FILE), 'rb')
+            self.tokens = mmap.mmap(self.tokens_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, text):
+        key = text_hash(text)
+        entry = self.index.get(key)
+        if entry is None:
+            return self.added.get(key)
+        offset, count = entry
+        if not count:
+            return []
+        term_ids = array(TERM_ID)
+        term_ids.frombytes(self.tokens[offset * term_ids.itemsize:(offset + count) * term_ids.itemsize])
+        vocabulary = self.vocabulary
+        return [vocabulary[term_id] for term_id in term_ids]
+
+    # Terms of the text, from the cache or analyzed (and recorded to be saved)
+    def analyze(self, text):
+        terms = self.get(text)
+        if terms is not None:
+            self.hits += 1
+            return terms
+        self.misses += 1
+        terms = self.analyzer.analyze(text)
+        self.added[text_hash(text)] = terms
+        return terms
+
+    # Analyze many texts at once, the texts missing from the cache in one batch of the analyzer
+    def analyze_batch(self, texts):
+        results = [self.get(text) for text in texts]
+        missing = [i for i, terms in enumerate(results) if terms is None]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        for i, terms in zip(missing, self.analyzer.analyze_batch([texts[i] for i in missing])):
+            self.added[text_hash(texts[i])] = terms
+            results[i] = terms
+        return results
+
+    # Texts analyzed since the last call (by a worker process), to be handed over to the process saving the cache
+    def take_added(self):
+        added = self.added
+        self.added = {}
+        return added
+
+    def update(self, added):
+        self.added.update(added)
+
+    # Append the analyzed texts to the cache on disk
+    def save(self):
+        if not self.added:
+            return
+        with open(self.path(LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # another process may have saved since this cache was opened
+                vocabulary, index = self.read()
+                term_ids = {term: term_id for term_id, term in enumerate(vocabulary)}
+                with open(self.path(TOKENS_FILE), 'ab') as tokens_file:
+                    offset = tokens_file.tell() // array(TERM_ID).itemsize
+                    for key, terms in self.added.items():
+                        if key in index:
+                            continue
+                        stream = array(TERM_ID)
+                        for term in terms:
+                            term_id = term_ids.get(term)
+                            if term_id is None:
+                                term_id = term_ids[term] = len(vocabulary)
+                                vocabulary.append(term)
+                            stream.append(term_id)
+                        tokens_file.write(stream.tobytes())
+                        index[key] = (offset, len(stream))
+                        offset += len(stream)
+                write_pickle(self.path(VOCABULARY_FILE), vocabulary)
+                write_pickle(self.path(INDEX_FILE), index)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.vocabulary, self.index = vocabulary, index
+        self.added = {}
+        self.open_tokens()
+
+    def close(self):
+        if self.tokens is not None:
+            self.tokens.close()
+            self.tokens_file.close()